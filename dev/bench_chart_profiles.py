@@ -0,0 +1,96 @@
+"""Benchmark render profiles of stats charts: render time and image size.
+
+Usage: python dev/bench_chart_profiles.py [--profiles preview,standard,print]
+                                          [--repeat 5]
+"""
+
+import argparse
+import io
+import os
+import random
+import statistics
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+os.chdir(ROOT)  # fonts are looked up relative to the repository root
+
+from PIL import Image  # noqa: E402
+
+from helpers import charts  # noqa: E402
+
+MONTHS = "Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec".split()
+CATEGORIES = ["food", "rent", "transport", "cafe", "health", "gifts", "books"]
+# Telethon uploads photos larger than this (a side) re-encoded
+MAX_PHOTO_SIDE = 2560
+
+
+def make_balance_history() -> dict:
+    now = time.time()
+    dates = [now - week * 7 * 86400 for week in range(52, -1, -1)]
+    values = [1000.0]
+    for _ in dates[1:]:
+        values.append(values[-1] + random.uniform(-150, 200))
+    return {
+        "dates": dates,
+        "values": values,
+        "title": "Total net worth (USD)",
+        "month_names": MONTHS,
+    }
+
+
+def make_category_distribution() -> dict:
+    return {
+        "title": "Transactions by category (USD)",
+        "income": {"salary": 24000.0, "gifts": 800.0},
+        "expense": {name: random.uniform(100, 5000) for name in CATEGORIES},
+        "income_title": "Income",
+        "expense_title": "Expense",
+        "no_data": "No data",
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--profiles", default=",".join(charts.PROFILES))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    jobs = [
+        ("balance", charts.render_balance_history, make_balance_history()),
+        ("pie", charts.render_category_pie_charts, make_category_distribution()),
+    ]
+    charts.warm_up()
+
+    print(
+        f"{'profile':>9} {'chart':>8} {'pixels':>11} {'ms':>8} {'KB':>8} "
+        f"{'sent as':>9}"
+    )
+    for name in args.profiles.split(","):
+        profile = charts.PROFILES[name]
+        for chart, render, data in jobs:
+            times = []
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                image = render(data, name)
+                times.append(time.perf_counter() - started)
+
+            width, height = Image.open(io.BytesIO(image)).size
+            if profile.document or profile.format == "webp":
+                sent_as = "file"
+            elif max(width, height) > MAX_PHOTO_SIDE:
+                sent_as = "resized"
+            else:
+                sent_as = "photo"
+            print(
+                f"{name:>9} {chart:>8} {f'{width}x{height}':>11} "
+                f"{statistics.median(times) * 1e3:>8.1f} {len(image) / 1024:>8.1f} "
+                f"{sent_as:>9}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Benchmark fuzzy name lookup: full WRatio scan vs n-gram candidate index.
+
+Usage: python dev/bench_name_lookup.py [--sizes 100,1000,10000] [--queries 200]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from rapidfuzz import fuzz, process  # noqa: E402
+from rapidfuzz.utils import default_process  # noqa: E402
+
+from helpers.name_index import NGramIndex  # noqa: E402
+
+SYLLABLES = [
+    "ka", "ro", "mi", "ne", "ta", "lo", "su", "vi", "de", "pa", "gro", "cer",
+    "ies", "fo", "od", "sal", "ary", "cash", "card", "tax", "ren", "bo", "ok",
+    "еда", "так", "си", "ка", "фе",
+]  # fmt: skip
+THRESHOLD = 75
+
+
+def make_vocabulary(size: int) -> list[str]:
+    names = set()
+    while len(names) < size:
+        name = "".join(random.choices(SYLLABLES, k=random.randint(2, 4)))
+        if random.random() < 0.1:
+            name += f" {random.choice(SYLLABLES)}{random.randint(1, 99)}"
+        names.add(name)
+    return [default_process(name) for name in names]
+
+
+def make_typo(name: str) -> str:
+    chars = list(name)
+    for _ in range(random.randint(1, 2)):
+        i = random.randrange(len(chars))
+        edit = random.choice(["drop", "swap", "replace"])
+        if edit == "drop" and len(chars) > 3:
+            del chars[i]
+        elif edit == "swap" and i + 1 < len(chars):
+            chars[i], chars[i + 1] = chars[i + 1], chars[i]
+        else:
+            chars[i] = random.choice("abcdefghijklmnopqrstuvwxyz")
+    return "".join(chars)
+
+
+def make_queries(vocabulary: list[str], count: int) -> list[str]:
+    # mostly typos of existing names, the rest are names that don't exist
+    queries = []
+    for _ in range(count):
+        if random.random() < 0.7:
+            queries.append(make_typo(random.choice(vocabulary)))
+        else:
+            queries.append("".join(random.choices(SYLLABLES, k=3)) + "zq")
+    return [default_process(query) for query in queries]
+
+
+def timed(lookup, queries: list[str]) -> tuple[float, list]:
+    started = time.perf_counter()
+    results = [lookup(query) for query in queries]
+    return (time.perf_counter() - started) / len(queries), results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", default="100,500,1000,5000,20000,50000")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    cutoff = THRESHOLD - 0.5
+
+    print(
+        f"{'names':>8} {'build ms':>9} {'scan ms':>9} {'index ms':>9} "
+        f"{'speedup':>8} {'matched':>8}"
+    )
+    for size in map(int, args.sizes.split(",")):
+        vocabulary = make_vocabulary(size)
+        queries = make_queries(vocabulary, args.queries)
+
+        started = time.perf_counter()
+        index = NGramIndex(vocabulary)
+        build = time.perf_counter() - started
+
+        scan, expected = timed(
+            lambda query: process.extractOne(
+                query,
+                vocabulary,
+                scorer=fuzz.WRatio,
+                processor=None,
+                score_cutoff=cutoff,
+            ),
+            queries,
+        )
+        indexed, results = timed(
+            lambda query: index.extract_one(query, score_cutoff=cutoff), queries
+        )
+
+        for query, a, b in zip(queries, expected, results):
+            if (a and a[1:]) != (b and b[1:]):
+                raise AssertionError(f"Results differ for {query!r}: {a} != {b}")
+
+        matched = sum(result is not None for result in results)
+        print(
+            f"{size:>8} {build * 1e3:>9.1f} {scan * 1e3:>9.3f} {indexed * 1e3:>9.3f} "
+            f"{scan / indexed:>7.1f}x {matched:>8}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Check that drawing charts over and over doesn't grow memory of a worker.
+
+Draws every chart --count times after a warm-up and compares the peak RSS
+of the process before and after; exits with an error if it grew by more
+than --max-growth MB. Catches leaks in matplotlib and numpy that only
+show as native memory (numpy 2.4.0 leaked every np.roots call, which
+matplotlib makes for each pie wedge).
+
+Usage: python dev/check_chart_memory.py [--count 300] [--max-growth 20]
+                                        [--profile standard]
+"""
+
+import argparse
+import gc
+import os
+import resource
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)  # fonts are looked up relative to the repository root
+
+import bench_chart_profiles as bench  # noqa: E402
+
+from helpers import charts  # noqa: E402
+
+# renders before the baseline is taken, caches of matplotlib fill up first
+WARM_UP_RENDERS = 50
+
+
+def peak_rss_mb() -> float:
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=300)
+    parser.add_argument("--max-growth", type=float, default=20.0)
+    parser.add_argument("--profile", default=charts.DEFAULT_PROFILE)
+    args = parser.parse_args()
+
+    jobs = [
+        ("balance", charts.render_balance_history, bench.make_balance_history),
+        ("pie", charts.render_category_pie_charts, bench.make_category_distribution),
+    ]
+    charts.warm_up()
+
+    failed = False
+    for chart, render, make_data in jobs:
+        for _ in range(WARM_UP_RENDERS):
+            render(make_data(), args.profile)
+        gc.collect()
+        before = peak_rss_mb()
+
+        for _ in range(args.count):
+            render(make_data(), args.profile)
+        gc.collect()
+        growth = peak_rss_mb() - before
+
+        ok = growth <= args.max_growth
+        failed |= not ok
+        print(
+            f"{chart:>8}: {args.count} renders, peak RSS {before:.1f} MB "
+            f"-> +{growth:.1f} MB {'ok' if ok else 'FAILED'}"
+        )
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
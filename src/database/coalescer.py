@@ -0,0 +1,150 @@
+import asyncio
+import os
+import time
+from typing import Any, Awaitable, Callable
+
+from loguru import logger
+from sqlalchemy.ext.asyncio import (AsyncEngine, AsyncSession,
+                                    async_sessionmaker)
+
+# unit of work: gets a session inside its own savepoint, must not commit
+WriteJob = Callable[[AsyncSession], Awaitable[Any]]
+
+
+class WriteCoalescer:
+    """Group-commit writes from concurrent events into one transaction.
+
+    Jobs submitted within a short window are run one after another in a
+    single session, each inside its own SAVEPOINT, and committed together.
+    A failing job only rolls back its savepoint; its error is raised to its
+    submitter while the rest of the batch is still committed.
+    """
+
+    def __init__(self):
+        self.session_maker: async_sessionmaker[AsyncSession] | None = None
+        self.queue: asyncio.Queue | None = None
+        self.task: asyncio.Task | None = None
+        self.window = 0.005
+        self.max_batch = 64
+
+        self.batches = 0
+        self.jobs = 0
+        self.max_batch_size = 0
+        self.total_added_latency = 0.0
+        self.max_added_latency = 0.0
+
+    def start(self, engine: AsyncEngine) -> None:
+        """Start collecting batches, commit them through `engine`."""
+        self.session_maker = async_sessionmaker(bind=engine, expire_on_commit=False)
+        self.window = int(os.getenv("WRITE_COALESCE_WINDOW_MS", "5")) / 1000
+        self.max_batch = int(os.getenv("WRITE_COALESCE_MAX_BATCH", "64"))
+        self.queue = asyncio.Queue()
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Commit jobs submitted so far, then stop the batching task."""
+        if self.task is not None:
+            assert self.queue is not None
+            await self.queue.join()
+            self.task.cancel()
+            self.task = None
+            self.queue = None
+
+    async def submit(self, job: WriteJob) -> Any:
+        """Run job in the next batch, return its result once committed."""
+        if self.queue is None:
+            raise RuntimeError("Write coalescer is not started")
+
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((job, future, time.monotonic()))
+        return await future
+
+    def metrics(self) -> dict[str, float]:
+        """Return batch size and added latency statistics."""
+        return {
+            "batches": self.batches,
+            "jobs": self.jobs,
+            "avg_batch_size": self.jobs / self.batches if self.batches else 0,
+            "max_batch_size": self.max_batch_size,
+            "avg_added_latency_ms": (
+                self.total_added_latency / self.jobs * 1000 if self.jobs else 0
+            ),
+            "max_added_latency_ms": self.max_added_latency * 1000,
+        }
+
+    async def _collect(self) -> list:
+        """Wait for a job, then gather more for up to one window."""
+        assert self.queue is not None
+        batch = [await self.queue.get()]
+
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def _run_batch(self, batch: list) -> None:
+        """Run jobs of one batch in a single transaction, resolve futures."""
+        assert self.session_maker is not None
+        outcomes = []
+        run_time = {}
+
+        async with self.session_maker() as session:
+            for job, future, _submitted in batch:
+                started = time.monotonic()
+                try:
+                    async with session.begin_nested():
+                        result = await job(session)
+                    outcomes.append((future, result, None))
+                except Exception as e:
+                    outcomes.append((future, None, e))
+                run_time[future] = time.monotonic() - started
+
+            try:
+                await session.commit()
+            except Exception as e:
+                # nothing of this batch got written
+                outcomes = [(future, None, e) for future, _, _ in outcomes]
+
+        done = time.monotonic()
+        for (future, result, error), (_job, _future, submitted) in zip(outcomes, batch):
+            added_latency = done - submitted - run_time[future]
+            self.total_added_latency += added_latency
+            self.max_added_latency = max(self.max_added_latency, added_latency)
+
+            if future.done():  # submitter went away
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+        self.batches += 1
+        self.jobs += len(batch)
+        self.max_batch_size = max(self.max_batch_size, len(batch))
+        logger.debug(f"Committed write batch of {len(batch)} job(s)")
+
+    async def _run(self) -> None:
+        """Collect and commit batches until cancelled."""
+        while True:
+            batch = await self._collect()
+            try:
+                await self._run_batch(batch)
+            except Exception as e:
+                logger.error(f"Write batch failed: {e}")
+                for _job, future, _submitted in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            finally:
+                assert self.queue is not None
+                for _ in batch:
+                    self.queue.task_done()
+
+
+write_coalescer = WriteCoalescer()
@@ -1,12 +1,187 @@
+import os
+import random
+import re
+import time
+
+from loguru import logger
+from sqlalchemy import Engine, event, make_url
 from sqlalchemy.ext.asyncio import (AsyncEngine, AsyncSession,
                                     async_sessionmaker, create_async_engine)
+from sqlalchemy.orm import Session, SessionTransaction
+
+PRAGMA_VALUE_PATTERN = r"^-?\w+$"
+# sessions holding the writer longer than this (seconds) are logged
+WRITER_HOLD_WARNING = 1.0
+
+
+def get_sqlite_pragmas() -> dict[str, str]:
+    """Return SQLite performance profile configured through the environment."""
+    pragmas = {
+        "journal_mode": os.getenv("SQLITE_JOURNAL_MODE", "WAL"),
+        "synchronous": os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+        "mmap_size": os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)),  # bytes
+        "cache_size": os.getenv("SQLITE_CACHE_SIZE", "-65536"),  # negative is KiB
+        "temp_store": os.getenv("SQLITE_TEMP_STORE", "MEMORY"),
+        "busy_timeout": os.getenv("SQLITE_BUSY_TIMEOUT", "5000"),  # ms
+    }
+
+    for name, value in pragmas.items():
+        if not re.match(PRAGMA_VALUE_PATTERN, value):
+            raise ValueError(f"Invalid value for SQLite pragma {name}: {value}")
+
+    return pragmas
+
+
+def apply_sqlite_pragmas(dbapi_connection, pragmas: dict[str, str]) -> None:
+    """Apply SQLite performance profile to a freshly opened connection."""
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+
+async def get_sqlite_settings(engine: AsyncEngine) -> dict[str, str]:
+    """Return the values of profile pragmas as seen by a live connection."""
+    settings = {}
+    async with engine.connect() as conn:
+        for name in get_sqlite_pragmas():
+            result = await conn.exec_driver_sql(f"PRAGMA {name}")
+            settings[name] = str(result.scalar())
+    return settings
+
+
+def is_sqlite_file(database_url: str) -> bool:
+    """Check if URL points to an on-disk SQLite database."""
+    url = make_url(database_url)
+    return (
+        url.get_backend_name() == "sqlite"
+        and url.database not in (None, "", ":memory:")
+        and url.query.get("mode") != "memory"
+    )
 
 
 def get_async_engine(database_url: str) -> AsyncEngine:
-    """Return SQLAlchemy AsyncEngine object for the given database URL."""
-    return create_async_engine(database_url, echo=False, future=True)
+    """Return SQLAlchemy AsyncEngine object for the given database URL.
+
+    For on-disk SQLite databases this is the single writer engine: its pool
+    holds one connection, so all writes are serialized in the process. A
+    session holds it from its first write until it commits, so handlers
+    must commit before awaiting Telegram or anything else slow; long writes
+    go through the write coalescer. Waiting for the writer fails after
+    SQLITE_BUSY_TIMEOUT, just like waiting for the lock of another process.
+    """
+    options = {}
+    if is_sqlite_file(database_url):
+        busy_timeout = int(get_sqlite_pragmas()["busy_timeout"]) / 1000  # seconds
+        options = {"pool_size": 1, "max_overflow": 0, "pool_timeout": busy_timeout}
+
+    engine = create_async_engine(database_url, echo=False, future=True, **options)
+
+    if engine.dialect.name == "sqlite":
+        pragmas = get_sqlite_pragmas()
+
+        @event.listens_for(engine.sync_engine, "connect")
+        def on_connect(dbapi_connection, connection_record):
+            apply_sqlite_pragmas(dbapi_connection, pragmas)
+            # let SQLAlchemy, not pysqlite, decide when transactions begin,
+            #  otherwise SAVEPOINTs and transactional DDL don't work
+            dbapi_connection.isolation_level = None
+
+        @event.listens_for(engine.sync_engine, "begin")
+        def on_begin(conn):
+            if conn.get_execution_options().get("isolation_level") != "AUTOCOMMIT":
+                # take the write lock up front, the writer is only used to write
+                conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+    return engine
+
+
+def get_reader_engines(database_url: str) -> list[AsyncEngine]:
+    """Return read-only engines for the same SQLite database file.
+
+    Returns no engines for databases that can't be opened a second time
+    (in-memory SQLite) or when SQLITE_READERS is 0.
+    """
+    count = int(os.getenv("SQLITE_READERS", "2"))
+    if count < 1 or not is_sqlite_file(database_url):
+        return []
+
+    url = make_url(database_url)
+    url = url.set(
+        database=f"file:{url.database}",
+        query={**url.query, "mode": "ro", "uri": "true"},
+    )
+
+    # journal mode is a property of the database file, set by the writer
+    pragmas = get_sqlite_pragmas()
+    pragmas.pop("journal_mode")
+    pragmas["query_only"] = "ON"
+
+    engines = []
+    for _ in range(count):
+        engine = create_async_engine(url, echo=False, future=True)
+
+        @event.listens_for(engine.sync_engine, "connect")
+        def on_connect(dbapi_connection, connection_record):
+            apply_sqlite_pragmas(dbapi_connection, pragmas)
+
+        engines.append(engine)
+
+    return engines
+
+
+class RoutingSession(Session):
+    """Session sending plain reads to reader engines, the rest to the writer.
+
+    Once a transaction has written anything, its following reads stick to
+    the writer as well, so they see the uncommitted changes.
+    """
+
+    readers: list[Engine] = []
+
+    def get_bind(self, mapper=None, *, clause=None, **kw):
+        if self._flushing or not getattr(clause, "is_select", False):
+            self.info["wrote"] = True
+            self.info.setdefault("wrote_at", time.monotonic())
+        elif self.readers and not self.info.get("wrote"):
+            return random.choice(self.readers)
+
+        return super().get_bind(mapper, clause=clause, **kw)
+
+
+@event.listens_for(RoutingSession, "do_orm_execute")
+def expose_statement(orm_execute_state) -> None:
+    """Pass statement to get_bind, compound ORM selects are missing it."""
+    orm_execute_state.bind_arguments.setdefault("clause", orm_execute_state.statement)
+
+
+@event.listens_for(RoutingSession, "after_transaction_end")
+def reset_routing(session: Session, transaction: SessionTransaction) -> None:
+    """Route reads back to reader engines once the transaction is over."""
+    if transaction.parent is None:
+        session.info.pop("wrote", None)
+        wrote_at = session.info.pop("wrote_at", None)
+        if wrote_at is not None:
+            held = time.monotonic() - wrote_at
+            if held > WRITER_HOLD_WARNING:
+                logger.warning(
+                    f"Session held the writer for {held:.1f}s, "
+                    "commit before awaiting the network"
+                )
+
 
+def get_session_maker(
+    engine: AsyncEngine, readers: list[AsyncEngine] | None = None
+) -> async_sessionmaker[AsyncSession]:
+    """Create and return a sessionmaker for async SQLAlchemy sessions.
 
-def get_session_maker(engine: AsyncEngine) -> async_sessionmaker[AsyncSession]:
-    """Create and return a sessionmaker for async SQLAlchemy sessions."""
-    return async_sessionmaker(bind=engine, expire_on_commit=False)
+    Sessions write through `engine` and read through one of `readers`.
+    """
+    session_class = type(
+        "RoutingSession",
+        (RoutingSession,),
+        {"readers": [reader.sync_engine for reader in readers or []]},
+    )
+    return async_sessionmaker(
+        bind=engine, expire_on_commit=False, sync_session_class=session_class
+    )
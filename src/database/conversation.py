@@ -0,0 +1,160 @@
+import asyncio
+import copy
+import os
+import time
+from typing import Any
+
+from loguru import logger
+from sqlalchemy import delete, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .coalescer import write_coalescer
+from .models import ConversationState, User
+
+# rows written per statement by the write-behind
+FLUSH_CHUNK_SIZE = 500
+
+
+def empty_state() -> dict[str, Any]:
+    """Return state of a user who is not in the middle of anything."""
+    return {"transaction": [], "expect": {"type": None, "data": None}, "message": None}
+
+
+class Conversation(dict):
+    """Conversation state of one user.
+
+    Holds the pending transaction ("transaction"), the input the bot waits
+    for ("expect") and the id of the last prompt message ("message"). Like
+    with MutableDict, only assignments to top-level keys are tracked.
+    """
+
+    def __init__(self, user_id: bytes, state: dict[str, Any], updated_at: float):
+        super().__init__(state)
+        self.user_id = user_id
+        self.updated_at = updated_at
+        self.dirty = False
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        super().__setitem__(key, value)
+        self.updated_at = time.time()
+        self.dirty = True
+
+
+class ConversationStore:
+    """In-memory conversation states with write-behind to the database.
+
+    Changes are kept in memory and periodically written to the
+    conversation_states table through the write coalescer, so that a
+    restart doesn't lose pending prompts. States untouched for longer than
+    CONVERSATION_TTL seconds expire.
+    """
+
+    def __init__(self):
+        self.states: dict[bytes, Conversation] = {}
+        self.task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        """Start writing changed states in the background."""
+        interval = float(os.getenv("CONVERSATION_FLUSH_INTERVAL", "1"))  # seconds
+        self.task = asyncio.create_task(self._run(interval))
+
+    async def stop(self) -> None:
+        """Stop the background task, write out remaining changes."""
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        await self.flush()
+
+    async def load(self, session: AsyncSession, user: User) -> Conversation:
+        """Return state of the user, read it from the database if needed."""
+        conversation = self.states.get(user.id)
+        if conversation is None:
+            conversation = await self._read(session, user)
+            # keep the state another event may have loaded meanwhile
+            conversation = self.states.setdefault(user.id, conversation)
+
+        if self._is_expired(conversation):
+            conversation = Conversation(user.id, empty_state(), time.time())
+            conversation.dirty = True
+            self.states[user.id] = conversation
+
+        return conversation
+
+    def get(self, user_id: bytes) -> Conversation:
+        """Return state of a user loaded for the current event."""
+        return self.states[user_id]
+
+    async def flush(self) -> int:
+        """Write changed states to the database, return their number."""
+        changed = [c for c in self.states.values() if c.dirty]
+        if not changed:
+            return 0
+
+        rows = [
+            {
+                "user_id": c.user_id,
+                "state": copy.deepcopy(dict(c)),
+                "updated_at": int(c.updated_at),
+            }
+            for c in changed
+        ]
+        for conversation in changed:
+            conversation.dirty = False
+
+        async def write(session: AsyncSession):
+            for i in range(0, len(rows), FLUSH_CHUNK_SIZE):
+                chunk = rows[i : i + FLUSH_CHUNK_SIZE]
+                await session.execute(
+                    delete(ConversationState).where(
+                        ConversationState.user_id.in_([r["user_id"] for r in chunk])
+                    )
+                )
+                await session.execute(insert(ConversationState), chunk)
+
+        try:
+            await write_coalescer.submit(write)
+        except Exception:
+            for conversation in changed:
+                conversation.dirty = True
+            raise
+
+        return len(rows)
+
+    async def _read(self, session: AsyncSession, user: User) -> Conversation:
+        result = await session.execute(
+            select(ConversationState.state, ConversationState.updated_at).where(
+                ConversationState.user_id == user.id
+            )
+        )
+        row = result.one_or_none()
+        if row is not None:
+            return Conversation(user.id, row.state or empty_state(), row.updated_at)
+
+        # not backfilled yet, take over the legacy column
+        state = copy.deepcopy(dict(user.expectation or empty_state()))
+        conversation = Conversation(user.id, state, time.time())
+        conversation.dirty = True
+        return conversation
+
+    def _is_expired(self, conversation: Conversation) -> bool:
+        ttl = float(os.getenv("CONVERSATION_TTL", "86400"))  # seconds
+        return time.time() - conversation.updated_at > ttl
+
+    def _evict_expired(self) -> None:
+        """Forget expired states that are already written."""
+        for user_id, conversation in list(self.states.items()):
+            if not conversation.dirty and self._is_expired(conversation):
+                del self.states[user_id]
+
+    async def _run(self, interval: float) -> None:
+        """Write changed states every `interval` seconds until cancelled."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+                self._evict_expired()
+            except Exception as e:
+                logger.error(f"Failed to write conversation states: {e}")
+
+
+conversations = ConversationStore()
@@ -1,9 +1,18 @@
+import asyncio
+
 from sqlalchemy.ext.asyncio import AsyncEngine
 
-from .models import Base
+from .migrations import migrate
+
+
+async def init_db(engine: AsyncEngine) -> asyncio.Task | None:
+    """Bring the database schema up to date.
 
+    Pending backfills keep running in the background while the bot serves
+    events; the returned task (if any) finishes once they are done.
+    """
+    backfills = await migrate(engine)
+    if backfills is None:
+        return None
 
-async def init_db(engine: AsyncEngine) -> None:
-    """Create all tables in the database that do not yet exist."""
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+    return asyncio.create_task(backfills)
@@ -0,0 +1,300 @@
+import asyncio
+import json
+import os
+import time
+from typing import Awaitable, Callable
+
+from loguru import logger
+from sqlalchemy import (BigInteger, Boolean, Column, Connection, Integer,
+                        MetaData, String, Table, func, inspect, select, text,
+                        update)
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from .models import Base
+
+metadata = MetaData()
+
+schema_version = Table(
+    "schema_version",
+    metadata,
+    Column("version", Integer, primary_key=True),
+    Column("description", String, nullable=False),
+    Column("applied_at", BigInteger, nullable=False),  # unix timestamp
+    Column("backfilled", Boolean, nullable=False, default=False),
+)
+
+# schema step, runs inside the transaction that records the new version
+Upgrade = Callable[[Connection], None]
+# one backfill batch: gets a batch size, returns the number of rows processed
+BackfillBatch = Callable[[Connection, int], int]
+
+
+class Migration:
+    """Single versioned schema change with an optional online backfill.
+
+    A migration without an upgrade step only records a version, see the
+    baseline in MIGRATIONS.
+    """
+
+    def __init__(
+        self,
+        version: int,
+        description: str,
+        upgrade: Upgrade | None,
+        backfill: BackfillBatch | None = None,
+    ):
+        self.version = version
+        self.description = description
+        self.upgrade = upgrade
+        self.backfill = backfill
+
+
+def _create_hot_query_indexes(conn: Connection) -> None:
+    """Indexes for transaction history and live wallet/category lookups."""
+    statements = [
+        "CREATE INDEX IF NOT EXISTS ix_transactions_holder_datetime "
+        "ON transactions (holder, datetime)",
+        "CREATE INDEX IF NOT EXISTS ix_transactions_wallet_datetime "
+        "ON transactions (wallet_id, datetime)",
+        "CREATE INDEX IF NOT EXISTS ix_transactions_category_datetime "
+        "ON transactions (category_id, datetime)",
+        "CREATE INDEX IF NOT EXISTS ix_wallets_holder_live "
+        "ON wallets (holder, transaction_count DESC) WHERE is_deleted = 0",
+        "CREATE INDEX IF NOT EXISTS ix_categories_holder_live "
+        "ON categories (holder, transaction_count DESC) WHERE is_deleted = 0",
+    ]
+    for statement in statements:
+        conn.exec_driver_sql(statement)
+    conn.exec_driver_sql("ANALYZE")
+
+
+def _create_conversation_states(conn: Connection) -> None:
+    """Narrow table for conversation state, moved out of users.expectation."""
+    conn.exec_driver_sql(
+        "CREATE TABLE IF NOT EXISTS conversation_states ("
+        "user_id BLOB NOT NULL PRIMARY KEY REFERENCES users (id), "
+        "state JSON NOT NULL, "
+        "updated_at BIGINT NOT NULL)"
+    )
+
+
+def _backfill_conversation_states(conn: Connection, batch_size: int) -> int:
+    """Copy users.expectation of users without a conversation state yet."""
+    users = conn.execute(
+        text(
+            "SELECT id, expectation FROM users WHERE NOT EXISTS ("
+            "SELECT 1 FROM conversation_states WHERE user_id = users.id"
+            ") LIMIT :limit"
+        ),
+        {"limit": batch_size},
+    ).all()
+
+    empty = {"transaction": [], "expect": {"type": None, "data": None}, "message": None}
+    now = int(time.time())
+    rows = [
+        {
+            "user_id": user_id,
+            "state": json.dumps((expectation and json.loads(expectation)) or empty),
+            "updated_at": now,
+        }
+        for user_id, expectation in users
+    ]
+    if rows:
+        conn.execute(
+            text(
+                "INSERT INTO conversation_states (user_id, state, updated_at) "
+                "VALUES (:user_id, :state, :updated_at)"
+            ),
+            rows,
+        )
+    return len(users)
+
+
+def _create_deleted_indexes(conn: Connection) -> None:
+    """Indexes for counting deleted wallets and categories of a user."""
+    statements = [
+        "CREATE INDEX IF NOT EXISTS ix_wallets_holder_deleted "
+        "ON wallets (holder) WHERE is_deleted = 1",
+        "CREATE INDEX IF NOT EXISTS ix_categories_holder_deleted "
+        "ON categories (holder) WHERE is_deleted = 1",
+    ]
+    for statement in statements:
+        conn.exec_driver_sql(statement)
+
+
+def _add_user_data_version(conn: Connection) -> None:
+    """Counter of changes to the data of a user, keys cached charts."""
+    conn.exec_driver_sql(
+        "ALTER TABLE users ADD COLUMN data_version BIGINT NOT NULL DEFAULT 0"
+    )
+
+
+# ordered list of all migrations, append new ones to the end
+MIGRATIONS: list[Migration] = [
+    # baseline: the tables as they were before versioned migrations, which
+    #  databases without the version table already have; they are stamped
+    #  with it, fresh databases get the latest schema right away
+    Migration(1, "initial schema", None),
+    Migration(2, "hot query indexes", _create_hot_query_indexes),
+    Migration(
+        3,
+        "conversation states",
+        _create_conversation_states,
+        _backfill_conversation_states,
+    ),
+    Migration(4, "deleted wallet and category indexes", _create_deleted_indexes),
+    Migration(5, "user data version", _add_user_data_version),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def _read_state(conn: Connection) -> tuple[int | None, set[int]]:
+    """Return current schema version and versions with unfinished backfills.
+
+    Version is None for a database without the version table; such databases
+    are either empty or were created by plain `create_all` (version 1).
+    """
+    if not inspect(conn).has_table(schema_version.name):
+        return None, set()
+
+    current = conn.execute(select(func.max(schema_version.c.version))).scalar()
+    pending = conn.execute(
+        select(schema_version.c.version).where(schema_version.c.backfilled == False)
+    )
+    return current, set(pending.scalars().all())
+
+
+def _stamp(conn: Connection, migration: Migration, backfilled: bool = False) -> None:
+    """Record migration as applied."""
+    conn.execute(
+        schema_version.insert().values(
+            version=migration.version,
+            description=migration.description,
+            applied_at=int(time.time()),
+            backfilled=backfilled or migration.backfill is None,
+        )
+    )
+
+
+def _upgrade(conn: Connection) -> list[Migration]:
+    """Apply pending schema steps, return migrations with pending backfills."""
+    current, pending_backfills = _read_state(conn)
+
+    if current is None:
+        metadata.create_all(conn)
+        if not inspect(conn).has_table("users"):
+            # fresh database: create the latest schema right away,
+            #  there is nothing to backfill
+            Base.metadata.create_all(conn)
+            for migration in MIGRATIONS:
+                _stamp(conn, migration, backfilled=True)
+            logger.info(f"Created database schema at version {LATEST_VERSION}")
+            return []
+
+        _stamp(conn, MIGRATIONS[0])
+        current = MIGRATIONS[0].version
+
+    for migration in MIGRATIONS:
+        if migration.version <= current:
+            continue
+
+        logger.info(f"Applying migration {migration.version}: {migration.description}")
+        if migration.upgrade is not None:
+            migration.upgrade(conn)
+        _stamp(conn, migration)
+        if migration.backfill is not None:
+            pending_backfills.add(migration.version)
+
+    return [m for m in MIGRATIONS if m.version in pending_backfills]
+
+
+async def is_current(engine: AsyncEngine) -> bool:
+    """Check if schema is at the latest version with all backfills done."""
+    async with engine.connect() as conn:
+        current, pending_backfills = await conn.run_sync(_read_state)
+    return current == LATEST_VERSION and not pending_backfills
+
+
+async def upgrade(engine: AsyncEngine) -> list[Migration]:
+    """Bring schema to the latest version.
+
+    Every schema step runs in the same transaction as its version record.
+    Returns migrations whose backfills still have to be run.
+    """
+    async with engine.connect() as conn:
+        # pysqlite does not open a transaction before DDL statements, manage
+        #  it explicitly so that a failed step leaves no partial schema behind
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.exec_driver_sql("BEGIN IMMEDIATE")
+        try:
+            pending = await conn.run_sync(_upgrade)
+        except BaseException:
+            await conn.exec_driver_sql("ROLLBACK")
+            raise
+        await conn.exec_driver_sql("COMMIT")
+
+    return pending
+
+
+async def backfill_in_batches(engine: AsyncEngine, batch: BackfillBatch) -> int:
+    """Run backfill batch by batch, each in its own short transaction.
+
+    Stops when a batch processes fewer rows than requested. Batch size is
+    halved whenever a batch holds the write lock for too long.
+    """
+    # rows touched per transaction, and the pause between transactions that
+    #  gives message handlers a chance to take the SQLite write lock
+    batch_size = int(os.getenv("MIGRATION_BATCH_SIZE", "500"))
+    pause = float(os.getenv("MIGRATION_BATCH_PAUSE", "0.05"))
+    # a batch holding the write lock longer than this halves the batch size
+    max_lock_time = float(os.getenv("MIGRATION_MAX_LOCK_TIME", "0.1"))
+    total = 0
+
+    while True:
+        started = time.monotonic()
+        async with engine.begin() as conn:
+            processed = await conn.run_sync(batch, batch_size)
+        elapsed = time.monotonic() - started
+
+        total += processed
+        if processed < batch_size:
+            return total
+
+        if elapsed > max_lock_time and batch_size > 1:
+            batch_size //= 2
+
+        # yield the write lock to message handlers
+        await asyncio.sleep(pause)
+
+
+async def run_backfills(engine: AsyncEngine, migrations: list[Migration]) -> None:
+    """Run pending backfills in order, mark each one done when finished."""
+    for migration in migrations:
+        logger.info(
+            f"Starting backfill for migration {migration.version}: "
+            f"{migration.description}"
+        )
+        total = await backfill_in_batches(engine, migration.backfill)  # type: ignore
+
+        async with engine.begin() as conn:
+            await conn.execute(
+                update(schema_version)
+                .where(schema_version.c.version == migration.version)
+                .values(backfilled=True)
+            )
+        logger.success(
+            f"Backfill for migration {migration.version} done ({total} rows)."
+        )
+
+
+async def migrate(engine: AsyncEngine) -> Awaitable[None] | None:
+    """Upgrade schema, return coroutine running pending backfills if any."""
+    if await is_current(engine):
+        return None
+
+    pending = await upgrade(engine)
+    if not pending:
+        return None
+
+    return run_backfills(engine, pending)
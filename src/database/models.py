@@ -1,8 +1,8 @@
 import uuid
 from enum import Enum as PyEnum
 
-from sqlalchemy import (BigInteger, Boolean, Column, Enum, ForeignKey, Integer,
-                        String, Text, TypeDecorator, UniqueConstraint)
+from sqlalchemy import (BigInteger, Boolean, Column, Enum, ForeignKey, Index,
+                        Integer, String, Text, TypeDecorator, UniqueConstraint)
 from sqlalchemy.dialects.sqlite import BLOB, JSON
 from sqlalchemy.ext.mutable import MutableDict
 from sqlalchemy.orm import declarative_base, relationship
@@ -45,7 +45,10 @@ class User(Base):
     registered_at = Column(BigInteger, nullable=False)  # unix timestamp
     language = Column(String, nullable=True)
     is_banned = Column(Boolean, default=False)
+    # legacy conversation state, superseded by ConversationState
     expectation = Column(MutableDict.as_mutable(JSON), nullable=True)
+    # bumped on every change of transactions, wallets or categories
+    data_version = Column(BigInteger, nullable=False, default=0)
 
     wallets = relationship("Wallet", back_populates="holder_user")
     categories = relationship("Category", back_populates="holder_user")
@@ -70,6 +73,18 @@ class Wallet(Base):
     holder_user = relationship("User", back_populates="wallets")
     transactions = relationship("Transaction", back_populates="wallet")
 
+    __table_args__ = (
+        # live wallets of a user, most used first (menus, start screen)
+        Index(
+            "ix_wallets_holder_live",
+            "holder",
+            transaction_count.desc(),
+            sqlite_where=is_deleted == False,
+        ),
+        # deleted ones are only counted
+        Index("ix_wallets_holder_deleted", "holder", sqlite_where=is_deleted == True),
+    )
+
 
 class Category(Base):
     __tablename__ = "categories"
@@ -86,6 +101,20 @@ class Category(Base):
     holder_user = relationship("User", back_populates="categories")
     transactions = relationship("Transaction", back_populates="category")
 
+    __table_args__ = (
+        # live categories of a user, most used first (menus)
+        Index(
+            "ix_categories_holder_live",
+            "holder",
+            transaction_count.desc(),
+            sqlite_where=is_deleted == False,
+        ),
+        # deleted ones are only counted
+        Index(
+            "ix_categories_holder_deleted", "holder", sqlite_where=is_deleted == True
+        ),
+    )
+
 
 class Transaction(Base):
     __tablename__ = "transactions"
@@ -103,6 +132,12 @@ class Transaction(Base):
     wallet = relationship("Wallet", back_populates="transactions")
     category = relationship("Category", back_populates="transactions")
 
+    __table_args__ = (
+        Index("ix_transactions_holder_datetime", "holder", "datetime"),
+        Index("ix_transactions_wallet_datetime", "wallet_id", "datetime"),
+        Index("ix_transactions_category_datetime", "category_id", "datetime"),
+    )
+
 
 class WalletAlias(Base):
     __tablename__ = "wallet_aliases"
@@ -134,3 +169,12 @@ class CategoryAlias(Base):
     __table_args__ = (
         UniqueConstraint("holder", "alias", name="uq_category_alias_per_user"),
     )
+
+
+class ConversationState(Base):
+    __tablename__ = "conversation_states"
+
+    user_id = Column(BLOB, ForeignKey("users.id"), primary_key=True)
+    # pending transaction, expected input and prompt message id
+    state = Column(JSON, nullable=False)
+    updated_at = Column(BigInteger, nullable=False)  # unix timestamp
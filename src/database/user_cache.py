@@ -0,0 +1,208 @@
+import copy
+import os
+import time
+from collections import OrderedDict
+from typing import Any
+
+from sqlalchemy import event, inspect, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
+
+from .models import User
+
+# column values of a user, as last committed
+Snapshot = dict[str, Any]
+
+COLUMNS = [column.key for column in User.__table__.columns]
+
+
+def take_snapshot(user: User) -> Snapshot | None:
+    """Copy column values of user, None if some of them are not loaded."""
+    state = user.__dict__
+    if any(key not in state for key in COLUMNS):
+        return None
+    return {key: copy.deepcopy(state[key]) for key in COLUMNS}
+
+
+def take_changes(user: User) -> Snapshot | None:
+    """Copy column values of user changed by the flush, call after it.
+
+    None if some of them are not loaded: columns set to SQL expressions are
+    expired by the flush, only the database knows their values.
+    """
+    state = inspect(user)
+    if any(key not in state.dict for key in COLUMNS):
+        return None
+    changes = {}
+    for key in COLUMNS:
+        added = state.attrs[key].history.added
+        if added:
+            changes[key] = copy.deepcopy(added[0])
+    return changes
+
+
+class UserCache:
+    """Bounded LRU/TTL cache of users by Telegram id.
+
+    Holds snapshots of committed column values, never ORM instances: every
+    session gets its own User rehydrated from the snapshot. Columns changed
+    by a session are written through when it commits; the other columns of
+    the cached user are left alone, a session may hold outdated values of
+    them.
+    """
+
+    def __init__(self):
+        self.entries: OrderedDict[int, tuple[Snapshot, float]] = OrderedDict()
+        # of users being loaded, bumped on every change, so loads racing with
+        #  a commit are not stored
+        self.generations: dict[int, int] = {}
+        self.loads: dict[int, int] = {}  # loads in flight
+
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, session: AsyncSession, telegram_id: int) -> User | None:
+        """Return user attached to session, query the database on a miss."""
+        snapshot = self._lookup(telegram_id)
+        if snapshot is not None:
+            self.hits += 1
+            return self._rehydrate(session, snapshot)
+
+        self.misses += 1
+        generation = self.generations.setdefault(telegram_id, 0)
+        self.loads[telegram_id] = self.loads.get(telegram_id, 0) + 1
+        try:
+            result = await session.execute(
+                select(User).where(User.telegram_id == telegram_id)
+            )
+            user = result.scalar_one_or_none()
+
+            if user is not None and self.generations[telegram_id] == generation:
+                snapshot = take_snapshot(user)
+                if snapshot is not None:
+                    self._store(telegram_id, snapshot)
+        finally:
+            self.loads[telegram_id] -= 1
+            if not self.loads[telegram_id]:
+                del self.loads[telegram_id]
+                del self.generations[telegram_id]
+        return user
+
+    def peek(self, telegram_id: int) -> Snapshot | None:
+        """Return cached snapshot of user without touching LRU order or counters."""
+        entry = self.entries.get(telegram_id)
+        if entry is None or time.monotonic() >= entry[1]:
+            return None
+        return entry[0]
+
+    def put(self, telegram_id: int, snapshot: Snapshot) -> None:
+        """Replace cached user with a freshly committed snapshot."""
+        self._bump(telegram_id)
+        self._store(telegram_id, snapshot)
+
+    def update(self, telegram_id: int, changes: Snapshot) -> None:
+        """Apply committed column changes to cached user, if it is cached."""
+        entry = self.entries.get(telegram_id)
+        self._bump(telegram_id)
+        if entry is not None:
+            self.entries[telegram_id] = ({**entry[0], **changes}, entry[1])
+
+    def invalidate(self, telegram_id: int) -> None:
+        """Drop cached user, the next access queries the database."""
+        self._bump(telegram_id)
+        self.entries.pop(telegram_id, None)
+
+    def metrics(self) -> dict[str, float]:
+        """Return hit/miss counters."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0,
+            "size": len(self.entries),
+            "loads": len(self.loads),
+        }
+
+    def _lookup(self, telegram_id: int) -> Snapshot | None:
+        entry = self.entries.get(telegram_id)
+        if entry is None:
+            return None
+
+        snapshot, expires_at = entry
+        if time.monotonic() >= expires_at:
+            del self.entries[telegram_id]
+            return None
+
+        self.entries.move_to_end(telegram_id)
+        return snapshot
+
+    def _store(self, telegram_id: int, snapshot: Snapshot) -> None:
+        ttl = float(os.getenv("USER_CACHE_TTL", "300"))  # seconds
+        self.entries[telegram_id] = (snapshot, time.monotonic() + ttl)
+        self.entries.move_to_end(telegram_id)
+        if len(self.entries) > int(os.getenv("USER_CACHE_SIZE", "4096")):
+            self.entries.popitem(last=False)
+
+    def _bump(self, telegram_id: int) -> None:
+        if telegram_id in self.generations:
+            self.generations[telegram_id] += 1
+
+    @staticmethod
+    def _rehydrate(session: AsyncSession, snapshot: Snapshot) -> User:
+        """Attach user built from snapshot to session without a query."""
+        existing = session.identity_map.get(identity_key(User, snapshot["id"]))
+        if existing is not None:
+            return existing  # type: ignore
+
+        user = User(**copy.deepcopy(snapshot))
+        make_transient_to_detached(user)
+        session.add(user)
+        return user
+
+
+user_cache = UserCache()
+
+
+@event.listens_for(Session, "after_flush")
+def record_user_changes(session: Session, flush_context) -> None:
+    """Remember users written by the flush, until the session commits.
+
+    New users are remembered whole, changed users by their changed columns
+    only, deleted ones (and changes that can't be told) as None.
+    """
+    changes = session.info.setdefault("user_cache_changes", {})
+    for obj in session.new:
+        if isinstance(obj, User):
+            snapshot = take_snapshot(obj)
+            changes[obj.telegram_id] = snapshot and ("snapshot", snapshot)
+    for obj in session.dirty:
+        if isinstance(obj, User):
+            previous = changes.get(obj.telegram_id, ("changes", {}))
+            columns = take_changes(obj)
+            if previous is None or columns is None:
+                changes[obj.telegram_id] = None
+            else:
+                changes[obj.telegram_id] = (previous[0], {**previous[1], **columns})
+    for obj in session.deleted:
+        if isinstance(obj, User):
+            changes[obj.telegram_id] = None
+
+
+@event.listens_for(Session, "after_commit")
+def apply_user_changes(session: Session) -> None:
+    """Write committed user changes through to the cache."""
+    for telegram_id, change in session.info.pop("user_cache_changes", {}).items():
+        if change is None:
+            user_cache.invalidate(telegram_id)
+        elif change[0] == "snapshot":
+            user_cache.put(telegram_id, change[1])
+        else:
+            user_cache.update(telegram_id, change[1])
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def discard_user_changes(session: Session, previous_transaction) -> None:
+    """Drop users whose flushed changes may have been rolled back."""
+    for telegram_id in session.info.pop("user_cache_changes", {}):
+        user_cache.invalidate(telegram_id)
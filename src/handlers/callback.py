@@ -1,35 +1,46 @@
 import time
 import uuid
+from functools import partial
+from typing import Callable
 
-from sqlalchemy import delete, select
+from sqlalchemy import delete
 from sqlalchemy.ext.asyncio import AsyncSession
 from telethon import events
 
 import menus.categories as categories
+import menus.statements as statements
 import menus.stats as stats
 import menus.transactions as transactions
 import menus.wallets as wallets
+from database.conversation import conversations
 from database.models import Category, CategoryAlias, User, WalletAlias
+from database.user_cache import user_cache
+from handlers.dispatcher import dispatcher
 from handlers.message import COMMANDS
 from handlers.transaction import (create_category, create_wallet,
                                   register_transaction)
-from translate import setup_translations
+from helpers.callback_data import decode_callback
+from helpers.name_index import name_indexes
+from helpers.outbox import outbox
+from helpers.render_pool import render_pool
+from translate import get_translator
 
 
 async def update_user_language(
-    event, new_language: str, user: User, session: AsyncSession, command: str
+    session: AsyncSession, user: User, _, event, language: bytes, *, command: str
 ):
     """Update user lang in db, notify the user."""
+    new_language = language.decode("ascii")
     user.language = new_language
     session.add(user)
     await session.commit()
-    _ = await setup_translations(event.sender_id, session)
+    _ = get_translator(new_language)
 
-    await event.answer(_("language_set_popup"))
-    await event.edit(_("language_set_message"), buttons=None)
+    await outbox.answer(event, _("language_set_popup"))
+    await outbox.edit(event, _("language_set_message"), buttons=None)
 
     if command == "lang":
-        await event.respond(_("tutorial"))
+        await outbox.respond(event, _("tutorial"))
 
 
 async def universal_custom_page_input_workflow(
@@ -42,28 +53,28 @@ async def universal_custom_page_input_workflow(
     extra_data: list | None = None,
 ) -> None:
     """Ask user for a page to go to."""
+    state = conversations.get(user.id)
     # Store type, msg_id, and any extra context (like year/month)
     data_to_store = [type_, msg_id]
     if extra_data:
         data_to_store.extend(extra_data)
 
-    user.expectation["expect"] = {"type": "page", "data": data_to_store}
-    await session.commit()
+    state["expect"] = {"type": "page", "data": data_to_store}
 
-    await event.respond(_("universal_prompt_page_number"))
+    await outbox.respond(event, _("universal_prompt_page_number"))
 
 
 async def handle_command_category(
-    session: AsyncSession, event, user: User, data: list, _
+    session: AsyncSession, user: User, _, event, *, choice: str
 ) -> None:
     """Handle user pressing a button under category creation prompt msg."""
-    if data[1] == "cancel":
-        user.expectation["expect"] = {"type": None, "data": None}
-        await session.commit()
-        await event.respond(_("category_creation_cancelled"))
+    state = conversations.get(user.id)
+    if choice == "cancel":
+        state["expect"] = {"type": None, "data": None}
+        await outbox.respond(event, _("category_creation_cancelled"))
         return
 
-    category_name = user.expectation["expect"]["data"]
+    category_name = state["expect"]["data"]
 
     new_category = Category(
         id=uuid.uuid4().bytes,
@@ -83,36 +94,35 @@ async def handle_command_category(
         )
     )
 
+    state["expect"] = {"type": None, "data": None}
     await session.commit()
-    await session.refresh(new_category)
+    name_indexes.invalidate(user.id)
 
-    await event.edit(_("category_created_successfully").format(category_name))
-
-    user.expectation["expect"] = {"type": None, "data": None}
-    await session.commit()
+    await outbox.edit(event, _("category_created_successfully").format(category_name))
 
-    current_transaction = user.expectation["transaction"]
+    current_transaction = state["transaction"]
     if len(current_transaction) > 0:
-        await event.respond(
+        await outbox.respond(
+            event,
             _("transaction_handling_in_process").format(
                 " ".join(map(str, current_transaction))
-            )
+            ),
         )
         await register_transaction(session, user, _, event, current_transaction)
 
 
 async def handle_command_categoryalias(
-    session: AsyncSession, event, user: User, data: list, _
+    session: AsyncSession, user: User, _, event, *, choice: str
 ) -> None:
     """Handle user pressing a button under category alias creation msg."""
-    if data[1] == "cancel":
-        user.expectation["expect"] = {"type": None, "data": None}
-        await session.commit()
-        await event.respond(_("category_alias_creation_cancelled"))
+    state = conversations.get(user.id)
+    if choice == "cancel":
+        state["expect"] = {"type": None, "data": None}
+        await outbox.respond(event, _("category_alias_creation_cancelled"))
         return
 
-    elif data[1] == "new":
-        category_name = user.expectation["expect"]["data"][0]
+    elif choice == "new":
+        category_name = state["expect"]["data"][0]
 
         new_category = Category(
             id=uuid.uuid4().bytes,
@@ -123,24 +133,24 @@ async def handle_command_categoryalias(
         )
 
         session.add(new_category)
+        state["expect"] = {"type": None, "data": None}
         await session.commit()
-        await session.refresh(new_category)
-
-        await event.edit(_("category_created_successfully").format(category_name))
+        name_indexes.invalidate(user.id)
 
-        user.expectation["expect"] = {"type": None, "data": None}
-        await session.commit()
+        await outbox.edit(
+            event, _("category_created_successfully").format(category_name)
+        )
 
-        current_transaction = user.expectation["transaction"]
+        current_transaction = state["transaction"]
         if len(current_transaction) > 0:
             # await event.respond(_("transaction_handling_in_process").format(
             #      " ".join(map(str, current_transaction))
             # ))
             await register_transaction(session, user, _, event, current_transaction)
 
-    elif data[1] == "approve":
-        alias_name = user.expectation["expect"]["data"][0]
-        actual_category_id = bytes.fromhex(user.expectation["expect"]["data"][1])
+    elif choice == "approve":
+        alias_name = state["expect"]["data"][0]
+        actual_category_id = bytes.fromhex(state["expect"]["data"][1])
 
         new_alias = CategoryAlias(
             id=uuid.uuid4().bytes,
@@ -150,14 +160,15 @@ async def handle_command_categoryalias(
         )
 
         session.add(new_alias)
+        state["expect"] = {"type": None, "data": None}
         await session.commit()
+        name_indexes.invalidate(user.id)
 
-        await event.edit(_("category_alias_created_successfully").format(alias_name))
-
-        user.expectation["expect"] = {"type": None, "data": None}
-        await session.commit()
+        await outbox.edit(
+            event, _("category_alias_created_successfully").format(alias_name)
+        )
 
-        current_transaction = user.expectation.get("transaction")
+        current_transaction = state.get("transaction")
         if len(current_transaction) > 0:
             # await event.respond(_("transaction_handling_in_process").format(
             #      " ".join(map(str, current_transaction))
@@ -166,22 +177,22 @@ async def handle_command_categoryalias(
 
 
 async def handle_command_walletalias(
-    session: AsyncSession, event, user: User, data: list, _
+    session: AsyncSession, user: User, _, event, *, choice: str
 ) -> None:
     """Handle user pressing a button under category alias creation msg."""
-    if data[1] == "cancel":
-        user.expectation["expect"] = {"type": None, "data": None}
-        await session.commit()
-        await event.respond(_("wallet_alias_creation_cancelled"))
+    state = conversations.get(user.id)
+    if choice == "cancel":
+        state["expect"] = {"type": None, "data": None}
+        await outbox.respond(event, _("wallet_alias_creation_cancelled"))
         return
 
-    elif data[1] == "new":
-        name = user.expectation["expect"]["data"][0]
+    elif choice == "new":
+        name = state["expect"]["data"][0]
         await create_wallet(session, user, _, event, name)
 
-    elif data[1] == "approve":
-        alias_name = user.expectation["expect"]["data"][0]
-        actual_wallet_id = bytes.fromhex(user.expectation["expect"]["data"][1])
+    elif choice == "approve":
+        alias_name = state["expect"]["data"][0]
+        actual_wallet_id = bytes.fromhex(state["expect"]["data"][1])
 
         new_alias = WalletAlias(
             id=uuid.uuid4().bytes,
@@ -191,14 +202,15 @@ async def handle_command_walletalias(
         )
 
         session.add(new_alias)
+        state["expect"] = {"type": None, "data": None}
         await session.commit()
+        name_indexes.invalidate(user.id)
 
-        await event.edit(_("wallet_alias_created_successfully").format(alias_name))
-
-        user.expectation["expect"] = {"type": None, "data": None}
-        await session.commit()
+        await outbox.edit(
+            event, _("wallet_alias_created_successfully").format(alias_name)
+        )
 
-        current_transaction = user.expectation.get("transaction")
+        current_transaction = state.get("transaction")
         if len(current_transaction) > 0:
             # await event.respond(_("transaction_handling_in_process").format(
             #      " ".join(map(str, current_transaction))
@@ -206,174 +218,164 @@ async def handle_command_walletalias(
             await register_transaction(session, user, _, event, current_transaction)
 
 
-async def handle_command_action(
-    session: AsyncSession, event, user: User, data: list, _
-) -> None:
-    """Handle user pressing a button under one of the action menus."""
-
-    if data[1][0] == "c":
-        await categories.handle_action(session, event, user, data, _)
-
-    if data[1][0] == "w":
-        await wallets.handle_action(session, event, user, data, _)
-
-    if data[1][0] == "t":
-        await transactions.handle_action(session, event, user, data, _)
-
-    else:
-        raise Exception('Got unexpected data for callback command "action"')
-
-
 async def handle_command_page(
-    session: AsyncSession, event, user: User, data: list, _
+    session: AsyncSession,
+    user: User,
+    _,
+    event,
+    page: int,
+    year: int = 0,
+    month: int = 0,
+    *,
+    type_: str,
 ) -> None:
-    """Handle user pressing a pagination button."""
-
-    msg_id = int(bytes.fromhex(data[2]).decode("utf-8"))
-
-    # special handling for transactions which have year/month context
-    if data[1] == "t":
-        # format: page_t_MSGID_PAGE_YEAR_MONTH
-        page = None
-        try:
-            page = int(data[3])
-        except (IndexError, ValueError):
-            page = None
-
-        year = None
-        month = None
-        # attempt to extract year/month if present in data
-        if len(data) >= 6:
-            try:
-                year = int(data[4])
-                month = int(data[5])
-            except (IndexError, ValueError):
-                pass
-
-        if page:
-            await transactions.send_menu(
-                session, user, _, event, page, msg_id, year=year, month=month
-            )
-            return
-        else:
-            # Beam to page workflow (input), passing year/month context
-            extra = [year, month] if year and month else None
-            await universal_custom_page_input_workflow(
-                session, event, user, _, data[1], msg_id, extra_data=extra
-            )
-            return
-
-    # standard handling for Categories and Wallets
-    try:
-        page = int(data[3])
-    except IndexError:
-        page = None
-
+    """Handle user pressing a pagination button, page 0 asks for a number."""
+    # the menu is edited in place, so buttons don't need to carry its id
+    msg_id = event.message_id
     if page:
-        if data[1] == "c":
+        if type_ == "c":
             await categories.send_menu(session, user, _, event, page, msg_id)
-        elif data[1] == "w":
+        elif type_ == "w":
             await wallets.send_menu(session, user, _, event, page, msg_id)
+        elif type_ == "t":
+            await transactions.send_menu(
+                session,
+                user,
+                _,
+                event,
+                page,
+                msg_id,
+                year=year or None,
+                month=month or None,
+            )
         return
 
-    await universal_custom_page_input_workflow(session, event, user, _, data[1], msg_id)
+    # beam to page workflow (input), passing year/month context
+    extra = [year, month] if year and month else None
+    await universal_custom_page_input_workflow(
+        session, event, user, _, type_, msg_id, extra_data=extra
+    )
+
+
+async def handle_command_wallet(session: AsyncSession, user: User, _, event) -> None:
+    """Handle user cancelling wallet creation."""
+    state = conversations.get(user.id)
+    state["expect"] = {"type": None, "data": None}
+    await outbox.respond(event, _("wallet_creation_cancelled"))
+
+
+async def handle_command_transactions_menu(
+    session: AsyncSession, user: User, _, event, year: int, month: int | None = None
+) -> None:
+    """Handle user picking a year or month in the transactions menu."""
+    await transactions.send_menu(session, user, _, event, year=year, month=month)
 
 
 async def handle_command_export(
-    session: AsyncSession, event, user: User, data: list, _
+    session: AsyncSession, user: User, _, event, *, kind: str
 ) -> None:
     """Handle user pressing an export button."""
 
-    if data[1] == "categories":
+    if kind == "categories":
         await categories.export(session, event, user, _)
-    elif data[1] == "wallets":
+    elif kind == "wallets":
         await wallets.export(session, event, user, _)
-    elif data[1] == "transactions":
+    elif kind == "transactions":
         await transactions.export(session, event, user, _)
-    else:
-        raise Exception('Got unexpected data for callback command "export"')
+
+
+async def handle_command_none(session: AsyncSession, user: User, _, event) -> None:
+    """Handle user pressing a button without an action."""
+    await outbox.answer(event)
+
+
+# callback route -> (handler, whether pending input and transaction are
+#  dropped before it runs); handlers get the route arguments after `event`
+ROUTES: dict[str, tuple[Callable, bool]] = {
+    "none": (handle_command_none, False),
+    "lang": (partial(update_user_language, command="lang"), True),
+    "plang": (partial(update_user_language, command="plang"), True),
+    "category_approve": (partial(handle_command_category, choice="approve"), False),
+    "category_cancel": (partial(handle_command_category, choice="cancel"), False),
+    "wallet_cancel": (handle_command_wallet, False),
+    "categoryalias_approve": (
+        partial(handle_command_categoryalias, choice="approve"),
+        False,
+    ),
+    "categoryalias_new": (partial(handle_command_categoryalias, choice="new"), False),
+    "categoryalias_cancel": (
+        partial(handle_command_categoryalias, choice="cancel"),
+        False,
+    ),
+    "walletalias_approve": (
+        partial(handle_command_walletalias, choice="approve"),
+        False,
+    ),
+    "walletalias_new": (partial(handle_command_walletalias, choice="new"), False),
+    "walletalias_cancel": (partial(handle_command_walletalias, choice="cancel"), False),
+    "add_wallet": (create_wallet, True),
+    "add_category": (create_category, True),
+    "menu_start": (COMMANDS["start"], True),
+    "menu_wallets": (COMMANDS["wallets"], True),
+    "menu_categories": (COMMANDS["categories"], True),
+    "menu_transactions": (COMMANDS["transactions"], True),
+    "menu_stats": (COMMANDS["stats"], True),
+    "menu_transactions_year": (handle_command_transactions_menu, False),
+    "menu_transactions_month": (handle_command_transactions_menu, False),
+    "action_cd": (categories.handle_delete, True),
+    "action_wd": (wallets.handle_delete, True),
+    "action_td": (transactions.handle_delete, True),
+    "page_c": (partial(handle_command_page, type_="c"), False),
+    "page_w": (partial(handle_command_page, type_="w"), False),
+    "page_t": (partial(handle_command_page, type_="t"), False),
+    "export_categories": (partial(handle_command_export, kind="categories"), False),
+    "export_wallets": (partial(handle_command_export, kind="wallets"), False),
+    "export_transactions": (
+        partial(handle_command_export, kind="transactions"),
+        False,
+    ),
+    "statement_confirm": (statements.handle_confirm, True),
+    "statement_cancel": (statements.handle_cancel, True),
+}
 
 
 def register_callback_handler(client, session_maker):
 
     @client.on(events.CallbackQuery)
     async def callback_handler(event):
-        data = event.data.decode("utf-8")
+        """Queue the callback after earlier events of the sender."""
+
+        async def notify_dropped():
+            snapshot = user_cache.peek(event.sender_id)
+            _ = get_translator(snapshot and snapshot["language"])
+            await outbox.answer(event, _("too_many_requests_error"))
+
+        # the user moved on, charts they are waiting for are not needed
+        render_pool.cancel(event.sender_id)
+
+        await dispatcher.dispatch(
+            event.sender_id, lambda: handle_callback(event), on_shed=notify_dropped
+        )
+
+    async def handle_callback(event):
+        route, args = decode_callback(event.data)
+        handler, resets_conversation = ROUTES[route]
 
         # get the user from DB
         telegram_id = event.sender_id
         async with session_maker() as session:
-            _ = await setup_translations(telegram_id, session)
-            result = await session.execute(
-                select(User).where(User.telegram_id == telegram_id)
-            )
-            user = result.scalar_one_or_none()
+            user = await user_cache.get(session, telegram_id)
 
             # TODO: is this even possible? handle this better
             if not user:
-                await event.answer("User not found.")
+                await outbox.answer(event, "User not found.")
                 return
 
-            data = data.split("_")
-            command = data[0]
-
-            # update language based on callback data
-            if command == "lang" or command == "plang":
-                user.expectation["expect"] = {"type": None, "data": None}
-                user.expectation["transaction"] = []
-                new_language = data[1]
-                await update_user_language(event, new_language, user, session, command)
-
-            elif command == "category":
-                await handle_command_category(session, event, user, data, _)
-
-            elif command == "wallet":
-                user.expectation["expect"] = {"type": None, "data": None}
-                await session.commit()
-                await event.respond(_("wallet_creation_cancelled"))
-
-            elif command == "categoryalias":
-                await handle_command_categoryalias(session, event, user, data, _)
-
-            elif command == "walletalias":
-                await handle_command_walletalias(session, event, user, data, _)
-
-            elif command == "add":
-                user.expectation["expect"] = {"type": None, "data": None}
-                user.expectation["transaction"] = []
-                if data[1] == "wallet":
-                    await create_wallet(session, user, _, event)
-                elif data[1] == "category":
-                    await create_category(session, user, _, event)
-
-            elif command == "menu":
-                # handle transaction specific menu data which includes year/month
-                if len(data) > 2 and data[1] == "transactions":
-                    # data format: menu_transactions_year_month OR menu_transactions_year
-                    try:
-                        year = int(data[2])
-                        month = int(data[3]) if len(data) > 3 else None
-                        await transactions.send_menu(
-                            session, user, _, event, year=year, month=month
-                        )
-                        return
-                    except ValueError:
-                        pass  # Fallback to standard command handling
-
-                user.expectation["expect"] = {"type": None, "data": None}
-                user.expectation["transaction"] = []
-                await COMMANDS.get(data[1])(session, user, _, event)  # type: ignore
-
-            elif command == "action":
-                user.expectation["expect"] = {"type": None, "data": None}
-                user.expectation["transaction"] = []
-                await handle_command_action(session, event, user, data, _)
-
-            elif command == "page":
-                await handle_command_page(session, event, user, data, _)
-
-            elif command == "export":
-                await handle_command_export(session, event, user, data, _)
-
-            else:
-                raise Exception("Got unexpected callback query command")
+            _ = get_translator(user.language)
+            state = await conversations.load(session, user)
+
+            if resets_conversation:
+                state["expect"] = {"type": None, "data": None}
+                state["transaction"] = []
+
+            await handler(session, user, _, event, *args)
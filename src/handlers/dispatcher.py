@@ -0,0 +1,130 @@
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Hashable
+
+from loguru import logger
+
+# processes one event, takes no arguments
+EventJob = Callable[[], Awaitable[Any]]
+
+
+class Dispatcher:
+    """Run events of each user in order, events of different users in parallel.
+
+    Every user (key) gets a FIFO queue drained by its own task, so handlers
+    of one user never overlap. At most DISPATCH_CONCURRENCY handlers run at
+    once overall. When DISPATCH_MAX_PENDING events are queued in total, new
+    events wait for free space (backpressure); events of a user who already
+    has DISPATCH_USER_QUEUE_LIMIT events waiting are dropped (load shedding).
+    """
+
+    def __init__(self):
+        self.queues: dict[Hashable, deque[tuple[EventJob, float]]] = {}
+        self.workers: dict[Hashable, asyncio.Task] = {}
+        self.semaphore: asyncio.Semaphore | None = None
+        self.space: asyncio.Condition | None = None
+        self.max_pending = 1000
+        self.user_queue_limit = 20
+
+        self.pending = 0
+        self.running = 0
+        self.processed = 0
+        self.shed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.max_depth = 0
+
+    def start(self) -> None:
+        """Create the worker pool limits."""
+        self.semaphore = asyncio.Semaphore(int(os.getenv("DISPATCH_CONCURRENCY", "32")))
+        self.space = asyncio.Condition()
+        self.max_pending = int(os.getenv("DISPATCH_MAX_PENDING", "1000"))
+        self.user_queue_limit = int(os.getenv("DISPATCH_USER_QUEUE_LIMIT", "20"))
+
+    async def dispatch(
+        self,
+        key: Hashable,
+        job: EventJob,
+        on_shed: EventJob | None = None,
+    ) -> bool:
+        """Queue job after earlier events of key, return False if it was shed."""
+        if self.space is None:
+            raise RuntimeError("Dispatcher is not started")
+
+        queue = self.queues.get(key)
+        if queue is not None and len(queue) >= self.user_queue_limit:
+            self.shed += 1
+            logger.warning(f"Dropped event of {key}: {len(queue)} event(s) queued")
+            if on_shed is not None:
+                try:
+                    await on_shed()
+                except Exception as e:
+                    logger.error(f"Failed to notify about dropped event: {e}")
+            return False
+
+        async with self.space:
+            await self.space.wait_for(lambda: self.pending < self.max_pending)
+            self.pending += 1
+
+        # the queue may have been drained while waiting for space
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = self.queues[key] = deque()
+            self.workers[key] = asyncio.create_task(self._drain(key, queue))
+        queue.append((job, time.monotonic()))
+        self.max_depth = max(self.max_depth, len(queue))
+        return True
+
+    def metrics(self) -> dict[str, Any]:
+        """Return global counters and depth/wait of every active queue."""
+        now = time.monotonic()
+        return {
+            "pending": self.pending,
+            "running": self.running,
+            "processed": self.processed,
+            "shed": self.shed,
+            "avg_wait_ms": (
+                self.total_wait / self.processed * 1000 if self.processed else 0
+            ),
+            "max_wait_ms": self.max_wait * 1000,
+            "max_depth": self.max_depth,
+            "queues": {
+                key: {
+                    "depth": len(queue),
+                    "oldest_wait_ms": (now - queue[0][1]) * 1000 if queue else 0,
+                }
+                for key, queue in self.queues.items()
+            },
+        }
+
+    async def _drain(self, key: Hashable, queue: deque) -> None:
+        """Run queued jobs of key one by one, until the queue is empty."""
+        assert self.semaphore is not None and self.space is not None
+        try:
+            while queue:
+                job, enqueued = queue.popleft()
+                async with self.semaphore:
+                    wait = time.monotonic() - enqueued
+                    self.total_wait += wait
+                    self.max_wait = max(self.max_wait, wait)
+                    self.running += 1
+                    try:
+                        await job()
+                    except Exception:
+                        logger.exception(f"Failed to handle event of {key}")
+                    finally:
+                        self.running -= 1
+                        self.processed += 1
+
+                async with self.space:
+                    self.pending -= 1
+                    self.space.notify()
+        finally:
+            # no await since the loop ended, nothing could have been queued
+            del self.queues[key]
+            del self.workers[key]
+
+
+dispatcher = Dispatcher()
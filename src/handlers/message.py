@@ -5,19 +5,29 @@ import time
 import uuid
 from typing import Callable
 
-from sqlalchemy import delete, select
+from sqlalchemy import delete, func, select
 from sqlalchemy.ext.asyncio import AsyncSession
 from telethon import events
 from telethon.tl.custom import Button
 
 import menus.categories as categories
+import menus.statements as statements
 import menus.stats as stats
 import menus.transactions as transactions
 import menus.wallets as wallets
+from database.conversation import conversations
 from database.models import Category, User, Wallet, WalletAlias
-from handlers.transaction import create_category, register_transaction
+from database.user_cache import user_cache
+from handlers.dispatcher import dispatcher
+from handlers.transaction import (create_category, register_transaction,
+                                  register_transactions)
 from helpers.amount_formatter import format_amount
-from translate import setup_translations
+from helpers.callback_data import encode_callback
+from helpers.chart_cache import bump_data_version
+from helpers.name_index import name_indexes
+from helpers.outbox import outbox
+from helpers.render_pool import render_pool
+from translate import get_translator
 
 with open("src/assets/currency_codes.json", "r", encoding="utf-7") as f:
     currency_data = json.load(f)
@@ -28,65 +38,85 @@ with open("src/assets/currency_codes.json", "r", encoding="utf-7") as f:
 async def send_language_selection(event: events.NewMessage.Event) -> None:
     """Send language selection msg with inline buttons."""
     buttons = [
-        [Button.inline("🇬🇧 English", b"lang_en")],
+        [Button.inline("🇬🇧 English", encode_callback("lang", b"en"))],
         [
-            Button.inline("🇺🇦 Українська", b"lang_uk"),
-            Button.inline("🇷🇺 Русский", b"lang_ru"),
+            Button.inline("🇺🇦 Українська", encode_callback("lang", b"uk")),
+            Button.inline("🇷🇺 Русский", encode_callback("lang", b"ru")),
         ],
     ]
 
-    await event.respond("Welcome! Please choose your language:", buttons=buttons)
+    await outbox.respond(
+        event, "Welcome! Please choose your language:", buttons=buttons
+    )
 
 
 async def send_start_menu(session: AsyncSession, user: User, _, event) -> None:
     """Show start menu to the user."""
     MAX_WALLETS_DISPLAYED = 3
 
-    wallets = await session.execute(
-        select(Wallet).where(Wallet.holder == user.id).where(Wallet.is_deleted == False)
+    wallets_count = await session.execute(
+        select(func.count())
+        .select_from(Wallet)
+        .where(Wallet.holder == user.id, Wallet.is_deleted == False)
     )
-    wallets = wallets.scalars().all()
-    wallets = sorted(wallets, key=lambda x: x.transaction_count, reverse=True)
+    wallets_count = wallets_count.scalar_one()
 
-    if len(wallets) == 0:
-        await event.respond(_("command_start_no_wallets"))
+    if wallets_count == 0:
+        await outbox.respond(event, _("command_start_no_wallets"))
         return
 
-    wallet_info_raw = []
-    for i in range(MAX_WALLETS_DISPLAYED):
-        if len(wallets) > i:
-            wallet_info_raw.append(wallets[i])
+    wallets = await session.execute(
+        select(Wallet)
+        .where(Wallet.holder == user.id, Wallet.is_deleted == False)
+        .order_by(Wallet.transaction_count.desc(), Wallet.id)
+        .limit(MAX_WALLETS_DISPLAYED)
+    )
+    wallets = wallets.scalars().all()
 
     wallet_info = [
         _("command_start_component_wallet_info").format(
             x.name, format_amount(x.init_sum + x.current_sum), x.currency
         )
-        for x in wallet_info_raw
+        for x in wallets
     ]
 
     wallet_info_str = "\n".join(wallet_info)
 
-    if len(wallets) > MAX_WALLETS_DISPLAYED:
-        value = len(wallets) - MAX_WALLETS_DISPLAYED
+    if wallets_count > MAX_WALLETS_DISPLAYED:
+        value = wallets_count - MAX_WALLETS_DISPLAYED
         component = _("universal_component_not_shown_count")
         wallet_info_str += "\n" + component.format(value)
 
     buttons = [
         [
-            Button.inline(_("command_start_button_add_wallet"), b"add_wallet"),
-            Button.inline(_("command_start_button_add_category"), b"add_category"),
+            Button.inline(
+                _("command_start_button_add_wallet"), encode_callback("add_wallet")
+            ),
+            Button.inline(
+                _("command_start_button_add_category"), encode_callback("add_category")
+            ),
         ],
         [
-            Button.inline(_("command_start_button_wallets"), b"menu_wallets"),
-            Button.inline(_("command_start_button_categories"), b"menu_categories"),
+            Button.inline(
+                _("command_start_button_wallets"), encode_callback("menu_wallets")
+            ),
+            Button.inline(
+                _("command_start_button_categories"), encode_callback("menu_categories")
+            ),
         ],
         [
-            Button.inline(_("command_start_button_transactions"), b"menu_transactions"),
-            Button.inline(_("command_start_button_stats"), b"menu_stats"),
+            Button.inline(
+                _("command_start_button_transactions"),
+                encode_callback("menu_transactions"),
+            ),
+            Button.inline(
+                _("command_start_button_stats"), encode_callback("menu_stats")
+            ),
         ],
     ]
 
-    await event.respond(
+    await outbox.respond(
+        event,
         _("command_start_template").format(wallet_info_str),
         buttons=buttons,
         link_preview=False,
@@ -149,8 +179,10 @@ async def handle_command_start(session: AsyncSession, user: User, _, event) -> N
 
 async def handle_command_help(session: AsyncSession, user: User, _, event) -> None:
     """Handle /help command"""
-    buttons = [Button.inline(_("back_to_main_menu_button"), b"menu_start")]
-    await event.respond(_("command_help"), buttons=buttons)
+    buttons = [
+        Button.inline(_("back_to_main_menu_button"), encode_callback("menu_start"))
+    ]
+    await outbox.respond(event, _("command_help"), buttons=buttons)
 
 
 async def handle_command_wallets(session: AsyncSession, user: User, _, event) -> None:
@@ -180,14 +212,14 @@ async def handle_command_stats(session: AsyncSession, user: User, _, event) -> N
 async def handle_command_language(session: AsyncSession, user: User, _, event) -> None:
     """Handle /language command"""
     buttons = [
-        [Button.inline("🇬🇧 English", b"plang_en")],
+        [Button.inline("🇬🇧 English", encode_callback("plang", b"en"))],
         [
-            Button.inline("🇺🇦 Українська", b"plang_uk"),
-            Button.inline("🇷🇺 Русский", b"plang_ru"),
+            Button.inline("🇺🇦 Українська", encode_callback("plang", b"uk")),
+            Button.inline("🇷🇺 Русский", encode_callback("plang", b"ru")),
         ],
     ]
 
-    await event.respond("Choose a new language:", buttons=buttons)
+    await outbox.respond(event, "Choose a new language:", buttons=buttons)
 
 
 # TODO: make support username it optional
@@ -195,10 +227,11 @@ async def handle_unknown_command(session: AsyncSession, user: User, _, event) ->
     """Handle unknown commands"""
     command = event.raw_text.split()[0]
 
-    await event.respond(
+    await outbox.respond(
+        event,
         _("unknown_command").format(
             command, "@" + os.getenv("SUPPORT_USERNAME", "[not specified]")
-        )
+        ),
     )
 
 
@@ -225,16 +258,30 @@ async def handle_command(session: AsyncSession, user: User, _, event):
     await handler(session, user, _, event)
 
 
+def is_csv_document(event) -> bool:
+    """Check if the message carries a csv file, like exported transactions."""
+    file = event.file
+    if file is None:
+        return False
+    return file.mime_type == "text/csv" or (file.name or "").lower().endswith(".csv")
+
+
 async def handle_transaction(session: AsyncSession, user: User, _, event):
     """Handle transaction from User (msg not starting with "/")."""
     raw_text = event.raw_text
     if raw_text == "":
-        await event.respond(_("got_empty_message_for_transaction"))
+        await outbox.respond(event, _("got_empty_message_for_transaction"))
+        return
+
+    # bulk mode: one transaction per line
+    lines = [line for line in raw_text.splitlines() if line.strip()]
+    if len(lines) > 1:
+        await register_transactions(session, user, _, event, lines)
         return
 
     parts = event.raw_text.split()
     if len(parts) < 3:
-        await event.respond(_("info_omitted_for_transaction_error"))
+        await outbox.respond(event, _("info_omitted_for_transaction_error"))
         return
 
     raw_sum, category, wallet = parts[:3]
@@ -246,14 +293,14 @@ async def handle_transaction(session: AsyncSession, user: User, _, event):
     try:
         sum = float(raw_sum.replace(",", "."))
     except ValueError:
-        await event.respond(_("non_numerical_sum_error"))
+        await outbox.respond(event, _("non_numerical_sum_error"))
         return
 
     # checking this after checking for numerical value (and
     #  not before!) allows
     #  for more clear errors
     if raw_sum[0] not in "+-":
-        await event.respond(_("no_sign_specified_for_sum"))
+        await outbox.respond(event, _("no_sign_specified_for_sum"))
         return
 
     await register_transaction(session, user, _, event, [sum, category, wallet])
@@ -263,6 +310,7 @@ async def register_new_wallet(
     session: AsyncSession, event, user: User, data: list, _
 ) -> None:
     """Register new wallet after all the data has been verified."""
+    state = conversations.get(user.id)
     new_wallet = Wallet(
         id=uuid.uuid4().bytes,
         holder=user.id,
@@ -282,43 +330,44 @@ async def register_new_wallet(
         )
     )
 
+    state["expect"] = {"type": None, "data": None}
+    bump_data_version(user)
     await session.commit()
-    await session.refresh(new_wallet)
+    name_indexes.invalidate(user.id)
 
-    await event.respond(_("wallet_created_successfully").format(data[0]))
+    await outbox.respond(event, _("wallet_created_successfully").format(data[0]))
 
-    user.expectation["expect"] = {"type": None, "data": None}
-    await session.commit()
-
-    current_transaction = user.expectation["transaction"]
+    current_transaction = state["transaction"]
     if current_transaction is not None:
-        await event.respond(
+        await outbox.respond(
+            event,
             _("transaction_handling_in_process").format(
                 " ".join(map(str, current_transaction))
-            )
+            ),
         )
         await register_transaction(session, user, _, event, current_transaction)
 
 
 async def handle_expectation_new_wallet(session: AsyncSession, user: User, _, event):
     """Handle new_wallet expectation."""
+    state = conversations.get(user.id)
     raw_text = event.raw_text
 
     if raw_text == "":
-        await event.respond(_("got_empty_message_for_wallet"))
+        await outbox.respond(event, _("got_empty_message_for_wallet"))
         return
 
     parts = raw_text.split()
     currency = parts[0] if len(parts) > 0 else "eur"
     init_sum = parts[1] if len(parts) > 1 else "0"
-    name = parts[2] if len(parts) > 2 else user.expectation["expect"]["data"]
+    name = parts[2] if len(parts) > 2 else state["expect"]["data"]
 
     if name is None:
-        await event.respond(_("unspecified_wallet_name_error"))
+        await outbox.respond(event, _("unspecified_wallet_name_error"))
         return
 
     if currency.upper() not in ALLOWED_CURRENCIES:
-        await event.respond(_("unsupported_currency_error").format(currency))
+        await outbox.respond(event, _("unsupported_currency_error").format(currency))
         return
 
     currency = currency.upper()
@@ -326,7 +375,7 @@ async def handle_expectation_new_wallet(session: AsyncSession, user: User, _, ev
     try:
         init_sum = float(init_sum.replace(",", "."))
     except ValueError:
-        await event.respond(_("non_numerical_init_sum_error"))
+        await outbox.respond(event, _("non_numerical_init_sum_error"))
         return
 
     # name uniqueness check
@@ -338,7 +387,7 @@ async def handle_expectation_new_wallet(session: AsyncSession, user: User, _, ev
     )
     wallets = wallets.scalars().all()
     if len(wallets) != 0:
-        await event.respond(_("non_unique_wallet_name_error"))
+        await outbox.respond(event, _("non_unique_wallet_name_error"))
         return
 
     data = [name, currency, init_sum]
@@ -351,10 +400,10 @@ async def handle_expectation_new_category(session: AsyncSession, user: User, _,
     raw_text = event.raw_text
 
     if raw_text == "":
-        await event.respond(_("got_empty_message_for_category"))
+        await outbox.respond(event, _("got_empty_message_for_category"))
         return
     if " " in raw_text or "\n" in raw_text:
-        await event.respond(_("mutiple_word_category_name_error"))
+        await outbox.respond(event, _("mutiple_word_category_name_error"))
         return
 
     # name uniqueness check
@@ -366,7 +415,7 @@ async def handle_expectation_new_category(session: AsyncSession, user: User, _,
     )
     categories = categories.scalars().all()
     if len(categories) != 0:
-        await event.respond(_("non_unique_category_name_error"))
+        await outbox.respond(event, _("non_unique_category_name_error"))
         return
 
     await create_category(session, user, _, event, raw_text)
@@ -374,21 +423,22 @@ async def handle_expectation_new_category(session: AsyncSession, user: User, _,
 
 async def handle_expectation_page(session: AsyncSession, user: User, _, event):
     """Handle page expectation."""
+    state = conversations.get(user.id)
     # data is now a list: [type, msg_id, year(opt), month(opt)]
-    data_list = user.expectation["expect"]["data"]
+    data_list = state["expect"]["data"]
     type_ = data_list[0]
     msg_id = data_list[1]
 
     raw_text = event.raw_text
 
     if raw_text == "":
-        await event.respond(_("got_empty_message_for_page_number"))
+        await outbox.respond(event, _("got_empty_message_for_page_number"))
         return
 
     try:
         page = int(raw_text)
     except ValueError:
-        await event.respond(_("non_numerical_page_number_error"))
+        await outbox.respond(event, _("non_numerical_page_number_error"))
         return
 
     if type_ == "c":
@@ -406,18 +456,18 @@ async def handle_expectation_page(session: AsyncSession, user: User, _, event):
             session, user, _, event, page, msg_id, year=year, month=month
         )
 
-    user.expectation["expect"] = {"type": None, "data": None}
-    await session.commit()
-    await event.client.send_message(
-        entity=event.chat_id,
+    state["expect"] = {"type": None, "data": None}
+    await outbox.send_message(
+        event,
+        _("beamed_to_page_successfully").format(str(page)),
         reply_to=msg_id,
-        message=_("beamed_to_page_successfully").format(str(page)),
     )
 
 
 async def handle_expectation(session: AsyncSession, user: User, _, event):
     """Handle bot flow if data is expected from user."""
-    expect = user.expectation["expect"]
+    state = conversations.get(user.id)
+    expect = state["expect"]
 
     if expect["type"] == "new_category":
         await handle_expectation_new_category(session, user, _, event)
@@ -426,12 +476,16 @@ async def handle_expectation(session: AsyncSession, user: User, _, event):
         await handle_expectation_new_wallet(session, user, _, event)
 
     elif expect["type"] == "new_category_alias":
-        prompt = user.expectation["message"]
-        await event.respond(_("unexpected_msg_on_alias_prompt"), reply_to=prompt)
+        prompt = state["message"]
+        await outbox.respond(
+            event, _("unexpected_msg_on_alias_prompt"), reply_to=prompt
+        )
 
     elif expect["type"] == "new_wallet_alias":
-        prompt = user.expectation["message"]
-        await event.respond(_("unexpected_msg_on_alias_prompt"), reply_to=prompt)
+        prompt = state["message"]
+        await outbox.respond(
+            event, _("unexpected_msg_on_alias_prompt"), reply_to=prompt
+        )
 
     elif expect["type"] == "edit_category":
         await categories.handle_expectation_edit_category(session, user, _, event)
@@ -458,16 +512,26 @@ def register_message_handler(client, session_maker):
 
     @client.on(events.NewMessage)
     async def new_msg_handler(event) -> None:
+        """Queue the message after earlier events of the sender."""
+
+        async def notify_dropped():
+            snapshot = user_cache.peek(event.sender_id)
+            _ = get_translator(snapshot and snapshot["language"])
+            await outbox.respond(event, _("too_many_requests_error"))
+
+        # the user moved on, charts they are waiting for are not needed
+        render_pool.cancel(event.sender_id)
+
+        await dispatcher.dispatch(
+            event.sender_id, lambda: handle_new_msg(event), on_shed=notify_dropped
+        )
+
+    async def handle_new_msg(event) -> None:
         """Check if user is known, handle new message."""
         telegram_id = event.sender_id
 
         async with session_maker() as session:
-            _ = await setup_translations(telegram_id, session)
-
-            result = await session.execute(
-                select(User).where(User.telegram_id == telegram_id)
-            )
-            user = result.scalar_one_or_none()
+            user = await user_cache.get(session, telegram_id)
 
             if not user:
                 user = User(
@@ -476,11 +540,6 @@ def register_message_handler(client, session_maker):
                     registered_at=int(time.time()),
                     language=None,
                     is_banned=False,
-                    expectation={
-                        "transaction": [],
-                        "expect": {"type": None, "data": None},
-                        "message": None,
-                    },
                 )
                 session.add(user)
                 await session.commit()
@@ -489,14 +548,24 @@ def register_message_handler(client, session_maker):
                 await send_language_selection(event)
                 return
 
+            _ = get_translator(user.language)
+            state = await conversations.load(session, user)
+
+            if is_csv_document(event):
+                # bank statements come with the name of their wallet
+                if event.raw_text.strip():
+                    await statements.import_statement(session, user, _, event)
+                else:
+                    await transactions.import_csv(session, user, _, event)
+                return
+
             if event.raw_text.startswith("/"):
-                user.expectation["expect"] = {"type": None, "data": None}
-                user.expectation["transaction"] = []
-                await session.commit()
+                state["expect"] = {"type": None, "data": None}
+                state["transaction"] = []
                 await handle_command(session, user, _, event)
                 return
 
-            if user.expectation["expect"]["type"] is None:
+            if state["expect"]["type"] is None:
                 await handle_transaction(session, user, _, event)
                 return
 
@@ -1,186 +1,149 @@
 import time
+from collections import Counter, defaultdict
 
-from sqlalchemy import select
+from sqlalchemy import update
 from sqlalchemy.ext.asyncio import AsyncSession
 from telethon.tl.custom import Button
-from thefuzz import process
 
-from database.models import (Category, CategoryAlias, Transaction,
-                             TransactionType, User, Wallet, WalletAlias)
+from database.coalescer import write_coalescer
+from database.conversation import conversations
+from database.models import (Category, Transaction, TransactionType, User,
+                             Wallet)
 from helpers.amount_formatter import format_amount
+from helpers.callback_data import encode_callback
+from helpers.chart_cache import bump_data_version
+from helpers.name_index import name_indexes
+from helpers.outbox import outbox
 
 
-async def find_category_by_name(
-    session: AsyncSession,
-    user: User,
-    input_name: str,
-    threshold: int = 75,
-    # ) -> tuple[str, Optional[bytes]]:
-):
-    """Find category UUID for a user by fuzzy match or alias name."""
-
-    # check aliases for exact match
-    result = await session.execute(
-        select(CategoryAlias)
-        .where(CategoryAlias.holder == user.id)
-        .where(CategoryAlias.alias == input_name.lower())
-    )
-    alias = result.scalar_one_or_none()
-    if alias:
-        return ("exact", alias.category)
-
-    # get all categories
-    result = await session.execute(
-        select(Category)
-        .where(Category.holder == user.id)
-        .where(Category.is_deleted.is_(False))
-    )
-    categories = result.scalars().all()
-
-    if not categories:
-        return ("none",)
-
-    # fuzzy match category names
-    choices = {category.name: category.id for category in categories}
-    match = process.extractOne(input_name.lower(), choices.keys())
-
-    if match and match[1] >= threshold:
-        if match[1] == 100:
-            return ("exact", choices[match[0]])
-        return ("fuzzy", choices[match[0]])
-
-    return ("none",)
-
-
-async def find_wallet_by_name(
-    session: AsyncSession, user: User, input_name: str, threshold: int = 75
+async def resolve_names(
+    session: AsyncSession, user: User, category_name: str, wallet_name: str
 ):
-    """Find wallet UUID for a user by alias or fuzzy name match."""
-
-    # check aliases for exact match
-    result = await session.execute(
-        select(WalletAlias)
-        .where(WalletAlias.holder == user.id)
-        .where(WalletAlias.alias == input_name.lower())
-    )
-    alias = result.scalar_one_or_none()
-    if alias:
-        return ("exact", alias.wallet)
-
-    # get all wallets
-    result = await session.execute(
-        select(Wallet)
-        .where(Wallet.holder == user.id)
-        .where(Wallet.is_deleted.is_(False))
-    )
-    wallets = result.scalars().all()
+    """Find category and wallet for a transaction in the user name index.
 
-    if not wallets:
-        return ("none",)
-
-    # fuzzy match wallet names
-    choices = {wallet.name: wallet.id for wallet in wallets}
-    match = process.extractOne(input_name.lower(), choices.keys())
-
-    if match and match[1] >= threshold:
-        if match[1] == 100:
-            return ("exact", choices[match[0]])
-        return ("fuzzy", choices[match[0]])
-
-    return ("none",)
+    Returns a ("exact" | "fuzzy", uuid, name) or ("none",) tuple for both.
+    """
+    categories, wallets = await name_indexes.get(session, user.id)
+    return categories.match(category_name), wallets.match(wallet_name)
 
 
 async def create_category(
     session: AsyncSession, user: User, _, event, name: str | None = None
 ) -> None:
     """Prompt user for creation of a new category."""
-    user.expectation["expect"] = {"type": "new_category", "data": name}
-    await session.commit()
+    state = conversations.get(user.id)
+    state["expect"] = {"type": "new_category", "data": name}
 
     if name is None:
-        buttons = [Button.inline(_("create_prompt_cancel"), b"category_cancel")]
-        await event.respond(_("create_new_unnamed_category_prompt"), buttons=buttons)
+        buttons = [
+            Button.inline(_("create_prompt_cancel"), encode_callback("category_cancel"))
+        ]
+        await outbox.respond(
+            event, _("create_new_unnamed_category_prompt"), buttons=buttons
+        )
         return
 
     buttons = [
-        Button.inline(_("create_prompt_approve"), b"category_approve"),
-        Button.inline(_("create_prompt_cancel"), b"category_cancel"),
+        Button.inline(_("create_prompt_approve"), encode_callback("category_approve")),
+        Button.inline(_("create_prompt_cancel"), encode_callback("category_cancel")),
     ]
-    await event.respond(_("create_new_category_prompt").format(name), buttons=buttons)
+    await outbox.respond(
+        event, _("create_new_category_prompt").format(name), buttons=buttons
+    )
 
 
 async def create_wallet(
     session: AsyncSession, user: User, _, event, name: str | None = None
 ) -> None:
     """Prompt user for creation of a new wallet."""
-    user.expectation["expect"] = {"type": "new_wallet", "data": name}
-    await session.commit()
+    state = conversations.get(user.id)
+    state["expect"] = {"type": "new_wallet", "data": name}
 
-    buttons = [Button.inline(_("create_prompt_cancel"), b"wallet_cancel")]
+    buttons = [
+        Button.inline(_("create_prompt_cancel"), encode_callback("wallet_cancel"))
+    ]
 
     if name is None:
-        await event.respond(_("create_new_unnamed_wallet_prompt"), buttons=buttons)
+        await outbox.respond(
+            event, _("create_new_unnamed_wallet_prompt"), buttons=buttons
+        )
         return
 
-    await event.respond(_("create_new_wallet_prompt").format(name), buttons=buttons)
+    await outbox.respond(
+        event, _("create_new_wallet_prompt").format(name), buttons=buttons
+    )
 
 
 async def create_category_alias(
-    session: AsyncSession, user: User, _, event, name: str, prediction_id
+    session: AsyncSession,
+    user: User,
+    _,
+    event,
+    name: str,
+    prediction_id: bytes,
+    prediction_name: str,
 ) -> None:
     """Prompt user about the correctness of fuzzy match for category name."""
-    result = await session.execute(
-        select(Category.name).where(Category.id == prediction_id)
-    )
-    prediction_name = result.scalar_one_or_none()
-
-    user.expectation["expect"] = {
+    state = conversations.get(user.id)
+    state["expect"] = {
         "type": "new_category_alias",
         "data": [name, prediction_id.hex(), prediction_name],
     }
 
     buttons = [
-        Button.inline(_("create_alias_prompt_approve"), b"categoryalias_approve"),
-        Button.inline(_("create_alias_prompt_new"), b"categoryalias_new"),
-        Button.inline(_("create_alias_prompt_cancel"), b"categoryalias_cancel"),
+        Button.inline(
+            _("create_alias_prompt_approve"), encode_callback("categoryalias_approve")
+        ),
+        Button.inline(
+            _("create_alias_prompt_new"), encode_callback("categoryalias_new")
+        ),
+        Button.inline(
+            _("create_alias_prompt_cancel"), encode_callback("categoryalias_cancel")
+        ),
     ]
 
-    prompt = await event.respond(
+    prompt = await outbox.respond(
+        event,
         _("create_new_category_alias_prompt").format(name, prediction_name),
         buttons=buttons,
     )
 
-    user.expectation["message"] = prompt.id
-    await session.commit()
+    state["message"] = prompt.id
 
 
 async def create_wallet_alias(
-    session: AsyncSession, user: User, _, event, name: str, prediction_id
+    session: AsyncSession,
+    user: User,
+    _,
+    event,
+    name: str,
+    prediction_id: bytes,
+    prediction_name: str,
 ) -> None:
     """Prompt user about the correctness of fuzzy match for wallet name."""
-    result = await session.execute(
-        select(Wallet.name).where(Wallet.id == prediction_id)
-    )
-    prediction_name = result.scalar_one_or_none()
-
-    user.expectation["expect"] = {
+    state = conversations.get(user.id)
+    state["expect"] = {
         "type": "new_wallet_alias",
         "data": [name, prediction_id.hex(), prediction_name],
     }
 
     buttons = [
-        Button.inline(_("create_alias_prompt_approve"), b"walletalias_approve"),
-        Button.inline(_("create_alias_prompt_new"), b"walletalias_new"),
-        Button.inline(_("create_alias_prompt_cancel"), b"walletalias_cancel"),
+        Button.inline(
+            _("create_alias_prompt_approve"), encode_callback("walletalias_approve")
+        ),
+        Button.inline(_("create_alias_prompt_new"), encode_callback("walletalias_new")),
+        Button.inline(
+            _("create_alias_prompt_cancel"), encode_callback("walletalias_cancel")
+        ),
     ]
 
-    prompt = await event.respond(
+    prompt = await outbox.respond(
+        event,
         _("create_new_wallet_alias_prompt").format(name, prediction_name),
         buttons=buttons,
     )
 
-    user.expectation["message"] = prompt.id
-    await session.commit()
+    state["message"] = prompt.id
 
 
 async def register_transaction(
@@ -193,76 +156,97 @@ async def register_transaction(
     custom_datetime=None,
 ) -> bool:
     """Register transaction in the db, handle creating new category/wallet."""
+    state = conversations.get(user.id)
     amount, category, wallet = data
 
-    category_id = await find_category_by_name(session, user, category)
-    wallet_id = await find_wallet_by_name(session, user, wallet)
+    category_id, wallet_id = await resolve_names(session, user, category, wallet)
 
     # ask about possible typos
     if category_id[0] == "fuzzy":
-        user.expectation["transaction"] = data
-        await session.commit()
-        await create_category_alias(session, user, _, event, category, category_id[1])
+        state["transaction"] = data
+        await create_category_alias(
+            session, user, _, event, category, category_id[1], category_id[2]
+        )
         return False
     if wallet_id[0] == "fuzzy":
-        user.expectation["transaction"] = data
-        await session.commit()
-        await create_wallet_alias(session, user, _, event, wallet, wallet_id[1])
+        state["transaction"] = data
+        await create_wallet_alias(
+            session, user, _, event, wallet, wallet_id[1], wallet_id[2]
+        )
         return False
 
     # create category/wallet if neccesarry
     if category_id[0] == "none":
-        user.expectation["transaction"] = data
-        await session.commit()
+        state["transaction"] = data
         await create_category(session, user, _, event, category)
         return False
     if wallet_id[0] == "none":
-        user.expectation["transaction"] = data
-        await session.commit()
+        state["transaction"] = data
         await create_wallet(session, user, _, event, wallet)
         return False
 
-    new_transaction = Transaction(
-        holder=user.id,
-        datetime=custom_datetime if custom_datetime else int(time.time()),
-        type=TransactionType.INCOME,
-        wallet_id=wallet_id[1],
-        category_id=category_id[1],
-        sum=amount,
-    )
+    # don't hold the writer connection while waiting for the batch
+    await session.commit()
 
-    wallet = await session.execute(select(Wallet).where(Wallet.id == wallet_id[1]))
-    wallet = wallet.scalar_one_or_none()
+    async def write(batch_session: AsyncSession):
+        batch_session.add(
+            Transaction(
+                holder=user.id,
+                datetime=custom_datetime if custom_datetime else int(time.time()),
+                type=TransactionType.INCOME,
+                wallet_id=wallet_id[1],
+                category_id=category_id[1],
+                sum=amount,
+            )
+        )
 
-    if wallet:
-        wallet.current_sum += amount
-        wallet.transaction_count += 1
+        wallet = await batch_session.execute(
+            update(Wallet)
+            .where(Wallet.id == wallet_id[1])
+            .values(
+                current_sum=Wallet.current_sum + amount,
+                transaction_count=Wallet.transaction_count + 1,
+            )
+            .returning(
+                Wallet.name, Wallet.currency, Wallet.init_sum + Wallet.current_sum
+            )
+            .execution_options(synchronize_session=False)
+        )
 
-    category = await session.execute(
-        select(Category).where(Category.id == category_id[1])
-    )
-    category = category.scalar_one_or_none()
+        category = await batch_session.execute(
+            update(Category)
+            .where(Category.id == category_id[1])
+            .values(transaction_count=Category.transaction_count + 1)
+            .returning(Category.name)
+            .execution_options(synchronize_session=False)
+        )
 
-    if category:
-        category.transaction_count += 1
+        return wallet.one(), category.scalar_one()
 
-    session.add_all([new_transaction, wallet, category])
+    wallet, category_name = await write_coalescer.submit(write)
+    # only once the write is committed, or a chart drawn meanwhile would be
+    #  cached under the new version
+    bump_data_version(user)
     await session.commit()
-
-    wallet_total = wallet.init_sum + wallet.current_sum
+    wallet_name, wallet_currency, wallet_total = wallet
 
     if is_editing:
-        buttons = [Button.inline(_("universal_back_button"), b"menu_transactions")]
-        await event.reply(
+        buttons = [
+            Button.inline(
+                _("universal_back_button"), encode_callback("menu_transactions")
+            )
+        ]
+        await outbox.reply(
+            event,
             _("transaction_edited").format(
                 *map(
                     str,
                     [
                         format_amount(amount),
-                        category.name,
-                        wallet.name,
+                        category_name,
+                        wallet_name,
                         format_amount(wallet_total),
-                        wallet.currency,
+                        wallet_currency,
                     ],
                 )
             ),
@@ -270,18 +254,150 @@ async def register_transaction(
         )
         return True
 
-    await event.reply(
+    await outbox.reply(
+        event,
         _("transaction_registered").format(
             *map(
                 str,
                 [
                     format_amount(amount),
-                    category.name,
-                    wallet.name,
+                    category_name,
+                    wallet_name,
                     format_amount(wallet_total),
-                    wallet.currency,
+                    wallet_currency,
                 ],
             )
+        ),
+    )
+    return True
+
+
+async def register_transactions(
+    session: AsyncSession, user: User, _, event, lines: list[str]
+) -> bool:
+    """Register one transaction per line in a single commit.
+
+    Names must match exactly; if any line can't be registered, nothing is
+    and all problems are reported at once.
+    """
+    categories, wallets = await name_indexes.get(session, user.id)
+
+    rows = []  # (amount, category match, wallet match)
+    errors = []
+    for number, line in enumerate(lines, start=1):
+        parts = line.split()
+        if len(parts) < 3:
+            errors.append(_("bulk_error_incomplete_line").format(number))
+            continue
+
+        raw_sum, category, wallet = parts[:3]
+        try:
+            amount = float(raw_sum.replace(",", "."))
+        except ValueError:
+            amount = None
+        if amount is None or raw_sum[0] not in "+-":
+            errors.append(_("bulk_error_invalid_sum").format(number, raw_sum))
+            continue
+
+        category_id = categories.match(category)
+        wallet_id = wallets.match(wallet)
+
+        if category_id[0] == "fuzzy":
+            errors.append(
+                _("bulk_error_fuzzy_category").format(number, category, category_id[2])
+            )
+        elif category_id[0] == "none":
+            errors.append(_("bulk_error_unknown_category").format(number, category))
+        if wallet_id[0] == "fuzzy":
+            errors.append(
+                _("bulk_error_fuzzy_wallet").format(number, wallet, wallet_id[2])
+            )
+        elif wallet_id[0] == "none":
+            errors.append(_("bulk_error_unknown_wallet").format(number, wallet))
+
+        rows.append((amount, category_id, wallet_id))
+
+    if errors:
+        await outbox.reply(
+            event, _("bulk_transactions_rejected").format("\n".join(errors))
+        )
+        return False
+
+    # don't hold the writer connection while waiting for the batch
+    await session.commit()
+
+    timestamp = int(time.time())
+    wallet_sums: defaultdict[bytes, float] = defaultdict(float)
+    wallet_counts: Counter[bytes] = Counter()
+    category_counts: Counter[bytes] = Counter()
+    for amount, category_id, wallet_id in rows:
+        wallet_sums[wallet_id[1]] += amount
+        wallet_counts[wallet_id[1]] += 1
+        category_counts[category_id[1]] += 1
+
+    async def write(batch_session: AsyncSession):
+        batch_session.add_all(
+            [
+                Transaction(
+                    holder=user.id,
+                    datetime=timestamp,
+                    type=TransactionType.INCOME,
+                    wallet_id=wallet_id[1],
+                    category_id=category_id[1],
+                    sum=amount,
+                )
+                for amount, category_id, wallet_id in rows
+            ]
+        )
+
+        # one update per wallet and category, however many lines use them
+        balances = {}
+        for uuid, total in wallet_sums.items():
+            result = await batch_session.execute(
+                update(Wallet)
+                .where(Wallet.id == uuid)
+                .values(
+                    current_sum=Wallet.current_sum + total,
+                    transaction_count=Wallet.transaction_count + wallet_counts[uuid],
+                )
+                .returning(
+                    Wallet.name, Wallet.currency, Wallet.init_sum + Wallet.current_sum
+                )
+                .execution_options(synchronize_session=False)
+            )
+            balances[uuid] = result.one()
+
+        for uuid, count in category_counts.items():
+            await batch_session.execute(
+                update(Category)
+                .where(Category.id == uuid)
+                .values(transaction_count=Category.transaction_count + count)
+                .execution_options(synchronize_session=False)
+            )
+
+        return balances
+
+    balances = await write_coalescer.submit(write)
+    bump_data_version(user)
+    await session.commit()
+
+    transaction_info = [
+        _("bulk_component_transaction").format(
+            format_amount(amount),
+            balances[wallet_id[1]][1],
+            category_id[2],
+            wallet_id[2],
         )
+        for amount, category_id, wallet_id in rows
+    ]
+    balance_info = [
+        _("bulk_component_wallet_balance").format(name, format_amount(total), currency)
+        for name, currency, total in balances.values()
+    ]
+    await outbox.reply(
+        event,
+        _("bulk_transactions_registered").format(
+            len(rows), "\n".join(transaction_info), "\n".join(balance_info)
+        ),
     )
     return True
@@ -0,0 +1,115 @@
+import struct
+
+# Telegram rejects inline buttons with longer callback data
+MAX_CALLBACK_DATA_SIZE = 64
+# bumped whenever an existing route changes its fields
+VERSION = 1
+# first byte of binary payloads; legacy text payloads are ASCII, so they
+#  never start with a byte above 0x7f
+MARKER = 0x80 | VERSION
+
+# route -> (code, struct format of its arguments); codes are stored in
+#  buttons of already sent messages, so they must never be reused
+FORMATS: dict[str, tuple[int, str]] = {
+    "none": (0, ""),
+    "lang": (1, "2s"),  # language code
+    "plang": (2, "2s"),
+    "category_approve": (3, ""),
+    "category_cancel": (4, ""),
+    "wallet_cancel": (5, ""),
+    "categoryalias_approve": (6, ""),
+    "categoryalias_new": (7, ""),
+    "categoryalias_cancel": (8, ""),
+    "walletalias_approve": (9, ""),
+    "walletalias_new": (10, ""),
+    "walletalias_cancel": (11, ""),
+    "add_wallet": (12, ""),
+    "add_category": (13, ""),
+    "menu_start": (14, ""),
+    "menu_wallets": (15, ""),
+    "menu_categories": (16, ""),
+    "menu_transactions": (17, ""),
+    "menu_stats": (18, ""),
+    "menu_transactions_year": (19, "H"),  # year
+    "menu_transactions_month": (20, "HB"),  # year, month
+    "action_cd": (21, "16s"),  # category uuid
+    "action_wd": (22, "16s"),  # wallet uuid
+    "action_td": (23, "16s"),  # transaction uuid
+    "page_c": (24, "H"),  # page (0 asks for a page number)
+    "page_w": (25, "H"),
+    "page_t": (26, "HHB"),  # page, year, month
+    "export_categories": (27, ""),
+    "export_wallets": (28, ""),
+    "export_transactions": (29, ""),
+    "statement_confirm": (30, ""),
+    "statement_cancel": (31, ""),
+}
+
+_STRUCTS = {
+    name: struct.Struct(">BB" + fields) for name, (_, fields) in FORMATS.items()
+}
+_BY_CODE = {code: name for name, (code, _) in FORMATS.items()}
+
+
+def encode_callback(route: str, *args) -> bytes:
+    """Pack route and its arguments into inline button callback data."""
+    data = _STRUCTS[route].pack(MARKER, FORMATS[route][0], *args)
+    if len(data) > MAX_CALLBACK_DATA_SIZE:
+        raise ValueError(
+            f"Callback data of {route} is {len(data)} bytes long, "
+            f"at most {MAX_CALLBACK_DATA_SIZE} are allowed"
+        )
+    return data
+
+
+def decode_callback(data: bytes) -> tuple[str, tuple]:
+    """Return route and arguments of callback data, binary or legacy."""
+    if not data or data[0] < 0x80:
+        route, args = _decode_legacy(data.decode("utf-8"))
+        if route not in FORMATS:
+            raise ValueError(f"Got unexpected callback data: {data!r}")
+        return route, args
+
+    if data[0] != MARKER:
+        raise ValueError(f"Unsupported callback data version: {data[0] & 0x7F}")
+
+    route = _BY_CODE.get(data[1]) if len(data) > 1 else None
+    if route is None:
+        raise ValueError(f"Got unexpected callback data: {data!r}")
+    return route, _STRUCTS[route].unpack(data)[2:]
+
+
+def _decode_legacy(text: str) -> tuple[str, tuple]:
+    """Parse "_"-separated callback data of buttons sent by older versions."""
+    if text in FORMATS and not FORMATS[text][1]:
+        return text, ()
+
+    def number(value: str) -> int:
+        return int(value) if value.isdigit() else 0
+
+    data = text.split("_")
+    command = data[0]
+
+    if command in ("lang", "plang") and len(data) == 2:
+        return command, (data[1].encode(),)
+
+    if command == "menu" and data[1:2] == ["transactions"]:
+        # menu_transactions_year OR menu_transactions_year_month
+        if len(data) == 3:
+            return "menu_transactions_year", (int(data[2]),)
+        return "menu_transactions_month", (int(data[2]), int(data[3]))
+
+    if command == "action" and len(data) == 3:
+        return f"action_{data[1]}", (bytes.fromhex(data[2]),)
+
+    if command == "page" and len(data) >= 3:
+        # page_TYPE_HEX(MSGID)[_PAGE[_YEAR_MONTH]], "beam" asks for a page;
+        #  MSGID is always the message of the button, so it's not needed
+        page = number(data[3]) if len(data) > 3 else 0
+        if data[1] == "t":
+            year = number(data[4]) if len(data) > 4 else 0
+            month = number(data[5]) if len(data) > 5 else 0
+            return "page_t", (page, year, month)
+        return f"page_{data[1]}", (page,)
+
+    raise ValueError(f"Got unexpected callback data: {text!r}")
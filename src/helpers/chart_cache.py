@@ -0,0 +1,111 @@
+import datetime
+import os
+from collections import OrderedDict
+from typing import Any, Hashable
+
+from database.models import User
+
+
+def bump_data_version(user: User) -> None:
+    """Mark data of user as changed, written by the next commit of its session.
+
+    Must be called by everything that changes what charts show: transactions,
+    wallets and categories. Cached charts of older versions are never used
+    again and age out of the cache.
+    """
+    user.data_version += 1
+
+
+def chart_key(user: User, chart: str, profile: str) -> Hashable:
+    """Cache key of a chart of user in their language and a render profile.
+
+    Charts cover the year up to today at today's exchange rates, so they
+    are redrawn daily. Target currency follows from the wallets, which are
+    covered by the data version.
+    """
+    return (
+        user.id,
+        user.data_version,
+        user.language,
+        chart,
+        profile,
+        datetime.date.today(),
+    )
+
+
+class CachedChart:
+    """Rendered chart and the media it was last sent as."""
+
+    def __init__(self, data: bytes):
+        self.data = data
+        # photo or document of the sent message, re-sent by reference
+        #  instead of uploading data again; None until sent, or when
+        #  Telegram no longer accepts it
+        self.media: Any = None
+
+
+class ChartCache:
+    """LRU cache of rendered charts, bounded by their total size in bytes.
+
+    Entries are never invalidated, keys carry the data version of the user
+    instead, see `bump_data_version`. Along with the image, an entry keeps
+    the media Telegram stored it as once it was sent.
+    """
+
+    def __init__(self):
+        self.entries: OrderedDict[Hashable, CachedChart] = OrderedDict()
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def get(self, key: Hashable) -> CachedChart | None:
+        """Return cached chart, None on a miss."""
+        chart = self.entries.get(key)
+        if chart is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return chart
+
+    def put(self, key: Hashable, data: bytes) -> CachedChart:
+        """Store chart, evicting least recently used ones over the size limit.
+
+        Returns the new entry; a chart larger than the whole cache is
+        returned without being stored.
+        """
+        chart = CachedChart(data)
+        max_size = int(os.getenv("CHART_CACHE_SIZE_MB", "64")) * 1024 * 1024
+        if len(data) > max_size:
+            return chart
+
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old.data)
+        self.entries[key] = chart
+        self.size += len(data)
+
+        while self.size > max_size:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted.data)
+            self.evicted += 1
+        return chart
+
+    def metrics(self) -> dict[str, float]:
+        """Return hit/miss counters and current size."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0,
+            "evicted": self.evicted,
+            "uploaded": sum(chart.media is not None for chart in self.entries.values()),
+            "entries": len(self.entries),
+            "size_bytes": self.size,
+        }
+
+
+chart_cache = ChartCache()
@@ -0,0 +1,326 @@
+import datetime
+import glob
+import io
+import os
+from contextlib import contextmanager
+from typing import Iterator
+
+import matplotlib
+import matplotlib.colors as mcolors
+import matplotlib.dates as mdates
+import matplotlib.font_manager as fm
+import matplotlib.style as mstyle
+from loguru import logger
+from matplotlib.artist import setp
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.ticker import FuncFormatter
+from PIL import Image
+
+# Runs in the render pool workers: functions take and return plain data
+#  only, see helpers/stats.py for what they get. Figures are built without
+#  pyplot, so charts can also be drawn in parallel threads.
+
+
+def setup_plotting_style():
+    """Sets global matplotlib style parameters for a modern dark theme with custom font."""
+    mstyle.use("dark_background")
+
+    # 1. Load All Static Fonts from Directory
+    font_dir = "src/assets/fonts/montserrat/static"
+    custom_font_family = "sans-serif"
+
+    if os.path.exists(font_dir):
+        font_files = glob.glob(os.path.join(font_dir, "*.ttf"))
+
+        if font_files:
+            for font_path in font_files:
+                try:
+                    fm.fontManager.addfont(font_path)
+                except Exception:
+                    pass
+
+            custom_font_family = "Montserrat"
+        else:
+            logger.warning(f"no .ttf files found in {font_dir}")
+    else:
+        logger.warning(f"font directory not found at {font_dir}")
+
+    # 2. Apply Styles
+    matplotlib.rcParams.update(
+        {
+            "figure.facecolor": "#121212",
+            "axes.facecolor": "#121212",
+            "text.color": "#E0E0E0",
+            "axes.labelcolor": "#E0E0E0",
+            "xtick.color": "#CCCCCC",
+            "ytick.color": "#CCCCCC",
+            "axes.edgecolor": "#444444",
+            "grid.color": "#333333",
+            "grid.linestyle": ":",
+            "grid.linewidth": 0.8,
+            # Font settings
+            "font.family": custom_font_family,
+            "font.weight": "bold",  # global bold default
+            "axes.labelweight": "bold",  # axes labels bold
+            "axes.titleweight": "bold",  # title bold
+            "font.size": 11,
+            "axes.titlesize": 16,
+            "axes.spines.top": False,
+            "axes.spines.right": False,
+        }
+    )
+
+
+setup_plotting_style()
+
+PALETTE = [
+    "#696FC7",
+    "#A7AAE1",
+    "#F5D3C4",
+    "#F2AEBB",
+    "#B5EAD7",
+]
+
+
+class RenderProfile:
+    """Resolution and image format charts are saved in.
+
+    Telethon uploads photos in RGB of up to 2560 pixels a side as they are,
+    anything else it converts to JPEG first, on the event loop. So profiles
+    sent as photos are kept within that. WebP is always sent as a file.
+    """
+
+    def __init__(
+        self,
+        dpi: int,
+        format: str,  # "png", "webp" or "jpeg"
+        quality: int = 90,  # of lossy formats, 1-100
+        colors: int | None = None,  # PNG palette size, None keeps true color
+        document: bool = False,  # send as a file, not as a photo
+    ):
+        self.dpi = dpi
+        self.format = format
+        self.quality = quality
+        self.colors = colors
+        self.document = document
+
+    @property
+    def extension(self) -> str:
+        return "jpg" if self.format == "jpeg" else self.format
+
+
+# chosen by CHART_PROFILE
+PROFILES = {
+    "preview": RenderProfile(dpi=100, format="jpeg", quality=85),
+    "standard": RenderProfile(dpi=200, format="png"),
+    # full resolution for zooming in and printing, too large for a photo
+    "print": RenderProfile(dpi=600, format="png", colors=256, document=True),
+}
+DEFAULT_PROFILE = "standard"
+
+
+@contextmanager
+def new_figure(**kwargs) -> Iterator[Figure]:
+    """Figure with its own Agg canvas, cleared even if drawing fails."""
+    fig = Figure(**kwargs)
+    FigureCanvasAgg(fig)
+    try:
+        yield fig
+    finally:
+        # drop artists right away instead of waiting for the cycle collector
+        fig.clear()
+
+
+def save_image(fig: Figure, profile: RenderProfile) -> bytes:
+    """Draw figure at the resolution of profile, return it in its format."""
+    fig.set_dpi(profile.dpi)
+    canvas = fig.canvas
+    canvas.draw()
+    # figures are opaque, the alpha channel is of no use
+    image = Image.frombuffer(
+        "RGBA", canvas.get_width_height(physical=True), canvas.buffer_rgba()
+    ).convert("RGB")
+
+    buf = io.BytesIO()
+    if profile.format == "png":
+        if profile.colors is not None:
+            image = image.quantize(profile.colors, method=Image.Quantize.FASTOCTREE)
+        image.save(buf, format="png")
+    else:
+        image.save(buf, format=profile.format, quality=profile.quality)
+    return buf.getvalue()
+
+
+def warm_up() -> None:
+    """Prepare a worker: draw once to load fonts and the backend."""
+    with new_figure(figsize=(1, 1)) as fig:
+        ax = fig.subplots()
+        ax.plot([0, 1], [0, 1])
+        for profile in PROFILES.values():
+            # loads the encoders of all formats
+            save_image(fig, RenderProfile(10, profile.format, colors=profile.colors))
+
+
+def ping() -> None:
+    """Do nothing, submitted to start workers ahead of the first chart."""
+
+
+def get_text_color(hex_color):
+    """Determines whether black or white text contrasts better with the background."""
+    try:
+        rgb = mcolors.hex2color(hex_color)
+        luminance = 0.299 * rgb[0] + 0.587 * rgb[1] + 0.114 * rgb[2]
+        return "#000000" if luminance > 0.6 else "#FFFFFF"
+    except Exception:
+        return "#FFFFFF"
+
+
+def render_balance_history(data: dict, profile: str) -> bytes:
+    """Draw weekly balance history, return it as image."""
+    dates = [datetime.datetime.fromtimestamp(ts) for ts in data["dates"]]
+    values = data["values"]
+
+    with new_figure(figsize=(10, 6)) as fig:
+        ax = fig.subplots()
+        _draw_balance_history(fig, ax, dates, values, data)
+        return save_image(fig, PROFILES[profile])
+
+
+def _draw_balance_history(fig: Figure, ax, dates, values, data: dict) -> None:
+    accent_color = "#696FC7"
+
+    ax.plot(
+        dates,
+        values,
+        linestyle="-",
+        linewidth=3,
+        color=accent_color,
+    )
+
+    ax.fill_between(dates, values, color=accent_color, alpha=0.15)
+
+    ax.set_title(data["title"], pad=25)
+
+    ax.grid(True, axis="y", alpha=0.3)
+    ax.grid(False, axis="x")
+
+    month_names = data["month_names"]
+
+    def localize_date(x, pos):
+        """Converts matplotlib date number to localized 'Mon YY' string."""
+        dt = mdates.num2date(x)
+        return f"{month_names[dt.month - 1]} {dt.strftime('%y')}"
+
+    ax.xaxis.set_major_formatter(FuncFormatter(localize_date))
+
+    setp(ax.get_xticklabels(), fontweight="bold")
+    setp(ax.get_yticklabels(), fontweight="bold")
+
+    fig.autofmt_xdate(rotation=45)
+
+    fig.subplots_adjust(left=0.15, right=0.90, top=0.8, bottom=0.2)
+
+
+def render_category_pie_charts(data: dict, profile: str) -> bytes:
+    """Draw income and expense donuts by category, return them as image."""
+    with new_figure(figsize=(10, 8)) as fig:
+        ax1, ax2 = fig.subplots(1, 2)
+        _draw_category_pie_charts(fig, ax1, ax2, data)
+        return save_image(fig, PROFILES[profile])
+
+
+def _draw_category_pie_charts(fig: Figure, ax1, ax2, data: dict) -> None:
+    fig.suptitle(
+        data["title"],
+        y=0.90,
+        fontsize=18,
+        fontweight="bold",
+    )
+
+    def plot_donut(ax, data, title, no_data):
+        if not data:
+            ax.text(
+                0.5,
+                0.5,
+                no_data,
+                ha="center",
+                va="center",
+                color="#777777",
+                fontweight="bold",
+            )
+            ax.set_title(title, pad=5)
+            ax.axis("off")
+            return
+
+        sorted_items = sorted(data.items(), key=lambda item: item[1], reverse=True)
+
+        MAX_SLICES = 6
+        OTHER_COLOR = "#555555"
+
+        labels = []
+        sizes = []
+        colors = []
+
+        if len(sorted_items) > MAX_SLICES:
+            main_items = sorted_items[: MAX_SLICES - 1]
+            tail_items = sorted_items[MAX_SLICES - 1 :]
+
+            labels = [k for k, v in main_items]
+            sizes = [v for k, v in main_items]
+            colors = PALETTE[: len(main_items)]
+
+            tail_sum = sum(v for k, v in tail_items)
+            tail_names = [k for k, v in tail_items]
+
+            if len(tail_names) == 1:
+                tail_label = tail_names[0]
+            elif len(tail_names) == 2:
+                tail_label = f"{tail_names[0]}, {tail_names[1]}"
+            else:
+                tail_label = (
+                    f"{tail_names[0]}, {tail_names[1]} + {len(tail_names)-2} more"
+                )
+
+            labels.append(tail_label)
+            sizes.append(tail_sum)
+            colors.append(OTHER_COLOR)
+        else:
+            labels = [k for k, v in sorted_items]
+            sizes = [v for k, v in sorted_items]
+            colors = PALETTE * (len(labels) // len(PALETTE) + 1)
+            colors = colors[: len(labels)]
+
+        wedges, texts, autotexts = ax.pie(
+            sizes,
+            labels=None,
+            autopct="%1.0f%%",
+            startangle=90,
+            colors=colors,
+            wedgeprops=dict(width=0.4, edgecolor="#121212", linewidth=2),
+            pctdistance=0.80,
+        )
+
+        for text, wedge_color in zip(autotexts, colors):
+            text.set_color(get_text_color(wedge_color))
+            text.set_weight("heavy")
+            text.set_fontsize(10)
+
+        ax.set_title(title, pad=5, fontsize=16, fontweight="bold")
+
+        ax.legend(
+            wedges,
+            labels,
+            loc="upper center",
+            bbox_to_anchor=(0.5, -0.05),
+            frameon=False,
+            ncol=1,
+            fontsize=11,
+            labelspacing=0.8,
+            prop={"weight": "bold"},
+        )
+
+    plot_donut(ax1, data["income"], data["income_title"], data["no_data"])
+    plot_donut(ax2, data["expense"], data["expense_title"], data["no_data"])
+
+    fig.subplots_adjust(left=0.08, right=0.92, top=0.9, bottom=0.2)
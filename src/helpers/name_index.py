@@ -0,0 +1,330 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+from rapidfuzz import fuzz, process
+from rapidfuzz.utils import default_process
+from sqlalchemy import literal, select, union_all
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database.models import Category, CategoryAlias, Wallet, WalletAlias
+
+# characters other than whitespace are counted in this many buckets
+CHAR_BUCKETS = 64
+# choices scored up front to get a good initial score cutoff
+SHORTLIST_SIZE = 8
+# slack for float error of scores computed with a cutoff; it only widens
+#  the candidate set, so results don't depend on it
+SCORE_TOLERANCE = 0.01
+
+
+def char_counts(text: str) -> np.ndarray:
+    """Count non-whitespace characters of text, hashed into buckets."""
+    counts = np.zeros(CHAR_BUCKETS, dtype=np.uint16)
+    for char in text:
+        if not char.isspace():
+            counts[ord(char) % CHAR_BUCKETS] += 1
+    return counts
+
+
+class NGramIndex:
+    """Candidate index for WRatio matching against a large list of choices.
+
+    A trigram index shortlists likely matches, whose best score becomes the
+    cutoff for the rest. A character count filter then discards every choice
+    whose WRatio score provably can't reach the cutoff, and only the
+    remaining choices are scored. Results are identical to a full
+    `process.extractOne` over all choices.
+
+    Choices must already be processed, the filter assumes `processor=None`.
+    """
+
+    def __init__(self, choices: list[str]):
+        self.choices = choices
+
+        self.counts = np.zeros((len(choices), CHAR_BUCKETS), dtype=np.uint16, order="F")
+        lengths, spaces, words = [], [], []
+        self.tokens: dict[str, list[int]] = {}
+        grams: dict[str, list[int]] = {}
+        # choices with repeated words are always scored, the filter below
+        #  assumes their sorted and deduplicated words are the same
+        always = []
+
+        for i, choice in enumerate(choices):
+            split = choice.split()
+            self.counts[i] = char_counts(choice)
+            lengths.append(len(choice))
+            spaces.append(sum(char.isspace() for char in choice))
+            words.append(len(split))
+
+            for token in set(split):
+                self.tokens.setdefault(token, []).append(i)
+            for gram in self.trigrams(choice):
+                grams.setdefault(gram, []).append(i)
+            if len(set(split)) != len(split):
+                always.append(i)
+
+        self.lengths = np.array(lengths, dtype=np.float64)
+        self.spaces = np.array(spaces, dtype=np.float64)
+        # words joined by single spaces, as token ratios compare them
+        self.separators = np.maximum(np.array(words, dtype=np.float64) - 1, 0)
+        self.sorted_lengths = self.lengths - self.spaces + self.separators
+
+        self.grams = {
+            gram: np.array(ids, dtype=np.int32) for gram, ids in grams.items()
+        }
+        self.always = np.array(always, dtype=np.int64)
+
+    @staticmethod
+    def trigrams(text: str) -> set[str]:
+        padded = f"  {text} "
+        return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+    def shortlist(self, query: str) -> np.ndarray:
+        """Return choices sharing the most trigrams with the query."""
+        postings = [self.grams[g] for g in self.trigrams(query) if g in self.grams]
+        if not postings:
+            return np.empty(0, dtype=np.int64)
+
+        shared = np.bincount(np.concatenate(postings), minlength=len(self.choices))
+        size = min(SHORTLIST_SIZE, len(self.choices))
+        return np.argpartition(shared, -size)[-size:]
+
+    def overlap(self, text: str) -> np.ndarray:
+        """Upper bound of common non-whitespace characters with every choice."""
+        total = np.zeros(len(self.choices), dtype=np.float64)
+        counts = char_counts(text)
+        for bucket in np.flatnonzero(counts):
+            total += np.minimum(self.counts[:, bucket], counts[bucket])
+        return total
+
+    def bounds(self, query: str) -> np.ndarray:
+        """Upper bounds of WRatio scores of query and every choice.
+
+        Every ratio WRatio takes into account is an Indel similarity of
+        some (sub)strings, at most twice their common characters divided by
+        their total length. Token ratios compare words sorted and joined by
+        single spaces, which keeps the same non-whitespace characters.
+
+        Not valid for choices sharing a word with the query or having
+        repeated words, those are handled by the caller.
+        """
+        split = query.split()
+        sorted_query = " ".join(sorted(split))
+        set_query = " ".join(sorted(set(split)))
+
+        common = self.overlap(query)
+        if len(set(split)) == len(split):
+            set_common = common
+        else:
+            set_common = self.overlap(set_query)
+
+        plain_common = common + np.minimum(
+            self.spaces, len(query) - len("".join(split))
+        )
+        sorted_common = common + np.minimum(self.separators, len(split) - 1)
+        set_common = set_common + np.minimum(self.separators, len(set(split)) - 1)
+
+        length = self.lengths
+        sorted_length = self.sorted_lengths
+        shorter = np.minimum(length, len(query))
+        len_ratio = np.maximum(length, len(query)) / np.maximum(shorter, 1)
+
+        ratio = 200 * plain_common / (length + len(query))
+        token_ratio = 0.95 * np.maximum(
+            200 * sorted_common / (sorted_length + len(sorted_query)),
+            200 * set_common / (sorted_length + len(set_query)),
+        )
+
+        # partial ratios compare the shorter string with parts of the longer,
+        #  best case is a part made of the common characters only
+        def partial(common: np.ndarray, shorter: np.ndarray) -> np.ndarray:
+            return 200 * common / np.maximum(shorter + common, 1)
+
+        scale = np.where(len_ratio < 8.0, 0.9, 0.6)
+        partial_ratio = scale * partial(plain_common, shorter)
+        partial_token_ratio = (
+            0.95
+            * scale
+            * np.maximum(
+                partial(sorted_common, np.minimum(sorted_length, len(sorted_query))),
+                partial(set_common, np.minimum(sorted_length, len(set_query))),
+            )
+        )
+
+        return np.where(
+            len_ratio < 1.5,
+            np.maximum(ratio, token_ratio),
+            np.maximum.reduce([ratio, partial_ratio, partial_token_ratio]),
+        )
+
+    def extract_one(self, query: str, score_cutoff: float):
+        """Same as `process.extractOne` with WRatio scorer and no processor."""
+        if not query or not self.choices:
+            return None
+
+        shortlist = self.shortlist(query)
+        best = process.extractOne(
+            query,
+            [self.choices[i] for i in shortlist],
+            scorer=fuzz.WRatio,
+            processor=None,
+            score_cutoff=score_cutoff,
+        )
+        if best is not None:
+            score_cutoff = best[1] - SCORE_TOLERANCE
+
+        candidates = np.flatnonzero(
+            self.bounds(query) >= score_cutoff - SCORE_TOLERANCE
+        )
+        shared = [self.tokens.get(token, []) for token in query.split()]
+        candidates = np.union1d(
+            candidates,
+            np.concatenate([self.always, shortlist, *map(np.array, shared)]),
+        ).astype(np.int64)
+
+        match = process.extractOne(
+            query,
+            [self.choices[i] for i in candidates],
+            scorer=fuzz.WRatio,
+            processor=None,
+            score_cutoff=score_cutoff,
+        )
+        if match is None:
+            return None
+        return match[0], match[1], int(candidates[match[2]])
+
+
+class NameIndex:
+    """Live names and aliases of one kind of entity (categories or wallets)."""
+
+    def __init__(self, names: dict[str, bytes], aliases: dict[str, bytes]):
+        self.names = names  # name -> uuid
+        self.aliases = aliases  # alias -> uuid
+        self.by_id = {uuid: name for name, uuid in names.items()}
+        # exact matches are found without scoring
+        self.lowered: dict[str, str] = {}
+        for name in names:
+            self.lowered.setdefault(name.lower(), name)
+
+        # fuzzy matching choices, processed once instead of on every lookup
+        self.choices = list(names)
+        self.processed = [default_process(name) for name in self.choices]
+        self.ngrams = None
+        if len(self.choices) >= int(os.getenv("NAME_INDEX_NGRAM_MIN_SIZE", "500")):
+            self.ngrams = NGramIndex(self.processed)
+
+    def match(self, input_name: str, threshold: int = 75):
+        """Find entity by alias, exact or fuzzy name match.
+
+        Returns a ("exact" | "fuzzy", uuid, name) or ("none",) tuple.
+        """
+        name = input_name.lower()
+
+        uuid = self.aliases.get(name)
+        if uuid in self.by_id:
+            return ("exact", uuid, self.by_id[uuid])
+        if name in self.lowered:
+            name = self.lowered[name]
+            return ("exact", self.names[name], name)
+
+        # scores are compared rounded, like thefuzz did
+        if self.ngrams is not None:
+            match = self.ngrams.extract_one(
+                default_process(input_name), score_cutoff=threshold - 0.5
+            )
+        else:
+            match = process.extractOne(
+                default_process(input_name),
+                self.processed,
+                scorer=fuzz.WRatio,
+                processor=None,
+                score_cutoff=threshold - 0.5,
+            )
+        if match is None or round(match[1]) < threshold:
+            return ("none",)
+
+        name = self.choices[match[2]]
+        if round(match[1]) == 100:
+            return ("exact", self.names[name], name)
+        return ("fuzzy", self.names[name], name)
+
+
+class NameIndexCache:
+    """LRU cache of per-user category and wallet name indexes.
+
+    Has to be invalidated whenever a category, wallet or alias of the user
+    is created, renamed or deleted.
+    """
+
+    def __init__(self):
+        self.indexes: OrderedDict[bytes, tuple[NameIndex, NameIndex]] = OrderedDict()
+        # of users being loaded, bumped on invalidation, so loads racing with
+        #  a change are not stored
+        self.generations: dict[bytes, int] = {}
+        self.loads: dict[bytes, int] = {}  # loads in flight
+
+    def invalidate(self, user_id: bytes) -> None:
+        """Drop cached indexes of the user."""
+        self.indexes.pop(user_id, None)
+        if user_id in self.generations:
+            self.generations[user_id] += 1
+
+    async def get(
+        self, session: AsyncSession, user_id: bytes
+    ) -> tuple[NameIndex, NameIndex]:
+        """Return (categories, wallets) indexes, loading them on a miss."""
+        if user_id in self.indexes:
+            self.indexes.move_to_end(user_id)
+            return self.indexes[user_id]
+
+        generation = self.generations.setdefault(user_id, 0)
+        self.loads[user_id] = self.loads.get(user_id, 0) + 1
+        try:
+            indexes = await load_name_indexes(session, user_id)
+
+            if self.generations[user_id] == generation:
+                self.indexes[user_id] = indexes
+                if len(self.indexes) > int(os.getenv("NAME_INDEX_CACHE_SIZE", "1024")):
+                    self.indexes.popitem(last=False)
+        finally:
+            self.loads[user_id] -= 1
+            if not self.loads[user_id]:
+                del self.loads[user_id]
+                del self.generations[user_id]
+
+        return indexes
+
+
+async def load_name_indexes(
+    session: AsyncSession, user_id: bytes
+) -> tuple[NameIndex, NameIndex]:
+    """Load live names and aliases of user categories and wallets at once."""
+    result = await session.execute(
+        union_all(
+            select(literal("c"), literal(False), Category.name, Category.id).where(
+                Category.holder == user_id, Category.is_deleted == False
+            ),
+            select(
+                literal("c"), literal(True), CategoryAlias.alias, CategoryAlias.category
+            ).where(CategoryAlias.holder == user_id),
+            select(literal("w"), literal(False), Wallet.name, Wallet.id).where(
+                Wallet.holder == user_id, Wallet.is_deleted == False
+            ),
+            select(
+                literal("w"), literal(True), WalletAlias.alias, WalletAlias.wallet
+            ).where(WalletAlias.holder == user_id),
+        )
+    )
+
+    data = {("c", False): {}, ("c", True): {}, ("w", False): {}, ("w", True): {}}
+    for kind, is_alias, name, uuid in result:
+        data[(kind, bool(is_alias))][name] = uuid
+
+    return (
+        NameIndex(data[("c", False)], data[("c", True)]),
+        NameIndex(data[("w", False)], data[("w", True)]),
+    )
+
+
+name_indexes = NameIndexCache()
@@ -0,0 +1,347 @@
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from enum import IntEnum
+from typing import Any, Awaitable, Callable, Hashable
+
+from loguru import logger
+from telethon import events
+from telethon.errors import FloodWaitError
+
+# makes one Telegram API call
+ApiCall = Callable[[], Awaitable[Any]]
+
+
+class Priority(IntEnum):
+    """Order in which queued calls are sent, lower first."""
+
+    REPLY = 0  # answers to what the user just did
+    MEDIA = 1  # charts, exported files
+    BACKGROUND = 2  # progress of long running jobs
+
+
+class TokenBucket:
+    """Allows `rate` calls per second on average, bursts of up to `burst`."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until a token is available."""
+        self.refill(now)
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+
+class _Chat:
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        self.blocked_until = 0.0  # FloodWait of this chat
+        self.busy = False  # a call is in flight, calls of a chat keep their order
+        self.pending = 0
+
+
+class _Job:
+    def __init__(self, chat_id: int, call: ApiCall, priority: Priority, limited: bool):
+        self.chat_id = chat_id
+        self.call = call
+        self.priority = priority
+        self.limited = limited  # takes a token of the chat bucket
+        self.futures: list[asyncio.Future] = []
+        self.edit_key: Hashable | None = None
+        self.queued = time.monotonic()
+
+
+class Outbox:
+    """Flood-control aware scheduler of outgoing Telegram API calls.
+
+    Calls are queued by priority and sent as global and per-chat token
+    buckets allow (OUTBOX_GLOBAL_RATE and OUTBOX_CHAT_RATE calls per
+    second). A chat hit by FloodWait is paused for the requested time and
+    its call is retried. An edit of a message that still waits for its
+    turn is replaced by a newer edit of the same message, only the last
+    one is sent.
+
+    Handlers and menus should use the methods below instead of calling
+    `event.respond`, `event.edit` etc. directly. The client must have
+    `flood_sleep_threshold` at 0, otherwise Telethon sleeps through short
+    FloodWaits inside the call and they never get here.
+    """
+
+    def __init__(self):
+        self.heap: list[tuple[int, int, _Job]] = []
+        self.chats: dict[int, _Chat] = {}
+        self.edits: dict[Hashable, _Job] = {}
+        self.sequence = itertools.count()
+        self.wakeup: asyncio.Event | None = None
+        self.task: asyncio.Task | None = None
+        # calls in flight, referenced so they are not garbage collected
+        self.sending: set[asyncio.Task] = set()
+        self.bucket = TokenBucket(30, 30)
+        self.chat_rate = 1.0
+        self.chat_burst = 3.0
+        self.max_flood_wait = 300
+
+        self.sent = 0
+        self.coalesced = 0
+        self.flood_waits = 0
+        self.max_queue_delay = 0.0
+
+    def start(self) -> None:
+        """Start sending queued calls."""
+        rate = float(os.getenv("OUTBOX_GLOBAL_RATE", "30"))  # calls per second
+        self.bucket = TokenBucket(rate, rate)
+        self.chat_rate = float(os.getenv("OUTBOX_CHAT_RATE", "1"))
+        self.chat_burst = float(os.getenv("OUTBOX_CHAT_BURST", "3"))
+        # longer FloodWaits fail the call instead of holding it
+        self.max_flood_wait = int(os.getenv("OUTBOX_MAX_FLOOD_WAIT", "300"))
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop sending, queued calls are not made."""
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def respond(self, event, *args, priority=Priority.REPLY, **kwargs):
+        """Same as `event.respond`."""
+        return await self.submit(
+            event.chat_id, lambda: event.respond(*args, **kwargs), priority
+        )
+
+    async def reply(self, event, *args, priority=Priority.REPLY, **kwargs):
+        """Same as `event.reply`."""
+        return await self.submit(
+            event.chat_id, lambda: event.reply(*args, **kwargs), priority
+        )
+
+    async def send_message(
+        self, event, message: str, *, priority=Priority.REPLY, **kwargs
+    ):
+        """Send a message to the chat of event."""
+        return await self.submit(
+            event.chat_id,
+            lambda: event.client.send_message(
+                entity=event.chat_id, message=message, **kwargs
+            ),
+            priority,
+        )
+
+    async def send_file(self, event, file, *, priority=Priority.MEDIA, **kwargs):
+        """Send file(s) to the chat of event."""
+        return await self.submit(
+            event.chat_id,
+            lambda: event.client.send_file(event.chat_id, file=file, **kwargs),
+            priority,
+        )
+
+    async def edit(self, target, *args, priority=Priority.REPLY, **kwargs):
+        """Same as `target.edit`, target is a callback event or a message."""
+        if isinstance(target, events.CallbackQuery.Event):
+            message_id = target.message_id
+        else:
+            message_id = target.id
+        return await self.submit(
+            target.chat_id,
+            lambda: target.edit(*args, **kwargs),
+            priority,
+            edit_key=(target.chat_id, message_id),
+        )
+
+    async def edit_message(
+        self, event, message_id: int, text: str, *, priority=Priority.REPLY, **kwargs
+    ):
+        """Edit message of the chat of event."""
+        return await self.submit(
+            event.chat_id,
+            lambda: event.client.edit_message(
+                entity=event.chat_id, message=message_id, text=text, **kwargs
+            ),
+            priority,
+            edit_key=(event.chat_id, message_id),
+        )
+
+    async def delete(self, target, *, priority=Priority.REPLY):
+        """Same as `target.delete`."""
+        return await self.submit(target.chat_id, target.delete, priority)
+
+    async def answer(self, event, *args, **kwargs):
+        """Same as `event.answer`, answers don't count as messages to the chat."""
+        return await self.submit(
+            event.chat_id,
+            lambda: event.answer(*args, **kwargs),
+            Priority.REPLY,
+            limited=False,
+        )
+
+    async def submit(
+        self,
+        chat_id: int,
+        call: ApiCall,
+        priority: Priority,
+        edit_key: Hashable | None = None,
+        limited: bool = True,
+    ) -> Any:
+        """Queue call, return its result once it was made."""
+        if self.wakeup is None:
+            raise RuntimeError("Outbox is not started")
+
+        future = asyncio.get_running_loop().create_future()
+
+        job = self.edits.get(edit_key) if edit_key is not None else None
+        if job is not None:
+            # not sent yet, send the new content instead
+            job.call = call
+            job.futures.append(future)
+            self.coalesced += 1
+            return await future
+
+        job = _Job(chat_id, call, priority, limited)
+        job.futures.append(future)
+        if edit_key is not None:
+            job.edit_key = edit_key
+            self.edits[edit_key] = job
+
+        self._chat(chat_id).pending += 1
+        heapq.heappush(self.heap, (priority, next(self.sequence), job))
+        self.wakeup.set()
+        return await future
+
+    def metrics(self) -> dict[str, float]:
+        """Return counters and current queue state."""
+        now = time.monotonic()
+        return {
+            "queued": len(self.heap),
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "flood_waits": self.flood_waits,
+            "blocked_chats": sum(c.blocked_until > now for c in self.chats.values()),
+            "max_queue_delay_ms": self.max_queue_delay * 1000,
+        }
+
+    def _chat(self, chat_id: int) -> _Chat:
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            chat = self.chats[chat_id] = _Chat(
+                TokenBucket(self.chat_rate, self.chat_burst)
+            )
+        return chat
+
+    def _pick(self, now: float) -> tuple[_Job | None, float | None]:
+        """Take the first call that can be sent now.
+
+        Returns (job, None), or (None, seconds until one may be ready), or
+        (None, None) if only a call in flight can unblock the queue.
+        """
+        if not self.heap:
+            return None, None
+        delay = self.bucket.wait_time(now)
+        if delay > 0:
+            return None, delay
+
+        skipped = []
+        found = None
+        delay = None
+        while self.heap:
+            entry = heapq.heappop(self.heap)
+            job = entry[2]
+            chat = self.chats[job.chat_id]
+
+            wait = chat.blocked_until - now
+            if job.limited:
+                wait = max(wait, chat.bucket.wait_time(now))
+            if not chat.busy and wait <= 0:
+                found = job
+                break
+
+            skipped.append(entry)
+            if not chat.busy:
+                delay = wait if delay is None else min(delay, wait)
+
+        for entry in skipped:
+            heapq.heappush(self.heap, entry)
+        return found, delay
+
+    def _forget_idle_chats(self, now: float) -> None:
+        for chat_id, chat in list(self.chats.items()):
+            if chat.pending == 0 and chat.blocked_until <= now:
+                chat.bucket.refill(now)
+                if chat.bucket.tokens >= chat.bucket.burst:
+                    del self.chats[chat_id]
+
+    async def _send(self, job: _Job) -> None:
+        chat = self.chats[job.chat_id]
+        try:
+            result = await job.call()
+        except FloodWaitError as e:
+            self.flood_waits += 1
+            if e.seconds > self.max_flood_wait:
+                self._finish(job, chat, error=e)
+                return
+            logger.warning(f"FloodWait of {e.seconds}s for chat {job.chat_id}")
+            chat.blocked_until = time.monotonic() + e.seconds
+            heapq.heappush(self.heap, (job.priority, next(self.sequence), job))
+        except Exception as e:
+            self._finish(job, chat, error=e)
+        else:
+            self.sent += 1
+            self._finish(job, chat, result=result)
+        finally:
+            chat.busy = False
+            assert self.wakeup is not None
+            self.wakeup.set()
+
+    def _finish(self, job: _Job, chat: _Chat, result=None, error=None) -> None:
+        chat.pending -= 1
+        for future in job.futures:
+            if future.done():  # caller went away
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    async def _run(self) -> None:
+        """Send queued calls as the rate limits allow, until cancelled."""
+        assert self.wakeup is not None
+        while True:
+            now = time.monotonic()
+            job, delay = self._pick(now)
+            if job is None:
+                if not self.heap:
+                    self._forget_idle_chats(now)
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            if job.edit_key is not None and self.edits.get(job.edit_key) is job:
+                # later edits of this message are queued as new calls
+                del self.edits[job.edit_key]
+            self.max_queue_delay = max(self.max_queue_delay, now - job.queued)
+
+            chat = self.chats[job.chat_id]
+            chat.busy = True
+            self.bucket.take()
+            if job.limited:
+                chat.bucket.take()
+            task = asyncio.create_task(self._send(job))
+            self.sending.add(task)
+            task.add_done_callback(self.sending.discard)
+
+
+outbox = Outbox()
@@ -0,0 +1,170 @@
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Hashable
+
+from loguru import logger
+
+from helpers import charts
+
+
+class RenderQueueFull(Exception):
+    """Too many charts are waiting to be drawn."""
+
+
+class RenderCancelled(Exception):
+    """Chart is no longer needed, see `RenderPool.cancel`."""
+
+
+class RenderPool:
+    """Draws charts in a pool of worker processes, off the event loop.
+
+    CHART_WORKERS processes are started up front and keep matplotlib,
+    fonts and style loaded between charts. Memory of a worker levels off
+    once matplotlib caches are full, see dev/check_chart_memory.py; a
+    worker is still replaced after drawing CHART_WORKER_MAX_TASKS charts,
+    in case a library leaks. At most CHART_MAX_QUEUE charts
+    are queued or drawn at once, more are refused with RenderQueueFull.
+    A chart that takes longer than CHART_TIMEOUT seconds fails with
+    TimeoutError. Jobs get only plain data and return plain data.
+
+    Charts are drawn in the CHART_PROFILE render profile, see
+    `charts.PROFILES`.
+    """
+
+    def __init__(self):
+        self.executor: ProcessPoolExecutor | None = None
+        self.workers = 2
+        self.max_tasks_per_worker = 500
+        self.max_queue = 16
+        self.timeout = 60.0
+        self.profile = charts.DEFAULT_PROFILE
+        # key -> futures of its charts, to cancel them
+        self.jobs: dict[Hashable, set[asyncio.Future]] = {}
+
+        self.pending = 0
+        self.rendered = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.cancelled = 0
+        self.total_time = 0.0
+
+    def start(self) -> None:
+        """Start the worker processes."""
+        self.workers = int(os.getenv("CHART_WORKERS", "2"))
+        self.max_tasks_per_worker = int(os.getenv("CHART_WORKER_MAX_TASKS", "500"))
+        self.max_queue = int(os.getenv("CHART_MAX_QUEUE", "16"))
+        self.timeout = float(os.getenv("CHART_TIMEOUT", "60"))  # seconds
+        self.profile = os.getenv("CHART_PROFILE", charts.DEFAULT_PROFILE)
+        if self.profile not in charts.PROFILES:
+            raise ValueError(
+                f"Unknown CHART_PROFILE {self.profile!r}, "
+                f"expected one of {', '.join(charts.PROFILES)}"
+            )
+        self._create_executor()
+
+    def stop(self) -> None:
+        """Stop the workers, queued charts are not drawn."""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    async def render(self, key: Hashable, function: Callable, *args) -> Any:
+        """Run function in a worker, return its result.
+
+        Raises RenderQueueFull, TimeoutError or RenderCancelled if the
+        charts of key were cancelled meanwhile.
+        """
+        if self.executor is None:
+            raise RuntimeError("Render pool is not started")
+        if self.pending >= self.max_queue:
+            self.rejected += 1
+            raise RenderQueueFull()
+
+        loop = asyncio.get_running_loop()
+        job = self.executor.submit(function, *args)
+        self.pending += 1
+        # the slot is taken until a worker is done with the chart, even if
+        #  the caller gave up on it earlier (timeout, cancel)
+        job.add_done_callback(lambda _: self._release(loop))
+        started = time.monotonic()
+        future = asyncio.wrap_future(job)
+        jobs = self.jobs.setdefault(key, set())
+        jobs.add(future)
+        try:
+            # cancels the job on timeout, if no worker took it yet
+            result = await asyncio.wait_for(future, self.timeout)
+        except TimeoutError:
+            self.timed_out += 1
+            raise
+        except asyncio.CancelledError:
+            task = asyncio.current_task()
+            if task is not None and task.cancelling():
+                raise
+            self.cancelled += 1
+            raise RenderCancelled()
+        except BrokenProcessPool:
+            logger.error("Chart worker died, restarting the render pool")
+            self.stop()
+            self._create_executor()
+            raise
+        finally:
+            jobs.discard(future)
+            if not jobs and self.jobs.get(key) is jobs:
+                del self.jobs[key]
+
+        self.rendered += 1
+        self.total_time += time.monotonic() - started
+        return result
+
+    def cancel(self, key: Hashable) -> int:
+        """Cancel charts of key, return their number.
+
+        Charts a worker already draws are finished, but their results are
+        thrown away.
+        """
+        jobs = self.jobs.get(key, ())
+        for future in jobs:
+            future.cancel()
+        return len(jobs)
+
+    def metrics(self) -> dict[str, float]:
+        """Return counters and current queue state."""
+        return {
+            "pending": self.pending,
+            "rendered": self.rendered,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "cancelled": self.cancelled,
+            "avg_render_ms": (
+                self.total_time / self.rendered * 1000 if self.rendered else 0
+            ),
+        }
+
+    def _release(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Free the slot of a finished chart, called from executor threads."""
+
+        def release():
+            self.pending -= 1
+
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(release)
+
+    def _create_executor(self) -> None:
+        # spawned, not forked: the bot process runs threads (database
+        #  drivers, executor managers) that a fork would copy mid-state
+        self.executor = ProcessPoolExecutor(
+            self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=charts.warm_up,
+            max_tasks_per_child=self.max_tasks_per_worker,
+        )
+        # workers are started on demand, get them all warm now
+        for _ in range(self.workers):
+            self.executor.submit(charts.ping)
+
+
+render_pool = RenderPool()
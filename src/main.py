@@ -6,47 +6,90 @@ from loguru import logger
 from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker
 from telethon import TelegramClient
 
-from database.connect import get_async_engine, get_session_maker
+from database.coalescer import write_coalescer
+from database.connect import (get_async_engine, get_reader_engines,
+                              get_session_maker, get_sqlite_settings)
+from database.conversation import conversations
 from database.init import init_db
 from handlers.callback import register_callback_handler
+from handlers.dispatcher import dispatcher
 from handlers.message import register_message_handler
-
-load_dotenv()
+from helpers.outbox import outbox
+from helpers.render_pool import render_pool
+from translate import load_translations, watch_translations
 
 logger.opt(colors=True)
 
-API_ID = int(os.getenv("API_ID", "0"))
-API_HASH = os.getenv("API_HASH", "")
-BOT_TOKEN = os.getenv("BOT_TOKEN", "")
-DATABASE_URL = os.getenv("DATABASE_URL")
-
-if not DATABASE_URL:
-    raise ValueError("DATABASE_URL environment variable not set.")
 
-engine: AsyncEngine = get_async_engine(DATABASE_URL)
-session_maker: async_sessionmaker = get_session_maker(engine)
+async def main():
+    """Initialize the database, start listening for events."""
+    # built here, not at import: chart workers are spawned, they import this
+    #  module again and must not open the database or the Telegram session
+    database_url = os.getenv("DATABASE_URL")
+    if not database_url:
+        raise ValueError("DATABASE_URL environment variable not set.")
 
-client = TelegramClient("connection", API_ID, API_HASH)
+    engine: AsyncEngine = get_async_engine(database_url)
+    reader_engines: list[AsyncEngine] = get_reader_engines(database_url)
+    session_maker: async_sessionmaker = get_session_maker(engine, reader_engines)
 
+    client = TelegramClient(
+        "connection",
+        int(os.getenv("API_ID", "0")),
+        os.getenv("API_HASH", ""),
+        # raise every FloodWait, the outbox waits them out per chat
+        flood_sleep_threshold=0,
+    )
 
-async def main():
-    """Initialize the database, start listening for events."""
     logger.info("Initializing database...")
-    await init_db(engine)
+    # keep a reference, so the backfill task is not garbage collected
+    backfills = await init_db(engine)  # noqa: F841
     logger.success("Database initialized.")
 
-    logger.info("Starting Telegram client...")
-    await client.start(bot_token=BOT_TOKEN)
-    logger.success("Telegram client started.")
+    if engine.dialect.name == "sqlite":
+        settings = await get_sqlite_settings(engine)
+        logger.info(
+            "SQLite settings: " + ", ".join(f"{k}={v}" for k, v in settings.items())
+        )
+        logger.info(f"Using 1 writer and {len(reader_engines)} reader engine(s).")
+
+    write_coalescer.start(engine)
+    conversations.start()
+    dispatcher.start()
+    outbox.start()
+    render_pool.start()
+
+    translations = load_translations()
+    logger.info(f"Loaded translations: {', '.join(translations) or 'none'}")
+    # seconds between checks for changed .mo files, 0 disables hot-reload
+    reload_interval = float(os.getenv("TRANSLATIONS_RELOAD_INTERVAL", "0"))
+    if reload_interval > 0:
+        translations_watcher = asyncio.create_task(  # noqa: F841
+            watch_translations(reload_interval)
+        )
+
+    try:
+        logger.info("Starting Telegram client...")
+        await client.start(bot_token=os.getenv("BOT_TOKEN", ""))
+        logger.success("Telegram client started.")
 
-    register_callback_handler(client, session_maker)
-    register_message_handler(client, session_maker)
+        register_callback_handler(client, session_maker)
+        register_message_handler(client, session_maker)
 
-    await client.run_until_disconnected()
-    logger.info("Telegram client disconnected.")
+        await client.run_until_disconnected()
+        logger.info("Telegram client disconnected.")
+    finally:
+        # also on Ctrl-C, which cancels main(); conversation states are
+        #  flushed through the coalescer, so it is drained after them
+        await conversations.stop()
+        await write_coalescer.stop()
+        await outbox.stop()
+        render_pool.stop()
+        logger.info("Pending writes flushed.")
 
 
 if __name__ == "__main__":
+    load_dotenv()
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
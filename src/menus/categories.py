@@ -9,20 +9,26 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload
 from telethon.tl.custom import Button
 
+from database.conversation import conversations
 from database.models import Category, CategoryAlias, Transaction, User
 from helpers.amount_formatter import format_amount
+from helpers.callback_data import encode_callback
+from helpers.chart_cache import bump_data_version
+from helpers.name_index import name_indexes
+from helpers.outbox import Priority, outbox
 
 
 async def handle_expectation_edit_category(session: AsyncSession, user: User, _, event):
     """Handle edit_category expectation."""
-    uuid = bytes.fromhex(user.expectation["expect"]["data"])
+    state = conversations.get(user.id)
+    uuid = bytes.fromhex(state["expect"]["data"])
     raw_text = event.raw_text
 
     if raw_text == "":
-        await event.respond(_("got_empty_message_for_category"))
+        await outbox.respond(event, _("got_empty_message_for_category"))
         return
     if " " in raw_text or "\n" in raw_text:
-        await event.respond(_("mutiple_word_category_name_error"))
+        await outbox.respond(event, _("mutiple_word_category_name_error"))
         return
 
     # name uniqueness check
@@ -34,7 +40,7 @@ async def handle_expectation_edit_category(session: AsyncSession, user: User, _,
     )
     categories = categories.scalars().all()
     if len(categories) != 0:
-        await event.respond(_("non_unique_category_name_error"))
+        await outbox.respond(event, _("non_unique_category_name_error"))
         return
 
     # delete matching aliases (same name)
@@ -51,18 +57,19 @@ async def handle_expectation_edit_category(session: AsyncSession, user: User, _,
     category = category.scalar_one_or_none()
     if category:
         category.name = raw_text
+        bump_data_version(user)
         await session.commit()
+        name_indexes.invalidate(user.id)
         await session.refresh(category)
-        await event.respond(_("category_edited_successfully").format(raw_text))
+        await outbox.respond(event, _("category_edited_successfully").format(raw_text))
         await send_menu(session, user, _, event)
 
-    user.expectation["expect"] = {"type": None, "data": None}
-    await session.commit()
+    state["expect"] = {"type": None, "data": None}
 
 
 async def export(session: AsyncSession, event, user: User, _):
     """Handle export callback - send back user categories as csv."""
-    await event.respond(_("export_started"))
+    await outbox.respond(event, _("export_started"))
 
     result = await session.execute(select(Category).where(Category.holder == user.id))
     categories = result.scalars().all()
@@ -87,35 +94,31 @@ async def export(session: AsyncSession, event, user: User, _):
     today = datetime.utcnow().strftime("%Y-%m-%d")
     csv_bytes.name = f"export_categories_{today}.csv"
 
-    await event.respond(_("export_categories_caption"), file=csv_bytes)
+    await outbox.respond(
+        event, _("export_categories_caption"), file=csv_bytes, priority=Priority.MEDIA
+    )
 
 
-async def handle_action(
-    session: AsyncSession, event, user: User, data: list, _
+async def handle_delete(
+    session: AsyncSession, user: User, _, event, uuid: bytes
 ) -> None:
-    """Handle user pressing a button under one of the action menus."""
-
-    if data[1][1] == "d":
-        uuid = bytes.fromhex(data[2])
+    """Handle user approving deletion of a category."""
 
-        category = await session.execute(select(Category).where(Category.id == uuid))
-        category = category.scalar_one_or_none()
-        category.is_deleted = True
-        session.add(category)
-
-        await session.execute(
-            delete(CategoryAlias).where(CategoryAlias.category == category.id)
-        )
+    category = await session.execute(select(Category).where(Category.id == uuid))
+    category = category.scalar_one_or_none()
+    category.is_deleted = True
+    session.add(category)
 
-        await session.commit()
+    await session.execute(
+        delete(CategoryAlias).where(CategoryAlias.category == category.id)
+    )
 
-        await event.edit(_("category_deleted_succesfully"))
-        await send_menu(session, user, _, event)
+    bump_data_version(user)
+    await session.commit()
+    name_indexes.invalidate(user.id)
 
-    else:
-        raise Exception(
-            'Got unexpected data for callback command "action" (categories)'
-        )
+    await outbox.edit(event, _("category_deleted_succesfully"))
+    await send_menu(session, user, _, event)
 
 
 async def check_ownership(
@@ -130,26 +133,30 @@ async def check_ownership(
     if category and not category.is_deleted:
         return True
     elif category and category.is_deleted:
-        await event.respond(_("category_action_ownership_check_got_deleted"))
+        await outbox.respond(event, _("category_action_ownership_check_got_deleted"))
     else:
-        await event.respond(_("category_action_ownership_check_failed"))
+        await outbox.respond(event, _("category_action_ownership_check_failed"))
 
     return False
 
 
 async def edit_menu(session: AsyncSession, user: User, _, event, uuid: bytes) -> None:
     """Send category edit menu to the user."""
-    await event.delete()
+    state = conversations.get(user.id)
+    await outbox.delete(event)
 
     is_owner = await check_ownership(session, user, _, event, uuid)
     if not is_owner:
         return
 
-    user.expectation["expect"] = {"type": "edit_category", "data": uuid.hex()}
-    await session.commit()
+    state["expect"] = {"type": "edit_category", "data": uuid.hex()}
 
-    buttons = [Button.inline(_("category_action_edit_cancel"), b"menu_categories")]
-    await event.respond(_("edit_category_prompt"), buttons=buttons)
+    buttons = [
+        Button.inline(
+            _("category_action_edit_cancel"), encode_callback("menu_categories")
+        )
+    ]
+    await outbox.respond(event, _("edit_category_prompt"), buttons=buttons)
 
 
 def format_component_transaction(transaction: Transaction, _) -> str:
@@ -176,7 +183,7 @@ async def view_menu(session: AsyncSession, user: User, _, event, uuid: bytes) ->
     MAX_TRANSACTIONS_SHOWN = 5
     MAX_ALIASES_SHOWN = 5
 
-    await event.delete()
+    await outbox.delete(event)
 
     is_owner = await check_ownership(session, user, _, event, uuid)
     if not is_owner:
@@ -188,7 +195,7 @@ async def view_menu(session: AsyncSession, user: User, _, event, uuid: bytes) ->
     category = category.scalar_one_or_none()
 
     if category is None:
-        await event.respond(_("category_action_view_not_found_error"))
+        await outbox.respond(event, _("category_action_view_not_found_error"))
         return
 
     # TODO: optimize to only select 5 latest
@@ -207,9 +214,12 @@ async def view_menu(session: AsyncSession, user: User, _, event, uuid: bytes) ->
         category.created_at, tz=timezone.utc
     ).strftime("%Y-%m-%d, %H:%M UTC")
 
-    buttons = [Button.inline(_("universal_back_button"), b"menu_categories")]
+    buttons = [
+        Button.inline(_("universal_back_button"), encode_callback("menu_categories"))
+    ]
     if len(transactions) == 0:
-        await event.respond(
+        await outbox.respond(
+            event,
             _("category_action_view_no_transactions").format(
                 category.icon, category.name, formatted_created_on
             ),
@@ -254,12 +264,12 @@ async def view_menu(session: AsyncSession, user: User, _, event, uuid: bytes) ->
                 len(full_aliases) - MAX_ALIASES_SHOWN
             )
 
-    await event.respond(content, buttons=buttons)
+    await outbox.respond(event, content, buttons=buttons)
 
 
 async def delete_menu(session: AsyncSession, user: User, _, event, uuid: bytes) -> None:
     """Send category delete menu to the user."""
-    await event.delete()
+    await outbox.delete(event)
 
     is_owner = await check_ownership(session, user, _, event, uuid)
     if not is_owner:
@@ -269,10 +279,16 @@ async def delete_menu(session: AsyncSession, user: User, _, event, uuid: bytes)
     name = name.scalar_one_or_none()
 
     buttons = [
-        Button.inline(_("category_action_delete_approve"), "action_cd_" + uuid.hex()),
-        Button.inline(_("category_action_delete_cancel"), b"menu_categories"),
+        Button.inline(
+            _("category_action_delete_approve"), encode_callback("action_cd", uuid)
+        ),
+        Button.inline(
+            _("category_action_delete_cancel"), encode_callback("menu_categories")
+        ),
     ]
-    await event.respond(_("delete_category_prompt").format(name), buttons=buttons)
+    await outbox.respond(
+        event, _("delete_category_prompt").format(name), buttons=buttons
+    )
 
 
 async def send_menu(
@@ -286,16 +302,13 @@ async def send_menu(
     """Send categories menu to the user."""
     CATEGORIES_PER_PAGE = 20
 
-    # TODO: include pagination into a query
-    categories = await session.execute(
-        select(Category)
-        .where(Category.holder == user.id)
-        .where(Category.is_deleted == False)
+    # both counts are answered from partial indexes
+    categories_count = await session.execute(
+        select(func.count())
+        .select_from(Category)
+        .where(Category.holder == user.id, Category.is_deleted == False)
     )
-    categories = categories.scalars().all()
-    categories = sorted(categories, key=lambda x: x.transaction_count, reverse=True)
-
-    categories_count = len(categories)
+    categories_count = categories_count.scalar_one()
 
     del_categories_count = await session.execute(
         select(func.count())
@@ -304,27 +317,37 @@ async def send_menu(
     )
     del_categories_count = del_categories_count.scalar_one()
 
-    if len(categories) == 0:
-        buttons = [Button.inline(_("back_to_main_menu_button"), b"menu_start")]
+    if categories_count == 0:
+        buttons = [
+            Button.inline(_("back_to_main_menu_button"), encode_callback("menu_start"))
+        ]
         if del_categories_count == 0:
-            await event.respond(_("menu_categories_no_categories"), buttons=buttons)
+            await outbox.respond(
+                event, _("menu_categories_no_categories"), buttons=buttons
+            )
         else:
-            await event.respond(
+            await outbox.respond(
+                event,
                 _("menu_categories_only_deleted").format(del_categories_count),
                 buttons=buttons,
             )
         return
 
-    page_count = math.ceil(len(categories) / CATEGORIES_PER_PAGE)
+    page_count = math.ceil(categories_count / CATEGORIES_PER_PAGE)
 
     if page < 1:
         page = 1
     if page > page_count:
         page = page_count
 
-    categories = categories[
-        (page - 1) * CATEGORIES_PER_PAGE : page * CATEGORIES_PER_PAGE
-    ]
+    categories = await session.execute(
+        select(Category)
+        .where(Category.holder == user.id, Category.is_deleted == False)
+        .order_by(Category.transaction_count.desc(), Category.id)
+        .limit(CATEGORIES_PER_PAGE)
+        .offset((page - 1) * CATEGORIES_PER_PAGE)
+    )
+    categories = categories.scalars().all()
 
     category_info = [
         _("menu_categories_component_category_info").format(
@@ -341,38 +364,13 @@ async def send_menu(
             del_categories_count
         )
 
-    # get the id of newly sent message, and then add buttons according to that
-
     pagination_buttons = []
 
     if page_count > 1:
-        pagination_buttons = [
-            Button.inline("◀️", b"none"),
-            Button.inline(f"{page} / {page_count}", b"none"),
-            Button.inline("▶️", b"none"),
-        ]
-
-    buttons = [
-        pagination_buttons,
-        [
-            Button.inline(_("export_button"), b"export_categories"),
-            Button.inline(_("back_to_main_menu_button"), b"menu_start"),
-        ],
-    ]
-    if original_msg is None:
-        message = await event.respond(content, buttons=buttons)
-    else:
-        message = await event.client.edit_message(
-            entity=event.chat_id, message=original_msg, text=content, buttons=buttons
-        )
-
-    pagination_buttons = []
-
-    if page_count > 1:
-        msg_id = str(message.id).encode("utf-8").hex()
-        back_button_data = "page_c_" + msg_id + "_" + str(page - 1)
-        main_button_data = "page_c_" + msg_id
-        forward_button_data = "page_c_" + msg_id + "_" + str(page + 1)
+        # buttons edit the message they are attached to, see callback handler
+        back_button_data = encode_callback("page_c", page - 1)
+        main_button_data = encode_callback("page_c", 0)
+        forward_button_data = encode_callback("page_c", page + 1)
         pagination_buttons = [
             Button.inline("◀️", back_button_data),
             Button.inline(f"{page} / {page_count}", main_button_data),
@@ -382,8 +380,11 @@ async def send_menu(
     buttons = [
         pagination_buttons,
         [
-            Button.inline(_("export_button"), b"export_categories"),
-            Button.inline(_("back_to_main_menu_button"), b"menu_start"),
+            Button.inline(_("export_button"), encode_callback("export_categories")),
+            Button.inline(_("back_to_main_menu_button"), encode_callback("menu_start")),
         ],
     ]
-    await message.edit(content, buttons=buttons)
+    if original_msg is None:
+        await outbox.respond(event, content, buttons=buttons)
+    else:
+        await outbox.edit_message(event, original_msg, content, buttons=buttons)
@@ -0,0 +1,382 @@
+import asyncio
+import os
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+from dateutil import parser
+from loguru import logger
+from rapidfuzz import fuzz, process
+from rapidfuzz.utils import default_process
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from telethon.errors import RPCError
+from telethon.tl.custom import Button
+
+from database.coalescer import write_coalescer
+from database.models import (Category, Transaction, TransactionType, User,
+                             Wallet)
+from helpers.amount_formatter import format_amount
+from helpers.callback_data import encode_callback
+from helpers.chart_cache import bump_data_version
+from helpers.name_index import NameIndex, name_indexes
+from helpers.outbox import outbox
+from menus.transactions import MAX_IMPORT_FILE_SIZE, read_csv, update_totals
+
+# words in header cells of bank statements, checked in order
+DATE_COLUMNS = ("date", "дата")
+DESCRIPTION_COLUMNS = (
+    "description",
+    "details",
+    "payee",
+    "merchant",
+    "memo",
+    "опис",
+    "описание",
+    "призначення",
+    "назначение",
+    "деталі",
+    "детали",
+)
+AMOUNT_COLUMNS = ("amount", "sum", "сума", "сумма")
+# banks put account details above the header, look for it this far
+MAX_HEADER_LINE = 20
+# matches scored lower than this are not categorized
+MIN_CONFIDENCE = 75
+# previews not confirmed within this many seconds are forgotten
+PREVIEW_TTL = 3600
+# categories and uncertain rows listed in the preview
+PREVIEW_CATEGORIES = 10
+PREVIEW_ROWS = 5
+# descriptions are cut to this length in the preview
+PREVIEW_DESCRIPTION_LENGTH = 40
+# descriptions scored at once, bounds the score matrix to this many rows
+MATCH_CHUNK_SIZE = 1024
+
+
+class StatementPreview:
+    """Categorized rows of a statement, waiting for the user to confirm."""
+
+    def __init__(self, wallet_id: bytes, wallet_name: str, rows: list[dict]):
+        self.wallet_id = wallet_id
+        self.wallet_name = wallet_name
+        self.rows = rows  # Transaction columns
+        self.created_at = time.monotonic()
+
+
+# user id -> statement shown to the user, one at a time
+previews: dict[bytes, StatementPreview] = {}
+
+
+def find_columns(row: list[str]) -> tuple[int, int, int] | None:
+    """Return indexes of date, description and amount columns of a header."""
+    cells = [cell.strip().lower() for cell in row]
+    found = []
+    for words in (DATE_COLUMNS, DESCRIPTION_COLUMNS, AMOUNT_COLUMNS):
+        index = next(
+            (
+                i
+                for word in words
+                for i, cell in enumerate(cells)
+                if word in cell and i not in found
+            ),
+            None,
+        )
+        if index is None:
+            return None
+        found.append(index)
+    return found[0], found[1], found[2]
+
+
+def parse_date(value: str) -> datetime:
+    """Parse dates like "2025-02-01", "01.02.2025" or "01/02/2025 10:30".
+
+    The day goes first unless the year does, ISO dates are never swapped.
+    """
+    value = value.strip()
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return parser.parse(value, dayfirst=not value[:4].isdigit())
+
+
+def parse_amount(value: str) -> float | None:
+    """Parse amounts like "-1 234,56", "1,234.56" or "+12.5"."""
+    value = value.replace(" ", "").replace("\xa0", "")
+    if "," in value and "." in value:
+        # the separator that comes first groups thousands
+        thousands = "," if value.index(",") < value.index(".") else "."
+        value = value.replace(thousands, "")
+    try:
+        return float(value.replace(",", "."))
+    except ValueError:
+        return None
+
+
+def categorize(
+    descriptions: list[str], index: NameIndex
+) -> tuple[list[bytes], np.ndarray, np.ndarray]:
+    """Score descriptions against all category names and aliases, by chunks.
+
+    Returns category uuids of the choices, and for every description the
+    choice it matches best and the score of that match.
+    """
+    choices = list(index.processed)
+    uuids = [index.names[name] for name in index.choices]
+    for alias, uuid in index.aliases.items():
+        if uuid in index.by_id:
+            choices.append(default_process(alias))
+            uuids.append(uuid)
+
+    # cores taken from the bot while the statement is matched
+    workers = int(os.getenv("STATEMENT_MATCH_WORKERS", "1"))
+    best = np.empty(len(descriptions), dtype=np.intp)
+    best_scores = np.empty(len(descriptions), dtype=np.uint8)
+    for start in range(0, len(descriptions), MATCH_CHUNK_SIZE):
+        chunk = descriptions[start : start + MATCH_CHUNK_SIZE]
+        scores = process.cdist(
+            [default_process(description) for description in chunk],
+            choices,
+            scorer=fuzz.WRatio,
+            processor=None,
+            dtype=np.uint8,
+            workers=workers,
+        )
+        chunk_best = scores.argmax(axis=1)
+        best[start : start + len(chunk)] = chunk_best
+        best_scores[start : start + len(chunk)] = scores[
+            np.arange(len(chunk)), chunk_best
+        ]
+    return uuids, best, best_scores
+
+
+async def import_statement(session: AsyncSession, user: User, _, event) -> None:
+    """Read a bank statement into the wallet named in the caption, preview it.
+
+    Descriptions are matched to categories and their aliases; transactions
+    are registered only once the user confirms the preview.
+    """
+    if event.file.size > MAX_IMPORT_FILE_SIZE:
+        await outbox.reply(event, _("import_file_too_large"))
+        return
+
+    categories, wallets = await name_indexes.get(session, user.id)
+    # don't hold the writer connection while the file is read
+    await session.commit()
+
+    wallet_name = event.raw_text.strip()
+    wallet = wallets.match(wallet_name)
+    if wallet[0] != "exact":
+        await outbox.reply(event, _("statement_unknown_wallet").format(wallet_name))
+        return
+    if not categories.names:
+        await outbox.reply(event, _("statement_no_categories"))
+        return
+
+    status = await outbox.reply(event, _("import_started"))
+
+    columns = None
+    timestamps: dict[str, int] = {}  # dates repeat a lot, parse each once
+    descriptions: dict[str, int] = {}  # description -> index
+    rows = []  # (timestamp, amount, description index)
+    invalid = 0
+    line = 0
+    try:
+        async for row in read_csv(event):
+            line += 1
+            if columns is None:
+                columns = find_columns(row)
+                if columns is None and line >= MAX_HEADER_LINE:
+                    break
+                continue
+            if not any(row):
+                continue
+
+            try:
+                raw_date, description, raw_sum = (row[i] for i in columns)
+                if raw_date not in timestamps:
+                    timestamp = parse_date(raw_date)
+                    if timestamp.tzinfo is None:
+                        timestamp = timestamp.replace(tzinfo=timezone.utc)
+                    timestamps[raw_date] = int(timestamp.timestamp())
+            except (IndexError, ValueError, OverflowError):
+                invalid += 1
+                continue
+            amount = parse_amount(raw_sum)
+            if amount is None:
+                invalid += 1
+                continue
+
+            description = " ".join(description.split())
+            index = descriptions.setdefault(description, len(descriptions))
+            rows.append((timestamps[raw_date], amount, index))
+    except UnicodeDecodeError:
+        columns = None
+    except RPCError as e:
+        logger.error(e)
+        await outbox.edit(status, _("import_download_failed"))
+        return
+
+    if columns is None:
+        await outbox.edit(status, _("statement_unknown_format"))
+        return
+    if not rows:
+        await outbox.edit(status, _("statement_empty"))
+        return
+
+    # CPU bound, keep the event loop responsive
+    uuids, best, scores = await asyncio.to_thread(
+        categorize, list(descriptions), categories
+    )
+
+    transactions = []
+    uncertain = []  # (score, description, category)
+    totals: dict[bytes, list] = {}  # category -> [count, sum, score sum]
+    names = list(descriptions)
+    skipped = 0
+    for timestamp, amount, index in rows:
+        score = int(scores[index])
+        if score < MIN_CONFIDENCE:
+            skipped += 1
+            continue
+
+        category_id = uuids[best[index]]
+        transactions.append(
+            {
+                "holder": user.id,
+                "datetime": timestamp,
+                "type": TransactionType.INCOME,
+                "wallet_id": wallet[1],
+                "category_id": category_id,
+                "sum": amount,
+                "comment": names[index],
+            }
+        )
+        total = totals.setdefault(category_id, [0, 0.0, 0])
+        total[0] += 1
+        total[1] += amount
+        total[2] += score
+        uncertain.append((score, names[index], categories.by_id[category_id]))
+
+    now = time.monotonic()
+    for user_id, preview in list(previews.items()):
+        if now - preview.created_at > PREVIEW_TTL:
+            del previews[user_id]
+    if transactions:
+        previews[user.id] = StatementPreview(wallet[1], wallet[2], transactions)
+
+    category_info = [
+        _("statement_component_category").format(
+            categories.by_id[uuid],
+            count,
+            format_amount(round(amount, 2)),
+            score // count,
+        )
+        for uuid, (count, amount, score) in sorted(
+            totals.items(), key=lambda item: item[1][0], reverse=True
+        )[:PREVIEW_CATEGORIES]
+    ]
+    uncertain.sort(key=lambda item: item[0])
+    row_info = [
+        _("statement_component_row").format(
+            description[:PREVIEW_DESCRIPTION_LENGTH], category, score
+        )
+        for score, description, category in uncertain[:PREVIEW_ROWS]
+    ]
+
+    buttons = [
+        [
+            Button.inline(
+                _("statement_confirm_button"), encode_callback("statement_confirm")
+            ),
+            Button.inline(
+                _("statement_cancel_button"), encode_callback("statement_cancel")
+            ),
+        ]
+    ]
+    await outbox.edit(
+        status,
+        _("statement_preview").format(
+            len(rows),
+            wallet[2],
+            len(transactions),
+            "\n".join(category_info),
+            "\n".join(row_info),
+            skipped,
+            invalid,
+        ),
+        buttons=buttons if transactions else None,
+    )
+
+
+class StatementOutdated(Exception):
+    """Wallet or some categories of a preview were deleted since it was made."""
+
+
+async def handle_confirm(session: AsyncSession, user: User, _, event) -> None:
+    """Register transactions of the previewed statement.
+
+    All rows are written by a single job along with the recounted totals, so
+    the statement is either registered whole or not at all.
+    """
+    preview = previews.pop(user.id, None)
+    if preview is None or time.monotonic() - preview.created_at > PREVIEW_TTL:
+        await outbox.edit(event, _("statement_preview_expired"))
+        return
+
+    await outbox.edit(event, _("import_started"))
+
+    category_ids = {row["category_id"] for row in preview.rows}
+    batch_size = int(os.getenv("IMPORT_BATCH_SIZE", "500"))
+
+    async def write(batch_session: AsyncSession):
+        wallet = await batch_session.execute(
+            select(Wallet.id).where(
+                Wallet.id == preview.wallet_id,
+                Wallet.holder == user.id,
+                Wallet.is_deleted == False,
+            )
+        )
+        categories = await batch_session.execute(
+            select(Category.id).where(
+                Category.id.in_(category_ids),
+                Category.holder == user.id,
+                Category.is_deleted == False,
+            )
+        )
+        if wallet.first() is None or set(categories.scalars()) != category_ids:
+            raise StatementOutdated()
+
+        for i in range(0, len(preview.rows), batch_size):
+            await batch_session.execute(
+                insert(Transaction), preview.rows[i : i + batch_size]
+            )
+        await update_totals(batch_session, user, {preview.wallet_id}, category_ids)
+
+    try:
+        await write_coalescer.submit(write)
+    except StatementOutdated:
+        await outbox.edit(event, _("statement_preview_outdated"))
+        return
+    except Exception as e:
+        logger.error(e)
+        await outbox.edit(
+            event,
+            _("statement_import_failed").format(
+                "@" + os.getenv("SUPPORT_USERNAME", "[not specified]")
+            ),
+        )
+        return
+
+    bump_data_version(user)
+    await session.commit()
+    await outbox.edit(
+        event,
+        _("statement_imported").format(len(preview.rows), preview.wallet_name),
+    )
+
+
+async def handle_cancel(session: AsyncSession, user: User, _, event) -> None:
+    """Forget the previewed statement."""
+    previews.pop(user.id, None)
+    await outbox.edit(event, _("statement_import_cancelled"))
@@ -1,39 +1,129 @@
+import asyncio
+import io
 import os
 
 from loguru import logger
 from sqlalchemy.ext.asyncio import AsyncSession
 from telethon import events
+from telethon.errors import (BadRequestError, FileReferenceEmptyError,
+                             FileReferenceExpiredError,
+                             FileReferenceInvalidError, MediaEmptyError)
 
 from database.models import User
-from helpers.stats import get_balance_history, get_category_pie_charts
+from helpers import charts
+from helpers.chart_cache import CachedChart, chart_cache, chart_key
+from helpers.outbox import outbox
+from helpers.render_pool import RenderCancelled, RenderQueueFull, render_pool
+from helpers.stats import get_balance_history, get_category_distribution
+
+# Telegram no longer accepts media sent before
+STALE_MEDIA_ERRORS = (
+    FileReferenceEmptyError,
+    FileReferenceExpiredError,
+    FileReferenceInvalidError,
+    MediaEmptyError,
+)
+
+
+def to_file(name: str, chart: CachedChart) -> io.BytesIO:
+    file = io.BytesIO(chart.data)
+    file.name = name
+    return file
+
+
+async def send_charts(event, cached: dict[str, CachedChart], **kwargs) -> None:
+    """Send cached charts, by their file names, as one album.
+
+    Charts sent before are sent by reference to the media Telegram already
+    has, only new ones are uploaded. If Telegram refuses a reference, all
+    charts are uploaded again.
+    """
+    files = [
+        chart.media if chart.media is not None else to_file(name, chart)
+        for name, chart in cached.items()
+    ]
+    try:
+        messages = await outbox.send_file(event, files, **kwargs)
+    except BadRequestError as e:
+        # references expire after a while; in albums Telegram reports
+        #  them as FILE_REFERENCE_<index>_EXPIRED
+        stale = isinstance(e, STALE_MEDIA_ERRORS) or "FILE_REFERENCE" in e.message
+        if not stale or all(chart.media is None for chart in cached.values()):
+            raise
+        logger.info(f"Uploading charts again, cached media was refused: {e}")
+        files = [to_file(name, chart) for name, chart in cached.items()]
+        messages = await outbox.send_file(event, files, **kwargs)
+
+    for chart, message in zip(cached.values(), messages):
+        chart.media = message.media
 
 
-# [TODO: wrap matplotlib in executor for async]
 async def send_menu(
     session: AsyncSession, user: User, _, event: events.NewMessage.Event
 ) -> None:
     """Send stats menu to the user with generated charts."""
-    status_msg = await event.reply(_("stats_waiting"))
+    status_msg = await outbox.reply(event, _("stats_waiting"))
 
     reply_id = getattr(event, "message_id", None) or event.id
 
     try:
-        balance_chart = await get_balance_history(_, session, user.id)
-        pie_chart = await get_category_pie_charts(_, session, user.id)
+        profile = charts.PROFILES[render_pool.profile]
+        balance_key = chart_key(user, "balance_history", render_pool.profile)
+        pie_key = chart_key(user, "category_pie_charts", render_pool.profile)
+        balance = chart_cache.get(balance_key)
+        pie = chart_cache.get(pie_key)
+
+        if balance is None or pie is None:
+            balance_data = await get_balance_history(_, session, user.id)
+            distribution_data = await get_category_distribution(_, session, user.id)
+            # don't hold the connection while the charts are drawn
+            await session.commit()
+
+            # a new event of the user cancels these, see handlers
+            balance_image, pie_image = await asyncio.gather(
+                render_pool.render(
+                    event.sender_id,
+                    charts.render_balance_history,
+                    balance_data,
+                    render_pool.profile,
+                ),
+                render_pool.render(
+                    event.sender_id,
+                    charts.render_category_pie_charts,
+                    distribution_data,
+                    render_pool.profile,
+                ),
+            )
+            balance = chart_cache.put(balance_key, balance_image)
+            pie = chart_cache.put(pie_key, pie_image)
 
-        await event.client.send_file(
-            event.chat_id,
-            file=[balance_chart, pie_chart],
+        await send_charts(
+            event,
+            {
+                f"balance_history.{profile.extension}": balance,
+                f"category_pie_charts.{profile.extension}": pie,
+            },
             caption=_("stats_caption"),
             reply_to=reply_id,
+            force_document=profile.document,
         )
 
-        await status_msg.delete()
+        await outbox.delete(status_msg)
+
+    except RenderCancelled:
+        await outbox.delete(status_msg)
+
+    except RenderQueueFull:
+        # the other chart is of no use alone
+        render_pool.cancel(event.sender_id)
+        await outbox.edit(status_msg, _("stats_busy_error"))
 
     except Exception as e:
         logger.error(e)
-        await status_msg.edit(
+        render_pool.cancel(event.sender_id)
+        await outbox.edit(
+            status_msg,
             _("stats_generation_error").format(
                 "@" + os.getenv("SUPPORT_USERNAME", "[not specified]")
-            )
+            ),
         )
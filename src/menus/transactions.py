@@ -1,20 +1,44 @@
+import asyncio
 import calendar
+import codecs
 import csv
 import math
 import os
+import time
 from datetime import date, datetime, timezone
 from io import BytesIO, StringIO
 
 from dateutil import parser
-from sqlalchemy import and_, select, update
+from loguru import logger
+from sqlalchemy import and_, delete, func, insert, select, update
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload
-from telethon.errors.rpcerrorlist import MessageIdInvalidError
+from telethon import events
+from telethon.errors import RPCError
+from telethon.errors.rpcerrorlist import FloodWaitError, MessageIdInvalidError
 from telethon.tl.custom import Button
 
-from database.models import Transaction, User
+from database.coalescer import write_coalescer
+from database.conversation import conversations
+from database.models import (Category, Transaction, TransactionType, User,
+                             Wallet)
 from handlers.transaction import register_transaction
 from helpers.amount_formatter import format_amount
+from helpers.callback_data import encode_callback
+from helpers.chart_cache import bump_data_version
+from helpers.name_index import name_indexes
+from helpers.outbox import Priority, outbox
+
+# columns of exported (and importable) transactions
+EXPORT_COLUMNS = ["created_at", "wallet", "category", "sum", "currency"]
+# separators of csv files, exports use the first one
+CSV_DELIMITERS = ",;\t"
+# files are downloaded for import, refuse unreasonably large ones
+MAX_IMPORT_FILE_SIZE = 20 * 1024 * 1024
+# seconds between edits of the import status message
+PROGRESS_INTERVAL = 2
+# skipped rows listed in the import summary
+MAX_REPORTED_ERRORS = 10
 
 
 def parse_time(s: str) -> float | None:
@@ -58,32 +82,46 @@ def get_month_name(_, month_index: int) -> str:
     return _(f"month_{month_index}")
 
 
-async def delete_transaction(session, uuid):
-    """Deletes a transaction by UUID and adjusts Wallet data"""
-    stmt = (
-        select(Transaction)
+async def delete_transaction(session, user, uuid):
+    """Deletes a transaction by UUID and adjusts Wallet and Category data"""
+    result = await session.execute(
+        delete(Transaction)
         .where(Transaction.id == uuid)
-        .options(selectinload(Transaction.wallet))
+        .returning(Transaction.wallet_id, Transaction.category_id, Transaction.sum)
     )
-    txn_result = await session.execute(stmt)
-    old_transaction = txn_result.scalar_one_or_none()
-
-    if old_transaction and old_transaction.wallet:
-        old_transaction.wallet.current_sum -= old_transaction.sum
-        old_transaction.wallet.transaction_count -= 1
-        await session.delete(old_transaction)
+    old_transaction = result.one_or_none()
+
+    if old_transaction:
+        wallet_id, category_id, amount = old_transaction
+        await session.execute(
+            update(Wallet)
+            .where(Wallet.id == wallet_id)
+            .values(
+                current_sum=Wallet.current_sum - amount,
+                transaction_count=Wallet.transaction_count - 1,
+            )
+            .execution_options(synchronize_session=False)
+        )
+        await session.execute(
+            update(Category)
+            .where(Category.id == category_id)
+            .values(transaction_count=Category.transaction_count - 1)
+            .execution_options(synchronize_session=False)
+        )
 
+    bump_data_version(user)
     await session.commit()
 
 
 async def handle_expectation_edit_transaction(
     session: AsyncSession, user: User, _, event
 ):
-    uuid = bytes.fromhex(user.expectation["expect"]["data"])
+    state = conversations.get(user.id)
+    uuid = bytes.fromhex(state["expect"]["data"])
     raw_text = event.raw_text
 
     if raw_text == "":
-        await event.respond(_("got_empty_message_for_transaction"))
+        await outbox.respond(event, _("got_empty_message_for_transaction"))
         return
 
     old_txn_result = await session.execute(
@@ -92,13 +130,13 @@ async def handle_expectation_edit_transaction(
     old_transaction = old_txn_result.scalar_one_or_none()
 
     if not old_transaction:
-        await event.respond(_("transaction_action_view_not_found_error"))
+        await outbox.respond(event, _("transaction_action_view_not_found_error"))
         return
 
     saved_datetime = old_transaction.datetime
     parts = event.raw_text.split()
     if len(parts) < 3:
-        await event.respond(_("info_omitted_for_transaction_error"))
+        await outbox.respond(event, _("info_omitted_for_transaction_error"))
         return
 
     raw_sum, category, wallet = parts[:3]
@@ -106,11 +144,11 @@ async def handle_expectation_edit_transaction(
     try:
         sum_val = float(raw_sum.replace(",", "."))
     except ValueError:
-        await event.respond(_("non_numerical_sum_error"))
+        await outbox.respond(event, _("non_numerical_sum_error"))
         return
 
     if raw_sum[0] not in "+-":
-        await event.respond(_("no_sign_specified_for_sum"))
+        await outbox.respond(event, _("no_sign_specified_for_sum"))
         return
 
     result = await register_transaction(
@@ -124,22 +162,23 @@ async def handle_expectation_edit_transaction(
     )
 
     if result:
-        await delete_transaction(session, uuid)
+        await delete_transaction(session, user, uuid)
 
 
 async def handle_expectation_reschedule_transaction(
     session: AsyncSession, user: User, _, event
 ):
-    uuid = bytes.fromhex(user.expectation["expect"]["data"])
+    state = conversations.get(user.id)
+    uuid = bytes.fromhex(state["expect"]["data"])
     raw_text = event.raw_text
 
     if raw_text == "":
-        await event.respond(_("got_empty_message_for_transaction_time"))
+        await outbox.respond(event, _("got_empty_message_for_transaction_time"))
         return
 
     new_timestamp = parse_time(raw_text)
     if new_timestamp is None:
-        await event.respond(_("could_not_parse_transaction_time"))
+        await outbox.respond(event, _("could_not_parse_transaction_time"))
         return
 
     new_timestamp_formatted = datetime.fromtimestamp(
@@ -149,17 +188,21 @@ async def handle_expectation_reschedule_transaction(
     await session.execute(
         update(Transaction).where(Transaction.id == uuid).values(datetime=new_timestamp)
     )
+    bump_data_version(user)
     await session.commit()
 
-    buttons = [Button.inline(_("universal_back_button"), b"menu_transactions")]
-    await event.reply(
+    buttons = [
+        Button.inline(_("universal_back_button"), encode_callback("menu_transactions"))
+    ]
+    await outbox.reply(
+        event,
         _("transaction_rescheduled").format(*map(str, [new_timestamp_formatted])),
         buttons=buttons,
     )
 
 
 async def export(session: AsyncSession, event, user: User, _):
-    await event.respond(_("export_started"))
+    await outbox.respond(event, _("export_started"))
 
     result = await session.execute(
         select(Transaction)
@@ -170,7 +213,7 @@ async def export(session: AsyncSession, event, user: User, _):
 
     csv_buffer = StringIO()
     writer = csv.writer(csv_buffer)
-    writer.writerow(["created_at", "wallet", "category", "sum", "currency"])
+    writer.writerow(EXPORT_COLUMNS)
 
     for transaction in transactions:
         created_at = datetime.utcfromtimestamp(transaction.datetime).isoformat()
@@ -188,40 +231,255 @@ async def export(session: AsyncSession, event, user: User, _):
     today = datetime.utcnow().strftime("%Y-%m-%d")
     csv_bytes.name = f"export_transactions_{today}.csv"
 
-    await event.respond(_("export_transactions_caption"), file=csv_bytes)
+    await outbox.respond(
+        event, _("export_transactions_caption"), file=csv_bytes, priority=Priority.MEDIA
+    )
 
 
-async def handle_action(
-    session: AsyncSession, event, user: User, data: list, _
-) -> None:
-    """Handle user pressing a button under one of the action menus."""
+async def download(event):
+    """Yield chunks of the document of event, waiting out FloodWaits.
+
+    Downloads don't go through the outbox, and the client raises every
+    FloodWait (see main.py); the download resumes where it stopped. Waits
+    longer than OUTBOX_MAX_FLOOD_WAIT are raised.
+    """
+    max_wait = int(os.getenv("OUTBOX_MAX_FLOOD_WAIT", "300"))
+    offset = 0
+    while True:
+        try:
+            async for chunk in event.client.iter_download(
+                event.message.media, offset=offset
+            ):
+                offset += len(chunk)
+                yield chunk
+            return
+        except FloodWaitError as e:
+            if e.seconds > max_wait:
+                raise
+            logger.warning(f"FloodWait of {e.seconds}s while downloading a file")
+            await asyncio.sleep(e.seconds)
+
+
+async def read_csv(event):
+    """Yield rows of the csv document of event while it is downloaded.
+
+    The delimiter is the one of CSV_DELIMITERS found most in the first line.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    delimiter = None
+    tail = ""
+    async for chunk in download(event):
+        lines = (tail + decoder.decode(chunk)).split("\n")
+        # the last line may continue in the next chunk
+        tail = lines.pop()
+        if lines and delimiter is None:
+            delimiter = max(CSV_DELIMITERS, key=lines[0].count)
+        for row in csv.reader(lines, delimiter=delimiter or ","):
+            yield row
+
+    tail += decoder.decode(b"", final=True)
+    if tail:
+        if delimiter is None:
+            delimiter = max(CSV_DELIMITERS, key=tail.count)
+        for row in csv.reader([tail], delimiter=delimiter):
+            yield row
+
+
+async def import_csv(session: AsyncSession, user: User, _, event) -> None:
+    """Import transactions from a csv file in the export format.
+
+    Rows are inserted in batches of IMPORT_BATCH_SIZE as the file is read;
+    balances and counters of the affected wallets and categories are
+    recomputed once at the end. Rows with unknown names are skipped.
+    """
+    if event.file.size > MAX_IMPORT_FILE_SIZE:
+        await outbox.reply(event, _("import_file_too_large"))
+        return
+
+    batch_size = int(os.getenv("IMPORT_BATCH_SIZE", "500"))
+    status = await outbox.reply(event, _("import_started"))
 
-    if data[1][1] == "d":
-        uuid = bytes.fromhex(data[2])
+    categories, wallets = await name_indexes.get(session, user.id)
+    # don't hold the writer connection while the file is read
+    await session.commit()
 
-        # fetch transaction first to get the date for menu context
-        stmt = select(Transaction).where(Transaction.id == uuid)
-        res = await session.execute(stmt)
-        txn = res.scalar_one_or_none()
+    # name -> uuid (None if unknown), so every name is matched once
+    category_ids: dict[str, bytes | None] = {}
+    wallet_ids: dict[str, bytes | None] = {}
 
-        saved_year = None
-        saved_month = None
-        if txn:
-            dt = datetime.fromtimestamp(txn.datetime, tz=timezone.utc)
-            saved_year = dt.year
-            saved_month = dt.month
+    def resolve(index, cache: dict, name: str) -> bytes | None:
+        if name not in cache:
+            match = index.match(name)
+            cache[name] = match[1] if match[0] == "exact" else None
+        return cache[name]
 
-        await delete_transaction(session, uuid)
+    async def insert_batch(rows: list[dict]) -> None:
+        async def write(batch_session: AsyncSession):
+            await batch_session.execute(insert(Transaction), rows)
 
-        await event.edit(_("transaction_deleted_succesfully"))
+        await write_coalescer.submit(write)
 
-        # return to the specific year/month view
-        await send_menu(session, user, _, event, year=saved_year, month=saved_month)
+    imported = 0
+    errors = []
+    batch: list[dict] = []
+    last_progress = time.monotonic()
+    line = 0
 
-    else:
-        raise Exception(
-            'Got unexpected data for callback command "action" (transactions)'
+    try:
+        async for row in read_csv(event):
+            line += 1
+            if line == 1:
+                if [column.strip() for column in row] != EXPORT_COLUMNS:
+                    await outbox.edit(status, _("import_wrong_format"))
+                    return
+                continue
+            if not row:
+                continue
+
+            try:
+                created_at, wallet, category, raw_sum, _currency = row
+                timestamp = datetime.fromisoformat(created_at)
+                if timestamp.tzinfo is None:
+                    timestamp = timestamp.replace(tzinfo=timezone.utc)
+                amount = float(raw_sum)
+            except ValueError:
+                errors.append(_("import_error_invalid_row").format(line))
+                continue
+
+            category_id = resolve(categories, category_ids, category)
+            wallet_id = resolve(wallets, wallet_ids, wallet)
+            if category_id is None:
+                errors.append(_("bulk_error_unknown_category").format(line, category))
+            if wallet_id is None:
+                errors.append(_("bulk_error_unknown_wallet").format(line, wallet))
+            if category_id is None or wallet_id is None:
+                continue
+
+            batch.append(
+                {
+                    "holder": user.id,
+                    "datetime": int(timestamp.timestamp()),
+                    "type": TransactionType.INCOME,
+                    "wallet_id": wallet_id,
+                    "category_id": category_id,
+                    "sum": amount,
+                }
+            )
+            if len(batch) >= batch_size:
+                await insert_batch(batch)
+                imported += len(batch)
+                batch = []
+
+                if time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+                    last_progress = time.monotonic()
+                    await outbox.edit(
+                        status,
+                        _("import_progress").format(imported),
+                        priority=Priority.BACKGROUND,
+                    )
+
+        if batch:
+            await insert_batch(batch)
+            imported += len(batch)
+    except UnicodeDecodeError:
+        await outbox.edit(status, _("import_wrong_format"))
+        return
+    except RPCError as e:
+        logger.error(e)
+        await outbox.edit(status, _("import_download_failed"))
+        return
+    finally:
+        if imported:
+            await recount_totals(
+                user,
+                {uuid for uuid in wallet_ids.values() if uuid is not None},
+                {uuid for uuid in category_ids.values() if uuid is not None},
+            )
+            # after the rows are committed, see register_transaction
+            bump_data_version(user)
+            await session.commit()
+
+    skipped = len(errors)
+    if len(errors) > MAX_REPORTED_ERRORS:
+        errors = errors[:MAX_REPORTED_ERRORS] + [
+            _("import_more_errors").format(len(errors) - MAX_REPORTED_ERRORS)
+        ]
+    await outbox.edit(
+        status, _("import_finished").format(imported, skipped, "\n".join(errors))
+    )
+
+
+async def update_totals(
+    session: AsyncSession, user: User, wallet_ids: set[bytes], category_ids: set[bytes]
+) -> None:
+    """Recompute balances and counters of wallets and categories from scratch.
+
+    Runs in the given session, for writes that recount in the same job.
+    """
+    wallet_transactions = select(Transaction).where(Transaction.wallet_id == Wallet.id)
+    category_transactions = select(Transaction).where(
+        Transaction.category_id == Category.id
+    )
+
+    await session.execute(
+        update(Wallet)
+        .where(Wallet.holder == user.id, Wallet.id.in_(wallet_ids))
+        .values(
+            current_sum=wallet_transactions.with_only_columns(
+                func.coalesce(func.sum(Transaction.sum), 0)
+            ).scalar_subquery(),
+            transaction_count=wallet_transactions.with_only_columns(
+                func.count()
+            ).scalar_subquery(),
+        )
+        .execution_options(synchronize_session=False)
+    )
+    await session.execute(
+        update(Category)
+        .where(Category.holder == user.id, Category.id.in_(category_ids))
+        .values(
+            transaction_count=category_transactions.with_only_columns(
+                func.count()
+            ).scalar_subquery()
         )
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def recount_totals(
+    user: User, wallet_ids: set[bytes], category_ids: set[bytes]
+) -> None:
+    """Recompute balances and counters of wallets and categories from scratch."""
+
+    async def write(session: AsyncSession):
+        await update_totals(session, user, wallet_ids, category_ids)
+
+    await write_coalescer.submit(write)
+
+
+async def handle_delete(
+    session: AsyncSession, user: User, _, event, uuid: bytes
+) -> None:
+    """Handle user approving deletion of a transaction."""
+
+    # fetch transaction first to get the date for menu context
+    stmt = select(Transaction).where(Transaction.id == uuid)
+    res = await session.execute(stmt)
+    txn = res.scalar_one_or_none()
+
+    saved_year = None
+    saved_month = None
+    if txn:
+        dt = datetime.fromtimestamp(txn.datetime, tz=timezone.utc)
+        saved_year = dt.year
+        saved_month = dt.month
+
+    await delete_transaction(session, user, uuid)
+
+    await outbox.edit(event, _("transaction_deleted_succesfully"))
+
+    # return to the specific year/month view
+    await send_menu(session, user, _, event, year=saved_year, month=saved_month)
 
 
 async def check_ownership(
@@ -235,12 +493,12 @@ async def check_ownership(
     if transaction:
         return True
     else:
-        await event.respond(_("transaction_action_ownership_check_failed"))
+        await outbox.respond(event, _("transaction_action_ownership_check_failed"))
         return False
 
 
 async def view_menu(session: AsyncSession, user: User, _, event, uuid: bytes) -> None:
-    await event.delete()
+    await outbox.delete(event)
 
     is_owner = await check_ownership(session, user, _, event, uuid)
     if not is_owner:
@@ -254,7 +512,7 @@ async def view_menu(session: AsyncSession, user: User, _, event, uuid: bytes) ->
     transaction = transaction.scalar_one_or_none()
 
     if transaction is None:
-        await event.respond(_("transaction_action_view_not_found_error"))
+        await outbox.respond(event, _("transaction_action_view_not_found_error"))
         return
 
     formatted_datetime = datetime.fromtimestamp(
@@ -268,8 +526,11 @@ async def view_menu(session: AsyncSession, user: User, _, event, uuid: bytes) ->
     else:
         emoji_indicator = "🟨"
 
-    buttons = [Button.inline(_("universal_back_button"), b"menu_transactions")]
-    await event.respond(
+    buttons = [
+        Button.inline(_("universal_back_button"), encode_callback("menu_transactions"))
+    ]
+    await outbox.respond(
+        event,
         _("transaction_action_view").format(
             os.getenv("BOT_USERNAME"),
             emoji_indicator,
@@ -287,43 +548,60 @@ async def view_menu(session: AsyncSession, user: User, _, event, uuid: bytes) ->
 
 
 async def edit_menu(session: AsyncSession, user: User, _, event, uuid: bytes) -> None:
-    await event.delete()
+    state = conversations.get(user.id)
+    await outbox.delete(event)
     is_owner = await check_ownership(session, user, _, event, uuid)
     if not is_owner:
         return
-    user.expectation["expect"] = {"type": "edit_transaction", "data": uuid.hex()}
-    await session.commit()
-    buttons = [Button.inline(_("transaction_action_edit_cancel"), b"menu_transactions")]
-    await event.respond(_("edit_transaction_prompt"), buttons=buttons)
+    state["expect"] = {"type": "edit_transaction", "data": uuid.hex()}
+    buttons = [
+        Button.inline(
+            _("transaction_action_edit_cancel"), encode_callback("menu_transactions")
+        )
+    ]
+    await outbox.respond(event, _("edit_transaction_prompt"), buttons=buttons)
 
 
 async def reschedule_menu(
     session: AsyncSession, user: User, _, event, uuid: bytes
 ) -> None:
-    await event.delete()
+    state = conversations.get(user.id)
+    await outbox.delete(event)
     is_owner = await check_ownership(session, user, _, event, uuid)
     if not is_owner:
         return
-    user.expectation["expect"] = {"type": "reschedule_transaction", "data": uuid.hex()}
-    await session.commit()
+    state["expect"] = {"type": "reschedule_transaction", "data": uuid.hex()}
     buttons = [
-        Button.inline(_("transaction_action_reschedule_cancel"), b"menu_transactions")
+        Button.inline(
+            _("transaction_action_reschedule_cancel"),
+            encode_callback("menu_transactions"),
+        )
     ]
-    await event.respond(_("reschedule_transaction_prompt"), buttons=buttons)
+    await outbox.respond(event, _("reschedule_transaction_prompt"), buttons=buttons)
 
 
 async def delete_menu(session: AsyncSession, user: User, _, event, uuid: bytes) -> None:
-    await event.delete()
+    await outbox.delete(event)
     is_owner = await check_ownership(session, user, _, event, uuid)
     if not is_owner:
         return
     buttons = [
         Button.inline(
-            _("transaction_action_delete_approve"), "action_td_" + uuid.hex()
+            _("transaction_action_delete_approve"), encode_callback("action_td", uuid)
+        ),
+        Button.inline(
+            _("transaction_action_delete_cancel"), encode_callback("menu_transactions")
         ),
-        Button.inline(_("transaction_action_delete_cancel"), b"menu_transactions"),
     ]
-    await event.respond(_("delete_transaction_prompt"), buttons=buttons)
+    await outbox.respond(event, _("delete_transaction_prompt"), buttons=buttons)
+
+
+async def _show(event, text: str, buttons) -> None:
+    """Edit the message with the pressed button, or send a new one."""
+    if isinstance(event, events.CallbackQuery.Event):
+        await outbox.edit(event, text, buttons=buttons)
+    else:
+        await outbox.respond(event, text, buttons=buttons)
 
 
 async def _render_year_selection(event, years, _):
@@ -331,18 +609,22 @@ async def _render_year_selection(event, years, _):
     buttons = []
     row = []
     for year in years:
-        row.append(Button.inline(str(year), f"menu_transactions_{year}".encode()))
+        row.append(
+            Button.inline(str(year), encode_callback("menu_transactions_year", year))
+        )
         if len(row) == 3:
             buttons.append(row)
             row = []
     if row:
         buttons.append(row)
 
-    buttons.append([Button.inline(_("back_to_main_menu_button"), b"menu_start")])
+    buttons.append(
+        [Button.inline(_("back_to_main_menu_button"), encode_callback("menu_start"))]
+    )
     try:
-        await event.edit(_("menu_transactions_select_year"), buttons=buttons)
+        await _show(event, _("menu_transactions_select_year"), buttons)
     except MessageIdInvalidError:
-        await event.respond(_("menu_transactions_select_year"), buttons=buttons)
+        await outbox.respond(event, _("menu_transactions_select_year"), buttons=buttons)
 
 
 async def _render_month_selection(event, year, months, _, has_multiple_years=False):
@@ -352,7 +634,9 @@ async def _render_month_selection(event, year, months, _, has_multiple_years=Fal
     for month in months:
         month_name = get_month_name(_, month)
         row.append(
-            Button.inline(month_name, f"menu_transactions_{year}_{month}".encode())
+            Button.inline(
+                month_name, encode_callback("menu_transactions_month", year, month)
+            )
         )
         if len(row) == 3:
             buttons.append(row)
@@ -361,12 +645,12 @@ async def _render_month_selection(event, year, months, _, has_multiple_years=Fal
         buttons.append(row)
 
     if has_multiple_years:
-        back_data = b"menu_transactions"
+        back_data = encode_callback("menu_transactions")
     else:
-        back_data = b"menu_start"
+        back_data = encode_callback("menu_start")
 
     buttons.append([Button.inline(_("universal_back_button"), back_data)])
-    await event.edit(_("menu_transactions_select_month").format(year), buttons=buttons)
+    await _show(event, _("menu_transactions_select_month").format(year), buttons)
 
 
 async def send_menu(
@@ -387,8 +671,12 @@ async def send_menu(
     timestamps = result.scalars().all()
 
     if not timestamps:
-        buttons = [Button.inline(_("back_to_main_menu_button"), b"menu_start")]
-        await event.respond(_("menu_transactions_no_transactions"), buttons=buttons)
+        buttons = [
+            Button.inline(_("back_to_main_menu_button"), encode_callback("menu_start"))
+        ]
+        await outbox.respond(
+            event, _("menu_transactions_no_transactions"), buttons=buttons
+        )
         return
 
     # Build structure: {2023: {1, 2}, 2024: {5, 6}}
@@ -406,13 +694,7 @@ async def send_menu(
     # 2. Logic: Resolve Year
     if year is None:
         if has_multiple_years:
-            if hasattr(event, "edit"):
-                await _render_year_selection(event, sorted_years, _)
-            else:
-                msg = await event.respond(
-                    "..."
-                )  # [TODO: localize? does this ever happen?]
-                await _render_year_selection(msg, sorted_years, _)
+            await _render_year_selection(event, sorted_years, _)
             return
         else:
             year = sorted_years[0]
@@ -423,9 +705,8 @@ async def send_menu(
 
     if month is None:
         if has_multiple_months:
-            target = event if hasattr(event, "edit") else (await event.respond("..."))
             await _render_month_selection(
-                target, year, available_months, _, has_multiple_years
+                event, year, available_months, _, has_multiple_years
             )
             return
         else:
@@ -502,47 +783,37 @@ async def send_menu(
     )
 
     if has_multiple_months:
-        back_data = f"menu_transactions_{year}".encode()
+        back_data = encode_callback("menu_transactions_year", year)
     elif has_multiple_years:
-        back_data = b"menu_transactions"
+        back_data = encode_callback("menu_transactions")
     else:
-        back_data = b"menu_start"
+        back_data = encode_callback("menu_start")
 
     pagination_buttons = []
 
+    if page_count > 1:
+        # embed Year and Month in the callback data so context is preserved
+        # middle button uses page 0 instead of page number to trigger input
+        # buttons edit the message they are attached to, see callback handler
+        back_p = encode_callback("page_t", page - 1, year, month)
+        main_p = encode_callback("page_t", 0, year, month)
+        next_p = encode_callback("page_t", page + 1, year, month)
+
+        pagination_buttons = [
+            Button.inline("◀️", back_p),
+            Button.inline(f"{page} / {page_count}", main_p),
+            Button.inline("▶️", next_p),
+        ]
+
     buttons = [
-        [],
+        pagination_buttons,
         [
-            Button.inline(_("export_button"), b"export_transactions"),
+            Button.inline(_("export_button"), encode_callback("export_transactions")),
             Button.inline(_("universal_back_button"), back_data),
         ],
     ]
 
     if original_msg is None:
-        if hasattr(event, "edit"):
-            message = await event.edit(content, buttons=buttons)
-        else:
-            message = await event.respond(content, buttons=buttons)
+        await _show(event, content, buttons)
     else:
-        message = await event.client.edit_message(
-            entity=event.chat_id, message=original_msg, text=content, buttons=buttons
-        )
-
-    if page_count > 1:
-        msg_id = str(message.id).encode("utf-8").hex()
-        # embed Year and Month in the callback data so context is preserved
-        # new format: page_t_MSGID_PAGE_YEAR_MONTH
-        # middle button uses 'beam' keyword instead of page number to trigger input
-        base_data = f"page_t_{msg_id}"
-
-        back_p = f"{base_data}_{page - 1}_{year}_{month}"
-        main_p = f"{base_data}_beam_{year}_{month}"
-        next_p = f"{base_data}_{page + 1}_{year}_{month}"
-
-        pagination_buttons = [
-            Button.inline("◀️", back_p.encode()),
-            Button.inline(f"{page} / {page_count}", main_p.encode()),
-            Button.inline("▶️", next_p.encode()),
-        ]
-        buttons[0] = pagination_buttons
-        await message.edit(content, buttons=buttons)
+        await outbox.edit_message(event, original_msg, content, buttons=buttons)
@@ -10,8 +10,13 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload
 from telethon.tl.custom import Button
 
+from database.conversation import conversations
 from database.models import Transaction, User, Wallet, WalletAlias
 from helpers.amount_formatter import format_amount
+from helpers.callback_data import encode_callback
+from helpers.chart_cache import bump_data_version
+from helpers.name_index import name_indexes
+from helpers.outbox import Priority, outbox
 
 with open("src/assets/currency_codes.json", "r", encoding="utf-7") as f:
     currency_data = json.load(f)
@@ -20,11 +25,12 @@ with open("src/assets/currency_codes.json", "r", encoding="utf-7") as f:
 
 async def handle_expectation_edit_wallet(session: AsyncSession, user: User, _, event):
     """Handle edit_wallet expectation."""
-    uuid = bytes.fromhex(user.expectation["expect"]["data"])
+    state = conversations.get(user.id)
+    uuid = bytes.fromhex(state["expect"]["data"])
     raw_text = event.raw_text
 
     if raw_text == "":
-        await event.respond(_("got_empty_message_for_wallet"))
+        await outbox.respond(event, _("got_empty_message_for_wallet"))
         return
 
     parts = raw_text.split()
@@ -33,11 +39,11 @@ async def handle_expectation_edit_wallet(session: AsyncSession, user: User, _, e
     name = parts[2] if len(parts) > 2 else None
 
     if name is None:
-        await event.respond(_("unspecified_wallet_name_error"))
+        await outbox.respond(event, _("unspecified_wallet_name_error"))
         return
 
     if currency.upper() not in ALLOWED_CURRENCIES:
-        await event.respond(_("unsupported_currency_error").format(currency))
+        await outbox.respond(event, _("unsupported_currency_error").format(currency))
         return
 
     currency = currency.upper()
@@ -45,7 +51,7 @@ async def handle_expectation_edit_wallet(session: AsyncSession, user: User, _, e
     try:
         init_sum = float(init_sum.replace(",", "."))
     except ValueError:
-        await event.respond(_("non_numerical_init_sum_error"))
+        await outbox.respond(event, _("non_numerical_init_sum_error"))
         return
 
     # name uniqueness check
@@ -58,7 +64,7 @@ async def handle_expectation_edit_wallet(session: AsyncSession, user: User, _, e
     )
     wallets = wallets.scalars().all()
     if len(wallets) != 0:
-        await event.respond(_("non_unique_wallet_name_error"))
+        await outbox.respond(event, _("non_unique_wallet_name_error"))
         return
 
     # delete matching aliases (same name)
@@ -77,22 +83,24 @@ async def handle_expectation_edit_wallet(session: AsyncSession, user: User, _, e
         wallet.name = name
         wallet.currency = currency
         wallet.init_sum = init_sum
+        bump_data_version(user)
         await session.commit()
+        name_indexes.invalidate(user.id)
         await session.refresh(wallet)
-        await event.respond(
+        await outbox.respond(
+            event,
             _("wallet_edited_successfully").format(
                 name, currency, format_amount(init_sum)
-            )
+            ),
         )
         await send_menu(session, user, _, event)
 
-    user.expectation["expect"] = {"type": None, "data": None}
-    await session.commit()
+    state["expect"] = {"type": None, "data": None}
 
 
 async def export(session: AsyncSession, event, user: User, _):
     """Handle export callback - send back user wallets as csv."""
-    await event.respond(_("export_started"))
+    await outbox.respond(event, _("export_started"))
 
     result = await session.execute(select(Wallet).where(Wallet.holder == user.id))
     wallets = result.scalars().all()
@@ -135,33 +143,29 @@ async def export(session: AsyncSession, event, user: User, _):
     today = datetime.utcnow().strftime("%Y-%m-%d")
     csv_bytes.name = f"export_wallets_{today}.csv"
 
-    await event.respond(_("export_wallets_caption"), file=csv_bytes)
+    await outbox.respond(
+        event, _("export_wallets_caption"), file=csv_bytes, priority=Priority.MEDIA
+    )
 
 
-async def handle_action(
-    session: AsyncSession, event, user: User, data: list, _
+async def handle_delete(
+    session: AsyncSession, user: User, _, event, uuid: bytes
 ) -> None:
-    """Handle user pressing a button under one of the action menus."""
-
-    if data[1][1] == "d":
-        uuid = bytes.fromhex(data[2])
+    """Handle user approving deletion of a wallet."""
 
-        wallet = await session.execute(select(Wallet).where(Wallet.id == uuid))
-        wallet = wallet.scalar_one_or_none()
-        wallet.is_deleted = True
-        session.add(wallet)
-
-        await session.execute(
-            delete(WalletAlias).where(WalletAlias.wallet == wallet.id)
-        )
+    wallet = await session.execute(select(Wallet).where(Wallet.id == uuid))
+    wallet = wallet.scalar_one_or_none()
+    wallet.is_deleted = True
+    session.add(wallet)
 
-        await session.commit()
+    await session.execute(delete(WalletAlias).where(WalletAlias.wallet == wallet.id))
 
-        await event.edit(_("wallet_deleted_succesfully"))
-        await send_menu(session, user, _, event)
+    bump_data_version(user)
+    await session.commit()
+    name_indexes.invalidate(user.id)
 
-    else:
-        raise Exception('Got unexpected data for callback command "action" (wallets)')
+    await outbox.edit(event, _("wallet_deleted_succesfully"))
+    await send_menu(session, user, _, event)
 
 
 async def check_ownership(
@@ -176,26 +180,28 @@ async def check_ownership(
     if wallet and not wallet.is_deleted:
         return True
     elif wallet and wallet.is_deleted:
-        await event.respond(_("wallet_action_ownership_check_got_deleted"))
+        await outbox.respond(event, _("wallet_action_ownership_check_got_deleted"))
     else:
-        await event.respond(_("wallet_action_ownership_check_failed"))
+        await outbox.respond(event, _("wallet_action_ownership_check_failed"))
 
     return False
 
 
 async def edit_menu(session: AsyncSession, user: User, _, event, uuid: bytes) -> None:
     """Send wallet edit menu to the user."""
-    await event.delete()
+    state = conversations.get(user.id)
+    await outbox.delete(event)
 
     is_owner = await check_ownership(session, user, _, event, uuid)
     if not is_owner:
         return
 
-    user.expectation["expect"] = {"type": "edit_wallet", "data": uuid.hex()}
-    await session.commit()
+    state["expect"] = {"type": "edit_wallet", "data": uuid.hex()}
 
-    buttons = [Button.inline(_("wallet_action_edit_cancel"), b"menu_wallets")]
-    await event.respond(_("edit_wallet_prompt"), buttons=buttons)
+    buttons = [
+        Button.inline(_("wallet_action_edit_cancel"), encode_callback("menu_wallets"))
+    ]
+    await outbox.respond(event, _("edit_wallet_prompt"), buttons=buttons)
 
 
 def format_component_transaction(transaction: Transaction, _) -> str:
@@ -222,7 +228,7 @@ async def view_menu(session: AsyncSession, user: User, _, event, uuid: bytes) ->
     MAX_TRANSACTIONS_SHOWN = 5
     MAX_ALIASES_SHOWN = 5
 
-    await event.delete()
+    await outbox.delete(event)
 
     is_owner = await check_ownership(session, user, _, event, uuid)
     if not is_owner:
@@ -234,7 +240,7 @@ async def view_menu(session: AsyncSession, user: User, _, event, uuid: bytes) ->
     wallet = wallet.scalar_one_or_none()
 
     if wallet is None:
-        await event.respond(_("wallet_action_view_not_found_error"))
+        await outbox.respond(event, _("wallet_action_view_not_found_error"))
         return
 
     # TODO: optimize to only select 5 latest
@@ -254,9 +260,12 @@ async def view_menu(session: AsyncSession, user: User, _, event, uuid: bytes) ->
         wallet.created_at, tz=timezone.utc
     ).strftime("%Y-%m-%d, %H:%M UTC")
 
-    buttons = [Button.inline(_("universal_back_button"), b"menu_wallets")]
+    buttons = [
+        Button.inline(_("universal_back_button"), encode_callback("menu_wallets"))
+    ]
     if len(transactions) == 0:
-        await event.respond(
+        await outbox.respond(
+            event,
             _("wallet_action_view_no_transactions").format(
                 wallet.icon,
                 wallet.name,
@@ -307,12 +316,12 @@ async def view_menu(session: AsyncSession, user: User, _, event, uuid: bytes) ->
                 len(full_aliases) - MAX_ALIASES_SHOWN
             )
 
-    await event.respond(content, buttons=buttons)
+    await outbox.respond(event, content, buttons=buttons)
 
 
 async def delete_menu(session: AsyncSession, user: User, _, event, uuid: bytes) -> None:
     """Send wallet delete menu to the user."""
-    await event.delete()
+    await outbox.delete(event)
 
     is_owner = await check_ownership(session, user, _, event, uuid)
     if not is_owner:
@@ -322,10 +331,14 @@ async def delete_menu(session: AsyncSession, user: User, _, event, uuid: bytes)
     name = name.scalar_one_or_none()
 
     buttons = [
-        Button.inline(_("wallet_action_delete_approve"), "action_wd_" + uuid.hex()),
-        Button.inline(_("wallet_action_delete_cancel"), b"menu_wallets"),
+        Button.inline(
+            _("wallet_action_delete_approve"), encode_callback("action_wd", uuid)
+        ),
+        Button.inline(
+            _("wallet_action_delete_cancel"), encode_callback("menu_wallets")
+        ),
     ]
-    await event.respond(_("delete_wallet_prompt").format(name), buttons=buttons)
+    await outbox.respond(event, _("delete_wallet_prompt").format(name), buttons=buttons)
 
 
 async def send_menu(
@@ -339,14 +352,13 @@ async def send_menu(
     """Send wallets menu to the user."""
     WALLETS_PER_PAGE = 20
 
-    # TODO: include pagination into a query
-    wallets = await session.execute(
-        select(Wallet).where(Wallet.holder == user.id).where(Wallet.is_deleted == False)
+    # both counts are answered from partial indexes
+    wallets_count = await session.execute(
+        select(func.count())
+        .select_from(Wallet)
+        .where(Wallet.holder == user.id, Wallet.is_deleted == False)
     )
-    wallets = wallets.scalars().all()
-    wallets = sorted(wallets, key=lambda x: x.transaction_count, reverse=True)
-
-    wallets_count = len(wallets)
+    wallets_count = wallets_count.scalar_one()
 
     del_wallets_count = await session.execute(
         select(func.count())
@@ -355,25 +367,35 @@ async def send_menu(
     )
     del_wallets_count = del_wallets_count.scalar_one()
 
-    if len(wallets) == 0:
-        buttons = [Button.inline(_("back_to_main_menu_button"), b"menu_start")]
+    if wallets_count == 0:
+        buttons = [
+            Button.inline(_("back_to_main_menu_button"), encode_callback("menu_start"))
+        ]
         if del_wallets_count == 0:
-            await event.respond(_("menu_wallets_no_wallets"), buttons=buttons)
+            await outbox.respond(event, _("menu_wallets_no_wallets"), buttons=buttons)
         else:
-            await event.respond(
+            await outbox.respond(
+                event,
                 _("menu_wallets_only_deleted").format(del_wallets_count),
                 buttons=buttons,
             )
         return
 
-    page_count = math.ceil(len(wallets) / WALLETS_PER_PAGE)
+    page_count = math.ceil(wallets_count / WALLETS_PER_PAGE)
 
     if page < 1:
         page = 1
     if page > page_count:
         page = page_count
 
-    wallets = wallets[(page - 1) * WALLETS_PER_PAGE : page * WALLETS_PER_PAGE]
+    wallets = await session.execute(
+        select(Wallet)
+        .where(Wallet.holder == user.id, Wallet.is_deleted == False)
+        .order_by(Wallet.transaction_count.desc(), Wallet.id)
+        .limit(WALLETS_PER_PAGE)
+        .offset((page - 1) * WALLETS_PER_PAGE)
+    )
+    wallets = wallets.scalars().all()
 
     wallet_info = [
         _("menu_wallets_component_wallet_info").format(
@@ -392,38 +414,13 @@ async def send_menu(
     if del_wallets_count != 0:
         content += _("menu_wallets_component_deleted_amount").format(del_wallets_count)
 
-    # get the id of newly sent message, and then add buttons according to that
-
     pagination_buttons = []
 
     if page_count > 1:
-        pagination_buttons = [
-            Button.inline("◀️", b"none"),
-            Button.inline(f"{page} / {page_count}", b"none"),
-            Button.inline("▶️", b"none"),
-        ]
-
-    buttons = [
-        pagination_buttons,
-        [
-            Button.inline(_("export_button"), b"export_wallets"),
-            Button.inline(_("back_to_main_menu_button"), b"menu_start"),
-        ],
-    ]
-    if original_msg is None:
-        message = await event.respond(content, buttons=buttons)
-    else:
-        message = await event.client.edit_message(
-            entity=event.chat_id, message=original_msg, text=content, buttons=buttons
-        )
-
-    pagination_buttons = []
-
-    if page_count > 1:
-        msg_id = str(message.id).encode("utf-8").hex()
-        back_button_data = "page_w_" + msg_id + "_" + str(page - 1)
-        main_button_data = "page_w_" + msg_id
-        forward_button_data = "page_w_" + msg_id + "_" + str(page + 1)
+        # buttons edit the message they are attached to, see callback handler
+        back_button_data = encode_callback("page_w", page - 1)
+        main_button_data = encode_callback("page_w", 0)
+        forward_button_data = encode_callback("page_w", page + 1)
         pagination_buttons = [
             Button.inline("◀️", back_button_data),
             Button.inline(f"{page} / {page_count}", main_button_data),
@@ -433,8 +430,11 @@ async def send_menu(
     buttons = [
         pagination_buttons,
         [
-            Button.inline(_("export_button"), b"export_wallets"),
-            Button.inline(_("back_to_main_menu_button"), b"menu_start"),
+            Button.inline(_("export_button"), encode_callback("export_wallets")),
+            Button.inline(_("back_to_main_menu_button"), encode_callback("menu_start")),
         ],
     ]
-    await message.edit(content, buttons=buttons)
+    if original_msg is None:
+        await outbox.respond(event, content, buttons=buttons)
+    else:
+        await outbox.edit_message(event, original_msg, content, buttons=buttons)
@@ -1,27 +1,79 @@
+import asyncio
 import gettext
 import os
+from types import MappingProxyType
+from typing import Callable, Mapping
 
-from sqlalchemy import select
-from sqlalchemy.ext.asyncio import AsyncSession
-
-from database.models import User
+from loguru import logger
 
 LOCALES_DIR = "locales"
 DEFAULT_LANG = "en"
 
+Translator = Callable[[str], str]
 
-async def setup_translations(user_id: int, session: AsyncSession):
-    """Load translations for given Telegram user."""
-    result = await session.execute(select(User).where(User.telegram_id == user_id))
-    user = result.scalar_one_or_none()
+# language -> translator, replaced as a whole on reload and never mutated
+_registry: Mapping[str, Translator] | None = None
+# .mo file -> modification time, as of the last load
+_mtimes: dict[str, float] = {}
 
-    lang = user.language if user and user.language else DEFAULT_LANG
 
-    mo_path = os.path.join(LOCALES_DIR, f"{lang}.mo")
+def _scan_catalogs() -> dict[str, float]:
+    """Return modification times of all compiled catalogs."""
     try:
-        with open(mo_path, "rb") as mo_file:
-            translator = gettext.GNUTranslations(mo_file).gettext
+        names = os.listdir(LOCALES_DIR)
     except FileNotFoundError:
-        translator = lambda s: s  # fallback: return original string
+        return {}
+
+    mtimes = {}
+    for name in names:
+        if name.endswith(".mo"):
+            path = os.path.join(LOCALES_DIR, name)
+            mtimes[path] = os.stat(path).st_mtime
+    return mtimes
+
+
+def load_translations() -> Mapping[str, Translator]:
+    """Load all compiled catalogs into a new immutable registry."""
+    global _registry, _mtimes
+
+    mtimes = _scan_catalogs()
+    translators = {}
+    for path in mtimes:
+        with open(path, "rb") as mo_file:
+            translators[os.path.basename(path)[:-3]] = gettext.GNUTranslations(
+                mo_file
+            ).gettext
+
+    _registry = MappingProxyType(translators)
+    _mtimes = mtimes
+    return _registry
+
 
+def get_translator(language: str | None) -> Translator:
+    """Return translator for the language, falling back to the default one."""
+    registry = _registry if _registry is not None else load_translations()
+
+    translator = registry.get(language or DEFAULT_LANG) or registry.get(DEFAULT_LANG)
+    if translator is None:
+        return lambda s: s  # fallback: return original string
     return translator
+
+
+def reload_if_changed() -> bool:
+    """Reload catalogs if any .mo file was added, removed or modified."""
+    if _scan_catalogs() == _mtimes:
+        return False
+
+    load_translations()
+    return True
+
+
+async def watch_translations(interval: float) -> None:
+    """Check catalogs for changes every `interval` seconds, reload them."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if reload_if_changed():
+                logger.info(f"Reloaded translations: {', '.join(_registry or {})}")
+        except Exception as e:
+            logger.error(f"Failed to reload translations: {e}")